@@ -0,0 +1,662 @@
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from xml.sax.saxutils import quoteattr
+
+MACHINE_IDENTIFIER = 'benchmark-plex'
+SERVER_NAME = 'Benchmark Plex'
+ADMIN_TOKEN = 'benchmark-admin-token'
+ADMIN_USERNAME = 'admin'
+ADMIN_PASSWORD = 'admin'
+JELLYFIN_API_KEY = 'benchmark-api-key'
+
+# Plex library section: (key, section type, title)
+SECTIONS = [
+    ('1', 'movie', 'Movies'),
+    ('2', 'show', 'TV Shows'),
+    ('3', 'artist', 'Music'),
+]
+
+# Plex libtype --> (search type number, XML tag, Jellyfin BaseItemKind)
+LIBTYPES = {
+    'movie': (1, 'Video', 'Movie'),
+    'show': (2, 'Directory', 'Series'),
+    'season': (3, 'Directory', 'Season'),
+    'episode': (4, 'Video', 'Episode'),
+    'artist': (8, 'Directory', 'MusicArtist'),
+    'album': (9, 'Directory', 'MusicAlbum'),
+    'track': (10, 'Track', 'Audio'),
+}
+SEARCH_TYPES = {number: libtype for libtype, (number, _, _) in LIBTYPES.items()}
+
+SECTION_LIBTYPES = {
+    'movie': ['movie'],
+    'show': ['show', 'season', 'episode'],
+    'artist': ['artist', 'album', 'track'],
+}
+
+EPISODES_PER_SEASON = 10
+SEASONS_PER_SHOW = 2
+TRACKS_PER_ALBUM = 10
+ALBUMS_PER_ARTIST = 2
+# updatedAt, lastRatedAt and lastViewedAt are spread out after this
+BASE_TIMESTAMP = 1600000000
+
+WORDS = ['night', 'river', 'glass', 'summer', 'iron', 'shadow', 'garden', 'echo', 'winter', 'signal', 'harbor',
+         'crimson', 'silent', 'golden', 'empire', 'ghost', 'paper', 'storm', 'orbit', 'velvet', 'hollow', 'north']
+
+# 1x1 JPEG served for every thumb/art request
+JPEG = bytes.fromhex(
+    'ffd8ffe000104a46494600010100000100010000ffdb004300080606070605080707070909080a0c140d0c0b0b0c1912130f141d1a1f1e'
+    '1d1a1c1c20242e2720222c231c1c2837292c30313434341f27393d38323c2e333432ffc0000b080001000101011100ffc4001f000001'
+    '0501010101010100000000000000000102030405060708090a0bffc400b5100002010303020403050504040000017d010203000411051221'
+    '31410613516107227114328191a1082342b1c11552d1f02433627282090a161718191a25262728292a3435363738393a434445464748494a'
+    '535455565758595a636465666768696a737475767778797a838485868788898a92939495969798999aa2a3a4a5a6a7a8a9aab2b3b4b5b6'
+    'b7b8b9bac2c3c4c5c6c7c8c9cad2d3d4d5d6d7d8d9dae1e2e3e4e5e6e7e8e9eaf1f2f3f4f5f6f7f8f9faffda0008010100003f00fbd3'
+    'ffd9')
+
+
+class Library:
+    """A generated Plex library and the Jellyfin library it should map onto.
+
+    Roughly a third each of movies, episodes and music tracks, plus the shows, seasons, artists and albums
+    they belong to. Most items carry provider IDs on both sides; some only match by title, some only
+    fuzzily, and some are missing from Jellyfin altogether.
+    """
+
+    def __init__(self, size=1000, users=3, playlists=5, playlist_size=100, rated=0.1, watched=0.2,
+                 unmatched=0.05, title_only=0.1, seed=0):
+        self.random = random.Random(seed)
+        self.items = []
+        self.by_key = {}
+        self.by_type = {libtype: [] for libtype in LIBTYPES}
+        self.rated = rated
+        self.watched = watched
+        self.unmatched = unmatched
+        self.title_only = title_only
+        self.seed = seed
+        self.users = [{'id': 100 + i, 'username': f'user{i}', 'token': f'benchmark-user-{i}-token'}
+                      for i in range(users)]
+        per_kind = max(1, size // 3)
+        self._add_movies(per_kind)
+        self._add_shows(per_kind)
+        self._add_music(per_kind)
+        playable = self.by_type['movie'] + self.by_type['episode'] + self.by_type['track']
+        self.playlists = []
+        for i in range(playlists):
+            self.playlists.append({
+                'ratingKey': str(900000000 + i),
+                'title': f'Playlist {i}',
+                'updatedAt': BASE_TIMESTAMP + i,
+                'items': [item['ratingKey'] for item in self.random.sample(playable, min(playlist_size, len(playable)))],
+            })
+
+    def _title(self, words=2):
+        return ' '.join(self.random.choice(WORDS).title() for _ in range(words))
+
+    def _add(self, libtype, title, **fields):
+        rating_key = str(len(self.items) + 1)
+        item = {
+            'ratingKey': rating_key,
+            'type': libtype,
+            'title': title,
+            'guid': f'plex://{libtype}/{uuid.UUID(int=self.random.getrandbits(128)).hex}',
+            'jellyfin_id': uuid.UUID(int=self.random.getrandbits(128)).hex,
+            'provider_ids': {},
+            'updatedAt': BASE_TIMESTAMP + int(rating_key),
+            **fields,
+        }
+        roll = self.random.random()
+        item['on_jellyfin'] = roll >= self.unmatched
+        if roll >= self.unmatched + self.title_only:
+            if libtype in ['movie', 'show', 'episode']:
+                item['provider_ids'] = {'Imdb': f'tt{int(rating_key):07d}', 'Tmdb': rating_key}
+            else:
+                item['provider_ids'] = {'MusicBrainzTrack' if libtype == 'track' else 'MusicBrainzAlbum':
+                                        str(uuid.UUID(int=int(rating_key)))}
+        self.items.append(item)
+        self.by_key[rating_key] = item
+        self.by_type[libtype].append(item)
+        return item
+
+    def _add_movies(self, count):
+        for i in range(count):
+            self._add('movie', f'{self._title(3)} {i}', year=1970 + i % 50, section='1')
+
+    def _add_shows(self, count):
+        shows = max(1, count // (SEASONS_PER_SHOW * EPISODES_PER_SEASON))
+        for s in range(shows):
+            show = self._add('show', f'{self._title()} {s}', year=1990 + s % 30, section='2')
+            for season_index in range(1, SEASONS_PER_SHOW + 1):
+                season = self._add('season', f'Season {season_index}', index=season_index, section='2',
+                                   parentTitle=show['title'], parentRatingKey=show['ratingKey'])
+                for index in range(1, EPISODES_PER_SEASON + 1):
+                    self._add('episode', self._title(), index=index, parentIndex=season_index, year=show['year'],
+                              section='2', parentTitle=season['title'], grandparentTitle=show['title'],
+                              parentRatingKey=season['ratingKey'])
+
+    def _add_music(self, count):
+        artists = max(1, count // (ALBUMS_PER_ARTIST * TRACKS_PER_ALBUM))
+        for a in range(artists):
+            artist = self._add('artist', f'The {self._title()} {a}', section='3')
+            for album_index in range(ALBUMS_PER_ARTIST):
+                album = self._add('album', self._title(), year=2000 + a % 20, section='3',
+                                  parentTitle=artist['title'], parentRatingKey=artist['ratingKey'])
+                for index in range(1, TRACKS_PER_ALBUM + 1):
+                    self._add('track', self._title(), index=index, section='3', parentTitle=album['title'],
+                              grandparentTitle=artist['title'], parentRatingKey=album['ratingKey'])
+
+    def _roll(self, user_id, item, salt):
+        return random.Random(f"{self.seed}:{user_id}:{item['ratingKey']}:{salt}").random()
+
+    def user_state(self, user_id, item):
+        # (userRating, viewCount, viewOffset, lastViewedAt) for one user, stable across requests
+        rating = None
+        if self._roll(user_id, item, 'rating') < self.rated:
+            rating = float(1 + int(self._roll(user_id, item, 'stars') * 10))
+        view_count, view_offset, last_viewed = 0, 0, None
+        if item['type'] in ['movie', 'episode', 'track']:
+            roll = self._roll(user_id, item, 'watched')
+            if roll < self.watched:
+                view_count = 1 + int(roll * 10)
+                last_viewed = BASE_TIMESTAMP + int(roll * 100000000)
+            elif roll < self.watched * 1.25:
+                view_offset = 60000 + int(roll * 1000000)
+                last_viewed = BASE_TIMESTAMP + int(roll * 100000000)
+        return rating, view_count, view_offset, last_viewed
+
+    def rated_at(self, user_id, item):
+        return BASE_TIMESTAMP + int(self._roll(user_id, item, 'rated_at') * 100000000)
+
+    def jellyfin_name(self, item):
+        if item['provider_ids']:
+            return item['title']
+        # title-only items: every other one is spelled slightly differently, to exercise fuzzy matching
+        if int(item['ratingKey']) % 2:
+            return item['title'].replace(' ', ': ', 1)
+        return item['title']
+
+    def jellyfin_item(self, item):
+        data = {
+            'Id': item['jellyfin_id'],
+            'Name': self.jellyfin_name(item),
+            'Type': LIBTYPES[item['type']][2],
+            'ProviderIds': item['provider_ids'],
+            'DateCreated': '2024-01-01T00:00:00.0000000Z',
+        }
+        if item.get('year'):
+            data['ProductionYear'] = item['year']
+        if item.get('index') is not None:
+            data['IndexNumber'] = item['index']
+        if item['type'] == 'episode':
+            data['ParentIndexNumber'] = item['parentIndex']
+            data['SeriesName'] = item['grandparentTitle']
+        elif item['type'] == 'season':
+            data['SeriesName'] = item['parentTitle']
+        elif item['type'] == 'track':
+            data['Album'] = item['parentTitle']
+            data['AlbumArtist'] = item['grandparentTitle']
+        elif item['type'] == 'album':
+            data['AlbumArtist'] = item['parentTitle']
+        return data
+
+
+class Stats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter()
+        self.errors = 0
+
+    def count(self, route):
+        with self._lock:
+            self.requests[route] += 1
+
+    def error(self):
+        with self._lock:
+            self.errors += 1
+
+    def reset(self):
+        with self._lock:
+            self.requests = Counter()
+            self.errors = 0
+
+    def total(self):
+        with self._lock:
+            return sum(self.requests.values())
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # (method, compiled path regex, handler method name, route name for the request counts)
+    routes = []
+
+    def log_message(self, format, *args):
+        pass
+
+    def _dispatch(self, method):
+        mock = self.server.mock
+        url = urlsplit(self.path)
+        self.query = {key: values[-1] for key, values in parse_qs(url.query, keep_blank_values=True).items()}
+        # plexapi sends paging as headers, the Jellyfin client as query parameters
+        for key in ['X-Plex-Container-Start', 'X-Plex-Container-Size']:
+            if key in self.headers and key not in self.query:
+                self.query[key] = self.headers[key]
+        body = self._read_body()
+        for route_method, pattern, handler, name in self.routes:
+            match = pattern.fullmatch(url.path)
+            if route_method == method and match:
+                mock.stats.count(f'{method} {name}')
+                if mock.latency:
+                    time.sleep(mock.latency)
+                if mock.error_rate and mock.random() < mock.error_rate:
+                    mock.stats.error()
+                    return self._send(503, b'', 'text/plain', headers={'Retry-After': '0'})
+                return getattr(self, handler)(body=body, **match.groupdict())
+        mock.stats.count(f'{method} (unknown)')
+        self._send(404, f'no mock route for {method} {url.path}'.encode(), 'text/plain')
+
+    def _read_body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip() or b'0', 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _send(self, status, body, content_type, headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PUT(self):
+        self._dispatch('PUT')
+
+    def do_DELETE(self):
+        self._dispatch('DELETE')
+
+
+def route(method, path, name=None):
+    def register(func):
+        func.route = (method, re.compile(path), name or path)
+        return func
+    return register
+
+
+def _collect_routes(cls):
+    cls.routes = [(func.route[0], func.route[1], attr, func.route[2])
+                  for attr, func in vars(cls).items() if hasattr(func, 'route')]
+    return cls
+
+
+class MockServer:
+    def __init__(self, handler, library, latency=0.0, error_rate=0.0, seed=0):
+        self.library = library
+        self.latency = latency
+        self.error_rate = error_rate
+        self.stats = Stats()
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.httpd.daemon_threads = True
+        self.httpd.mock = self
+        self.thread = None
+
+    def random(self):
+        with self._random_lock:
+            return self._random.random()
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name=type(self).__name__, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def _xml_attrs(attrs):
+    return ' '.join(f'{key}={quoteattr(str(value))}' for key, value in attrs.items() if value is not None)
+
+
+def _container(children='', **attrs):
+    return f'<?xml version="1.0" encoding="UTF-8"?><MediaContainer {_xml_attrs(attrs)}>{children}</MediaContainer>'
+
+
+@_collect_routes
+class PlexHandler(_Handler):
+    def _user_id(self):
+        token = self.headers.get('X-Plex-Token') or self.query.get('X-Plex-Token')
+        for user in self.server.mock.library.users:
+            if user['token'] == token:
+                return user['id']
+        return 1
+
+    def _xml(self, xml, status=200):
+        self._send(status, xml.encode(), 'text/xml;charset=utf-8')
+
+    def _item_xml(self, item, user_id):
+        library = self.server.mock.library
+        rating, view_count, view_offset, last_viewed = library.user_state(user_id, item)
+        attrs = {
+            'ratingKey': item['ratingKey'],
+            'key': f"/library/metadata/{item['ratingKey']}",
+            'guid': item['guid'],
+            'type': item['type'],
+            'title': item['title'],
+            'year': item.get('year'),
+            'index': item.get('index'),
+            'parentIndex': item.get('parentIndex'),
+            'parentTitle': item.get('parentTitle'),
+            'grandparentTitle': item.get('grandparentTitle'),
+            'parentRatingKey': item.get('parentRatingKey'),
+            'librarySectionID': item['section'],
+            'userRating': rating,
+            'lastRatedAt': library.rated_at(user_id, item) if rating else None,
+            'updatedAt': item['updatedAt'],
+            'viewCount': view_count or None,
+            'viewOffset': view_offset or None,
+            'lastViewedAt': last_viewed,
+            'thumb': f"/library/metadata/{item['ratingKey']}/thumb/1",
+            'art': f"/library/metadata/{item['ratingKey']}/art/1",
+        }
+        guids = ''.join(f'<Guid id="{provider.lower()}://{value}"/>' for provider, value in item['provider_ids'].items()
+                        if provider in ['Imdb', 'Tmdb'])
+        tag = LIBTYPES[item['type']][1]
+        return f'<{tag} {_xml_attrs(attrs)}>{guids}</{tag}>'
+
+    @route('GET', r'/', name='/')
+    def root(self, body):
+        self._xml(_container(machineIdentifier=MACHINE_IDENTIFIER, friendlyName=SERVER_NAME, version='1.40.0.0',
+                             myPlex='1', myPlexUsername=ADMIN_USERNAME, platform='Linux'))
+
+    @route('GET', r'/library/?', name='/library')
+    def library(self, body):
+        self._xml(_container('<Directory key="sections" title="Library Sections"/>', size=1, title1='Plex Library'))
+
+    @route('GET', r'/library/metadata/(?P<keys>\d+(,\d+)*)', name='/library/metadata/{id}')
+    def metadata(self, body, keys):
+        library = self.server.mock.library
+        items = [library.by_key[key] for key in keys.split(',') if key in library.by_key]
+        if not items:
+            return self._xml(_container(size=0), status=404)
+        user_id = self._user_id()
+        self._xml(_container(''.join(self._item_xml(item, user_id) for item in items), size=len(items)))
+
+    @route('GET', r'/library/sections/?', name='/library/sections')
+    def sections(self, body):
+        directories = ''.join(f'<Directory key="{key}" type="{section_type}" title="{title}" agent="tv.plex.agents" '
+                              f'uuid="{key}" language="en-US"/>' for key, section_type, title in SECTIONS)
+        self._xml(_container(directories, size=len(SECTIONS)))
+
+    def _filter_meta(self, section_type):
+        types = ''
+        for libtype in SECTION_LIBTYPES[section_type]:
+            number = LIBTYPES[libtype][0]
+            fields = (f'<Field key="{libtype}.userRating" title="Rating" type="integer"/>'
+                      f'<Field key="{libtype}.viewCount" title="Plays" type="integer"/>'
+                      f'<Field key="{libtype}.inProgress" title="In Progress" type="boolean"/>'
+                      f'<Field key="{libtype}.lastRatedAt" title="Last Rated" type="date"/>'
+                      f'<Field key="{libtype}.lastViewedAt" title="Last Played" type="date"/>'
+                      f'<Field key="{libtype}.updatedAt" title="Date Updated" type="date"/>')
+            types += (f'<Type key="/library/sections/all?type={number}" type="{libtype}" title="{libtype}" '
+                      f'active="1">{fields}</Type>')
+        operators = ''.join(f'<Operator key={quoteattr(key)} title={quoteattr(key)}/>' for key in ['=', '!=', '>>=', '<<='])
+        field_types = (f'<FieldType type="integer">{operators}</FieldType>'
+                       f'<FieldType type="date">{operators}</FieldType>'
+                       f'<FieldType type="boolean"><Operator key="=" title="is"/><Operator key="!=" title="is not"/>'
+                       f'</FieldType>')
+        return f'<Meta>{types}{field_types}</Meta>'
+
+    @route('GET', r'/library/sections/(?P<key>\d+)/(?P<listing>all|collections)', name='/library/sections/{id}/all')
+    def section_items(self, body, key, listing):
+        section_type = next(section_type for section_key, section_type, _ in SECTIONS if section_key == key)
+        if self.query.get('includeMeta') == '1':
+            return self._xml(_container(self._filter_meta(section_type), size=0, totalSize=0))
+        if listing == 'collections':
+            return self._xml(_container(size=0, totalSize=0))
+        library = self.server.mock.library
+        libtype = SEARCH_TYPES.get(int(self.query.get('type', 0) or 0), SECTION_LIBTYPES[section_type][0])
+        user_id = self._user_id()
+        items = library.by_type[libtype]
+        if any(k.endswith('userRating>>') for k in self.query):
+            items = [item for item in items if library.user_state(user_id, item)[0]]
+        elif any(k.endswith('viewCount>>') for k in self.query):
+            items = [item for item in items if library.user_state(user_id, item)[1]]
+        elif any(k.endswith('inProgress') for k in self.query):
+            items = [item for item in items if library.user_state(user_id, item)[2]]
+        # date filters, as sent for incremental runs: <field>>>=<timestamp>
+        for k, value in self.query.items():
+            if k.endswith('lastRatedAt>>'):
+                items = [item for item in items if library.rated_at(user_id, item) > int(value)]
+            elif k.endswith('lastViewedAt>>'):
+                items = [item for item in items if (library.user_state(user_id, item)[3] or 0) > int(value)]
+            elif k.endswith('updatedAt>>'):
+                items = [item for item in items if item['updatedAt'] > int(value)]
+        start = int(self.query.get('X-Plex-Container-Start', 0))
+        size = int(self.query.get('X-Plex-Container-Size', len(items)))
+        page = items[start:start + size]
+        children = ''.join(self._item_xml(item, user_id) for item in page)
+        self._xml(_container(children, size=len(page), totalSize=len(items), offset=start,
+                             librarySectionID=key))
+
+    @route('GET', r'/playlists/?', name='/playlists')
+    def playlists(self, body):
+        children = ''.join(f'<Playlist ratingKey="{playlist["ratingKey"]}" key="/playlists/{playlist["ratingKey"]}'
+                           f'/items" type="playlist" title={quoteattr(playlist["title"])} playlistType="video" '
+                           f'smart="0" leafCount="{len(playlist["items"])}" updatedAt="{playlist["updatedAt"]}"/>'
+                           for playlist in self.server.mock.library.playlists)
+        self._xml(_container(children, size=len(self.server.mock.library.playlists)))
+
+    @route('GET', r'/playlists/(?P<key>\d+)/items', name='/playlists/{id}/items')
+    def playlist_items(self, body, key):
+        library = self.server.mock.library
+        playlist = next(playlist for playlist in library.playlists if playlist['ratingKey'] == key)
+        user_id = self._user_id()
+        start = int(self.query.get('X-Plex-Container-Start', 0))
+        size = int(self.query.get('X-Plex-Container-Size', len(playlist['items'])))
+        page = playlist['items'][start:start + size]
+        children = ''.join(self._item_xml(library.by_key[rating_key], user_id) for rating_key in page)
+        self._xml(_container(children, size=len(page), totalSize=len(playlist['items']), offset=start))
+
+    @route('GET', r'/library/metadata/\d+/(thumb|art)/\d+', name='/library/metadata/{id}/{image}')
+    def image(self, body):
+        self._send(200, JPEG, 'image/jpeg')
+
+    @route('GET', r'/photo/:/transcode', name='/photo/:/transcode')
+    def transcode(self, body):
+        self._send(200, JPEG, 'image/jpeg')
+
+    # plex.tv account endpoints; the benchmark routes https://plex.tv here
+
+    @route('GET', r'/api/v2/user', name='plex.tv/api/v2/user')
+    def account(self, body):
+        self._xml(f'<?xml version="1.0" encoding="UTF-8"?><user id="1" uuid="benchmark" username="{ADMIN_USERNAME}" '
+                  f'title="{ADMIN_USERNAME}" email="admin@example.com" authToken="{ADMIN_TOKEN}" scrobbleTypes="1" '
+                  f'joinedAt="1600000000"><subscription active="1" status="Active" plan="lifetime"/>'
+                  f'<profile autoSelectAudio="1" autoSelectSubtitle="0"/></user>')
+
+    @route('GET', r'/api/users/?', name='plex.tv/api/users')
+    def users(self, body):
+        children = ''.join(
+            f'<User id="{user["id"]}" title="{user["username"]}" username="{user["username"]}" '
+            f'email="{user["username"]}@example.com"><Server id="{user["id"]}" serverId="1" '
+            f'machineIdentifier="{MACHINE_IDENTIFIER}" name="{SERVER_NAME}" allLibraries="1" owned="0" '
+            f'pending="0"/></User>'
+            for user in self.server.mock.library.users)
+        self._xml(_container(children, friendlyName='myPlex', size=len(self.server.mock.library.users)))
+
+    @route('GET', r'/api/servers/[^/]+/shared_servers', name='plex.tv/api/servers/{id}/shared_servers')
+    def shared_servers(self, body):
+        children = ''.join(f'<SharedServer id="{user["id"]}" userID="{user["id"]}" username="{user["username"]}" '
+                           f'accessToken="{user["token"]}"/>' for user in self.server.mock.library.users)
+        self._xml(_container(children))
+
+
+@_collect_routes
+class JellyfinHandler(_Handler):
+    def _json(self, data, status=200):
+        self._send(status, json.dumps(data).encode(), 'application/json')
+
+    def _no_content(self):
+        self._send(204, b'', 'application/json')
+
+    def _page(self, items):
+        start = int(self.query.get('StartIndex', 0))
+        limit = int(self.query.get('Limit', len(items)) or len(items))
+        self._json({'Items': items[start:start + limit], 'TotalRecordCount': len(items), 'StartIndex': start})
+
+    @route('POST', r'/Users/AuthenticateByName', name='/Users/AuthenticateByName')
+    def authenticate(self, body):
+        self._json({'AccessToken': 'benchmark-jellyfin-token', 'User': {'Id': self.server.mock.admin_id}})
+
+    @route('GET', r'/Users/Me', name='/Users/Me')
+    def me(self, body):
+        self._json({'Id': self.server.mock.admin_id, 'Name': ADMIN_USERNAME})
+
+    @route('GET', r'/Users', name='/Users')
+    def get_users(self, body):
+        with self.server.mock.lock:
+            users = [{'Id': user_id, 'Name': name} for user_id, name in self.server.mock.users.items()]
+        self._json(users)
+
+    @route('POST', r'/Users/New', name='/Users/New')
+    def new_user(self, body):
+        name = json.loads(body or b'{}').get('Name')
+        with self.server.mock.lock:
+            if name.casefold() in (existing.casefold() for existing in self.server.mock.users.values()):
+                return self._send(400, f'A user with the name {name} already exists.'.encode(), 'text/plain')
+            user_id = uuid.uuid4().hex
+            self.server.mock.users[user_id] = name
+        self._json({'Id': user_id, 'Name': name})
+
+    @route('POST', r'/Users/(?P<user_id>\w+)/(Policy|Password)', name='/Users/{id}/{Policy,Password}')
+    def user_settings(self, body, user_id):
+        self._no_content()
+
+    @route('DELETE', r'/Users/(?P<user_id>\w+)', name='/Users/{id}')
+    def delete_user(self, body, user_id):
+        with self.server.mock.lock:
+            self.server.mock.users.pop(user_id, None)
+        self._no_content()
+
+    @route('GET', r'/Users/(?P<user_id>\w+)/Items', name='/Users/{id}/Items')
+    def items(self, body, user_id):
+        mock = self.server.mock
+        item_types = set(filter(None, self.query.get('IncludeItemTypes', '').split(',')))
+        if item_types == {'Playlist'}:
+            with mock.lock:
+                playlists = [{'Id': playlist_id, 'Name': playlist['Name'], 'Type': 'Playlist'}
+                             for playlist_id, playlist in mock.playlists.items() if playlist['UserId'] == user_id]
+            return self._page(playlists)
+        items = mock.jellyfin_items
+        if item_types:
+            items = [item for item in items if item['Type'] in item_types]
+        self._page(items)
+
+    @route('GET', r'/Artists', name='/Artists')
+    def artists(self, body):
+        self._page([item for item in self.server.mock.jellyfin_items if item['Type'] == 'MusicArtist'])
+
+    @route('GET', r'/Search/Hints', name='/Search/Hints')
+    def search(self, body):
+        term = self.query.get('SearchTerm', '').casefold()
+        hints = [{**item, 'ItemId': item['Id']} for item in self.server.mock.jellyfin_items
+                 if term and term in item['Name'].casefold()][:20]
+        self._json({'SearchHints': hints, 'TotalRecordCount': len(hints)})
+
+    @route('POST', r'/UserItems/(?P<item_id>\w+)/UserData', name='/UserItems/{id}/UserData')
+    def user_data(self, body, item_id):
+        with self.server.mock.lock:
+            self.server.mock.writes['user_data'] += 1
+        self._json(json.loads(body or b'{}'))
+
+    @route('POST', r'/Users/(?P<user_id>\w+)/Items/(?P<item_id>\w+)/UserData', name='/Users/{id}/Items/{id}/UserData')
+    def legacy_user_data(self, body, user_id, item_id):
+        self.user_data(body=body, item_id=item_id)
+
+    @route('POST', r'/Users/(?P<user_id>\w+)/Items/(?P<item_id>\w+)/Rating', name='/Users/{id}/Items/{id}/Rating')
+    def rating(self, body, user_id, item_id):
+        self.user_data(body=b'{}', item_id=item_id)
+
+    @route('POST', r'/Playlists', name='/Playlists')
+    def make_playlist(self, body):
+        data = json.loads(body or b'{}')
+        playlist_id = uuid.uuid4().hex
+        with self.server.mock.lock:
+            self.server.mock.playlists[playlist_id] = {'Name': data.get('Name'), 'UserId': data.get('UserId'),
+                                                       'Items': []}
+            self.server.mock.writes['playlists'] += 1
+        self._json({'Id': playlist_id})
+
+    @route('GET', r'/Playlists/(?P<playlist_id>\w+)/Items', name='/Playlists/{id}/Items')
+    def playlist_items(self, body, playlist_id):
+        mock = self.server.mock
+        with mock.lock:
+            item_ids = list(mock.playlists.get(playlist_id, {}).get('Items', []))
+        self._page([{'Id': item_id} for item_id in item_ids])
+
+    @route('POST', r'/Playlists/(?P<playlist_id>\w+)/Items', name='/Playlists/{id}/Items')
+    def add_to_playlist(self, body, playlist_id):
+        item_ids = [item_id for item_id in self.query.get('Ids', '').split(',') if item_id]
+        with self.server.mock.lock:
+            self.server.mock.playlists[playlist_id]['Items'].extend(item_ids)
+            self.server.mock.writes['playlist_items'] += len(item_ids)
+        self._no_content()
+
+    @route('POST', r'/Items/(?P<item_id>\w+)/Images/(?P<image_type>\w+)', name='/Items/{id}/Images/{type}')
+    def upload_image(self, body, item_id, image_type):
+        with self.server.mock.lock:
+            self.server.mock.writes['images'] += 1
+            self.server.mock.writes['image_bytes'] += len(body)
+        self._no_content()
+
+
+class MockPlex(MockServer):
+    def __init__(self, library, latency=0.0, error_rate=0.0, seed=0):
+        super().__init__(handler=PlexHandler, library=library, latency=latency, error_rate=error_rate, seed=seed)
+
+
+class MockJellyfin(MockServer):
+    def __init__(self, library, latency=0.0, error_rate=0.0, seed=0):
+        super().__init__(handler=JellyfinHandler, library=library, latency=latency, error_rate=error_rate, seed=seed)
+        self.lock = threading.Lock()
+        self.admin_id = uuid.UUID(int=1).hex
+        self.reset()
+
+    def reset(self, with_users=True):
+        # a fresh Jellyfin server with no playlists and nothing written yet; with_users=False leaves only the admin
+        with self.lock:
+            self.users = {self.admin_id: ADMIN_USERNAME}
+            if with_users:
+                self.users.update({uuid.UUID(int=user['id']).hex: user['username'] for user in self.library.users})
+            self.playlists = {}
+            self.writes = Counter()
+        self.jellyfin_items = [self.library.jellyfin_item(item) for item in self.library.items if item['on_jellyfin']]
+        self.stats.reset()
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+
+"""
+Runs the migrate_* scripts against local mock Plex and Jellyfin servers and reports, for each script and library
+size, the wall time, the requests sent to each server and the peak memory of the script process.
+
+    python benchmarks/run.py --sizes 1000 10000 --scripts ratings playlists --latency 5 --error-rate 0.01
+
+Each script runs in a fresh temporary working directory (so journals, match caches and tokens never carry over
+between runs), with a generated creds.py pointing at the mock servers. Use --json to save the results for
+comparing runs over time.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from mock_servers import (ADMIN_PASSWORD, ADMIN_TOKEN, ADMIN_USERNAME, JELLYFIN_API_KEY, SERVER_NAME, Library,
+                          MockJellyfin, MockPlex)
+
+SCRIPTS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'scripts')
+
+# benchmark name --> (script, arguments, whether the Jellyfin users already exist)
+SCRIPTS = {
+    'users': ('migrate_users.py', [], False),
+    'ratings': ('migrate_ratings.py', ['--all-users'], True),
+    'playlists': ('migrate_playlists.py', ['--all-users'], True),
+    'watch-state': ('migrate_watch_state.py', ['--include-admin'], True),
+    'posters': ('migrate_posters.py', ['--upload', '--image-source', 'plex'], True),
+}
+
+CREDS = '''PLEX_URL = {plex_url!r}
+PLEX_TOKEN = {plex_token!r}
+PLEX_SERVER_NAME = {server_name!r}
+
+JELLYFIN_URL = {jellyfin_url!r}
+JELLYFIN_API_KEY = {api_key!r}
+JELLYFIN_ADMIN_USERNAME = {username!r}
+JELLYFIN_ADMIN_PASSWORD = {password!r}
+
+JELLYFIN_USER_POLICY = {{"Policy": {{"IsAdministrator": False}}}}
+'''
+
+# loaded by every Python process started with the run directory on PYTHONPATH: plexapi talks to plex.tv for
+# account and sharing details, so point those requests at the mock Plex server instead
+SITECUSTOMIZE = '''import os
+import requests
+
+_plex_tv = os.environ.get('BENCHMARK_PLEX_TV')
+_request = requests.Session.request
+
+
+def _redirect(self, method, url, *args, **kwargs):
+    if _plex_tv and url.startswith('https://plex.tv'):
+        url = _plex_tv + url[len('https://plex.tv'):]
+    return _request(self, method, url, *args, **kwargs)
+
+
+requests.Session.request = _redirect
+'''
+
+
+def run_script(name, plex, jellyfin, extra_args, keep):
+    script, args, with_users = SCRIPTS[name]
+    jellyfin.reset(with_users=with_users)
+    plex.stats.reset()
+    run_dir = tempfile.mkdtemp(prefix=f'benchmark-{name}-')
+    with open(os.path.join(run_dir, 'creds.py'), 'w') as f:
+        f.write(CREDS.format(plex_url=plex.url, plex_token=ADMIN_TOKEN, server_name=SERVER_NAME,
+                             jellyfin_url=jellyfin.url, api_key=JELLYFIN_API_KEY, username=ADMIN_USERNAME,
+                             password=ADMIN_PASSWORD))
+    with open(os.path.join(run_dir, 'sitecustomize.py'), 'w') as f:
+        f.write(SITECUSTOMIZE)
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([run_dir, SCRIPTS_DIR]), BENCHMARK_PLEX_TV=plex.url,
+               PYTHONUNBUFFERED='1')
+    log_file = os.path.join(run_dir, 'output.log')
+    with open(log_file, 'w') as log:
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, os.path.join(SCRIPTS_DIR, script)] + args + extra_args,
+                                   cwd=run_dir, env=env, stdout=log, stderr=subprocess.STDOUT,
+                                   stdin=subprocess.DEVNULL)
+        # wait4 gives the resource usage of this one child, so peak memory isn't mixed up between runs
+        _, status, usage = os.wait4(process.pid, 0)
+        wall_time = time.perf_counter() - start
+        # like Popen.returncode: negative signal number if the child was killed (os.waitstatus_to_exitcode is 3.9+)
+        process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    result = {
+        'script': name,
+        'exit_code': process.returncode,
+        'wall_time': round(wall_time, 3),
+        'peak_rss_mb': round(usage.ru_maxrss / 1024, 1),
+        'plex_requests': plex.stats.total(),
+        'jellyfin_requests': jellyfin.stats.total(),
+        'plex_errors': plex.stats.errors,
+        'jellyfin_errors': jellyfin.stats.errors,
+        'jellyfin_writes': dict(jellyfin.writes),
+        'plex_routes': dict(plex.stats.requests),
+        'jellyfin_routes': dict(jellyfin.stats.requests),
+        'log': log_file if keep else None,
+    }
+    if process.returncode != 0:
+        with open(log_file) as f:
+            print(f"{name} exited with {process.returncode}, last output:\n" + ''.join(f.readlines()[-15:]))
+    return result
+
+
+def print_results(results):
+    header = (f"{'script':<12} {'items':>7} {'wall s':>8} {'plex req':>9} {'jf req':>8} {'jf err':>7} "
+              f"{'writes':>8} {'peak MB':>8} {'exit':>5}")
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        writes = sum(count for key, count in result['jellyfin_writes'].items() if key != 'image_bytes')
+        print(f"{result['script']:<12} {result['items']:>7} {result['wall_time']:>8.2f} {result['plex_requests']:>9} "
+              f"{result['jellyfin_requests']:>8} {result['jellyfin_errors']:>7} {writes:>8} "
+              f"{result['peak_rss_mb']:>8.1f} {result['exit_code']:>5}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the migration scripts against mock servers")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000],
+                        help="Library sizes to generate, in Plex items (default: 1000)")
+    parser.add_argument('--scripts', choices=list(SCRIPTS.keys()), nargs='+', default=list(SCRIPTS.keys()),
+                        help="Which scripts to run (default: all)")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Milliseconds added to every Jellyfin request (default: 0)")
+    parser.add_argument('--plex-latency', type=float, default=0.0,
+                        help="Milliseconds added to every Plex request (default: 0)")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Fraction of Jellyfin requests answered with 503 (default: 0)")
+    parser.add_argument('--plex-error-rate', type=float, default=0.0,
+                        help="Fraction of Plex requests answered with 503 (default: 0)")
+    parser.add_argument('--users', type=int, default=3, help="Shared Plex users (default: 3)")
+    parser.add_argument('--playlists', type=int, default=5, help="Playlists per user (default: 5)")
+    parser.add_argument('--playlist-size', type=int, default=100, help="Items per playlist (default: 100)")
+    parser.add_argument('--rated', type=float, default=0.1, help="Fraction of items each user rated (default: 0.1)")
+    parser.add_argument('--watched', type=float, default=0.2,
+                        help="Fraction of items each user watched (default: 0.2)")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for the generated library (default: 0)")
+    parser.add_argument('--json', type=str, required=False, help="Also write the results to this JSON file")
+    parser.add_argument('--keep', action='store_true', help="Keep each run's output log and print its path")
+    parser.add_argument('script_args', nargs=argparse.REMAINDER,
+                        help="Anything after -- is passed on to every script")
+    args = parser.parse_args()
+    extra_args = [arg for arg in args.script_args if arg != '--']
+
+    results = []
+    for size in args.sizes:
+        print(f"Generating a {size} item library...")
+        library = Library(size=size, users=args.users, playlists=args.playlists, playlist_size=args.playlist_size,
+                          rated=args.rated, watched=args.watched, seed=args.seed)
+        plex = MockPlex(library=library, latency=args.plex_latency / 1000, error_rate=args.plex_error_rate,
+                        seed=args.seed).start()
+        jellyfin = MockJellyfin(library=library, latency=args.latency / 1000, error_rate=args.error_rate,
+                                seed=args.seed).start()
+        try:
+            for name in args.scripts:
+                print(f"Running {name} against {len(library.items)} items...")
+                result = run_script(name=name, plex=plex, jellyfin=jellyfin, extra_args=extra_args, keep=args.keep)
+                result['items'] = len(library.items)
+                results.append(result)
+                if result['log']:
+                    print(f"    output: {result['log']}")
+        finally:
+            plex.stop()
+            jellyfin.stop()
+
+    print()
+    print_results(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'created_at': time.time(), 'settings': vars(args), 'results': results}, f, indent=2)
+        print(f"Wrote results to {args.json}")
+
+
+if __name__ == '__main__':
+    main()
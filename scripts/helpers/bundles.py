@@ -0,0 +1,69 @@
+import hashlib
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Plex stores each item's bundle at <Metadata folder>/<first hex digit of sha1(guid)>/<remaining digits>.bundle
+HASH_PREFIXES = '0123456789abcdef'
+
+# Contents/_stored sub-folder --> image type
+IMAGE_FOLDERS = {
+    'posters': 'poster',
+    'art': 'backdrop',
+}
+
+
+def guid_hash(guid):
+    return hashlib.sha1(guid.encode()).hexdigest()
+
+
+def _newest_file(folder):
+    # a bundle can hold several candidates; the most recently written one is the one Plex last picked
+    try:
+        with os.scandir(folder) as entries:
+            files = [entry for entry in entries if entry.is_file()]
+    except OSError:
+        return None
+    if not files:
+        return None
+    return max(files, key=lambda entry: entry.stat().st_mtime).path
+
+
+class BundleIndex:
+    # guid hash --> {image type: file} for every bundle under one Plex Metadata folder (Movies, TV Shows, ...).
+    # The tree is scanned once, one worker per hash prefix, so resolving an item's images is a dict lookup.
+    def __init__(self, root, workers=len(HASH_PREFIXES)):
+        self.root = root
+        self.workers = workers
+        self.images = {}
+
+    def build(self):
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for images in executor.map(self._scan_prefix, HASH_PREFIXES):
+                self.images.update(images)
+        return self
+
+    def _scan_prefix(self, prefix):
+        images = {}
+        try:
+            with os.scandir(os.path.join(self.root, prefix)) as entries:
+                bundles = [entry for entry in entries if entry.name.endswith('.bundle') and entry.is_dir()]
+        except OSError:
+            return images
+        for bundle in bundles:
+            stored = os.path.join(bundle.path, 'Contents', '_stored')
+            found = {}
+            for folder, image_type in IMAGE_FOLDERS.items():
+                file = _newest_file(os.path.join(stored, folder))
+                if file:
+                    found[image_type] = file
+            if found:
+                images[prefix + bundle.name[:-len('.bundle')]] = found
+        return images
+
+    def get(self, guid, image_type):
+        if not guid:
+            return None
+        return self.images.get(guid_hash(guid), {}).get(image_type)
+
+    def __len__(self):
+        return len(self.images)
@@ -0,0 +1,50 @@
+import threading
+
+import helpers.jellyfin as jf
+
+
+class Clients:
+    # Plex and Jellyfin connections, created on first use and then shared by every migration run in the process,
+    # so running several migrations reuses the sessions, token, library index and match cache.
+    def __init__(self, settings):
+        self.settings = settings
+        self._lock = threading.Lock()
+        self._clients = {}
+
+    def _get(self, name, make):
+        with self._lock:
+            if name not in self._clients:
+                self._clients[name] = make()
+            return self._clients[name]
+
+    @property
+    def plex(self):
+        def make():
+            import helpers.plex as px  # plexapi is only imported when a migration reads from Plex
+            self.settings.require('PLEX_URL', 'PLEX_TOKEN', 'PLEX_SERVER_NAME')
+            return px.Plex(url=self.settings.PLEX_URL,
+                           token=self.settings.PLEX_TOKEN,
+                           server_name=self.settings.PLEX_SERVER_NAME)
+        return self._get('plex', make)
+
+    def _jellyfin(self, prefix):
+        url, api_key, username, password = (f'{prefix}URL', f'{prefix}API_KEY', f'{prefix}ADMIN_USERNAME',
+                                            f'{prefix}ADMIN_PASSWORD')
+        self.settings.require(url, api_key, username, password)
+        return jf.Jellyfin(url=getattr(self.settings, url),
+                           api_key=getattr(self.settings, api_key),
+                           username=getattr(self.settings, username),
+                           password=getattr(self.settings, password),
+                           default_policy=self.settings.JELLYFIN_USER_POLICY)
+
+    @property
+    def jellyfin(self):
+        return self._get('jellyfin', lambda: self._jellyfin('JELLYFIN_'))
+
+    @property
+    def jellyfin_source(self):
+        return self._get('jellyfin_source', lambda: self._jellyfin('JF_SRC_'))
+
+    @property
+    def jellyfin_dest(self):
+        return self._get('jellyfin_dest', lambda: self._jellyfin('JF_DEST_'))
@@ -0,0 +1,74 @@
+import json
+import os
+import runpy
+
+# the settings in creds.py.blank; the JF_SRC_*/JF_DEST_* ones are only needed for jf-to-jf
+SETTINGS = [
+    'PLEX_URL', 'PLEX_TOKEN', 'PLEX_SERVER_NAME',
+    'JELLYFIN_URL', 'JELLYFIN_API_KEY', 'JELLYFIN_ADMIN_USERNAME', 'JELLYFIN_ADMIN_PASSWORD', 'JELLYFIN_USER_POLICY',
+    'JF_SRC_URL', 'JF_SRC_API_KEY', 'JF_SRC_ADMIN_USERNAME', 'JF_SRC_ADMIN_PASSWORD',
+    'JF_DEST_URL', 'JF_DEST_API_KEY', 'JF_DEST_ADMIN_USERNAME', 'JF_DEST_ADMIN_PASSWORD',
+]
+
+# settings given as JSON when they come from the environment
+JSON_SETTINGS = {'JELLYFIN_USER_POLICY'}
+
+CONFIG_ENV = 'PLEX2JELLYFIN_CONFIG'
+CONFIG_FILE = 'creds.py'
+
+
+class Settings:
+    def __init__(self, values, file=None):
+        self.file = file
+        for name in SETTINGS:
+            setattr(self, name, values.get(name, {} if name in JSON_SETTINGS else ''))
+
+    def require(self, *names):
+        missing = [name for name in names if not getattr(self, name)]
+        if missing:
+            source = self.file or 'the environment'
+            print(f"Missing {', '.join(missing)}: set them in {source} or as environment variables")
+            exit(1)
+
+
+def find_config_file(file=None):
+    # an explicit file, then $PLEX2JELLYFIN_CONFIG, then creds.py in the working directory or next to the scripts
+    file = file or os.environ.get(CONFIG_ENV)
+    if file:
+        if not os.path.exists(file):
+            print(f"Config file {file} does not exist")
+            exit(1)
+        return file
+    scripts_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for folder in [os.getcwd(), scripts_dir]:
+        candidate = os.path.join(folder, CONFIG_FILE)
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def load_settings(file=None):
+    # values from the config file, overridden by environment variables of the same name
+    file = find_config_file(file)
+    values = {}
+    if file:
+        values.update({name: value for name, value in runpy.run_path(file).items() if name in SETTINGS})
+    for name in SETTINGS:
+        if name not in os.environ:
+            continue
+        value = os.environ[name]
+        if name in JSON_SETTINGS:
+            try:
+                value = json.loads(value)
+            except ValueError as e:
+                print(f"{name} is not valid JSON: {e}")
+                exit(1)
+        values[name] = value
+    return Settings(values=values, file=file)
+
+
+def add_config_arguments(parser):
+    parser.add_argument('--config', type=str, required=False,
+                        help=f"Python file with the server settings, as in creds.py.blank (default: ${CONFIG_ENV}, or "
+                             f"{CONFIG_FILE} in the working directory or next to the scripts). Environment variables "
+                             f"with the same names override it")
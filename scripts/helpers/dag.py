@@ -0,0 +1,70 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from helpers.metrics import metrics
+
+TASK_DONE = 'done'
+TASK_FAILED = 'failed'
+TASK_SKIPPED = 'skipped'
+
+
+class _Task:
+    def __init__(self, name, func, after):
+        self.name = name
+        self.func = func
+        self.after = after
+
+
+class TaskGraph:
+    # Runs named tasks on a thread pool, each one as soon as every task it depends on has finished. Tasks can only
+    # depend on tasks added before them, so there are no cycles. When a task fails (raises, exits or returns False),
+    # everything that depends on it is skipped and the independent tasks keep running.
+    def __init__(self, workers=4):
+        self.workers = workers
+        self.tasks = {}
+
+    def add(self, name, func, after=None):
+        after = [dependency for dependency in (after or []) if dependency]
+        for dependency in after:
+            if dependency not in self.tasks:
+                raise ValueError(f"{name} depends on unknown task {dependency}")
+        self.tasks[name] = _Task(name=name, func=func, after=after)
+        return self
+
+    def _run_task(self, task):
+        start = time.perf_counter()
+        try:
+            return task.func() is not False
+        except SystemExit:
+            return False
+        except Exception as e:
+            print(f"Error in {task.name}: {e}")
+            return False
+        finally:
+            metrics.observe('task_seconds', time.perf_counter() - start, task=task.name)
+
+    def run(self):
+        # returns {task name: TASK_DONE, TASK_FAILED or TASK_SKIPPED}
+        status = {}
+        pending = dict(self.tasks)
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            while pending or running:
+                for name, task in list(pending.items()):
+                    incomplete = [dependency for dependency in task.after
+                                  if status.get(dependency) in (TASK_FAILED, TASK_SKIPPED)]
+                    if incomplete:
+                        print(f"Skipping {name}: {', '.join(incomplete)} did not complete")
+                        status[name] = TASK_SKIPPED
+                        del pending[name]
+                    elif all(status.get(dependency) == TASK_DONE for dependency in task.after):
+                        running[executor.submit(self._run_task, task)] = name
+                        del pending[name]
+                if not running:
+                    continue
+                # wake up regularly so Ctrl-C still reaches the main thread
+                done, _ = wait(list(running.keys()), timeout=0.5, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    status[name] = TASK_DONE if future.result() else TASK_FAILED
+        return status
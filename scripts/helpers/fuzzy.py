@@ -0,0 +1,132 @@
+import re
+import threading
+import unicodedata
+from collections import Counter
+
+# minimum similarity (0-1) for a fuzzy match to be accepted
+DEFAULT_THRESHOLD = 0.8
+
+# leading articles dropped before comparing, so "The Office" and "Office, The" line up. English only: in other
+# languages they are too often ordinary words, as in "Die Hard" or "La La Land"
+ARTICLES = {'the', 'a', 'an'}
+
+YEAR_SUFFIX = re.compile(r'\s*[(\[]\d{4}[)\]]\s*$')
+TRAILING_ARTICLE = re.compile(r',\s*(\w+)\s*$')
+
+# a year mismatch of more than one doesn't rule a candidate out, but costs it this much
+YEAR_PENALTY = 0.9
+
+
+def normalize(title):
+    # casefold, strip diacritics and punctuation, a "(1999)" suffix and a leading (or trailing ", The") article
+    if not title:
+        return ''
+    title = YEAR_SUFFIX.sub('', str(title))
+    title = TRAILING_ARTICLE.sub(lambda m: '' if m.group(1).casefold() in ARTICLES else m.group(0), title)
+    title = unicodedata.normalize('NFKD', title)
+    title = ''.join(c for c in title if not unicodedata.combining(c))
+    title = title.casefold().replace('&', ' and ')
+    words = re.sub(r'[^\w\s]', ' ', title).split()
+    if len(words) > 1 and words[0] in ARTICLES:
+        words = words[1:]
+    return ' '.join(words)
+
+
+def ngrams(text, n=3):
+    padded = f' {text} '
+    if len(padded) <= n:
+        return {padded}
+    return {padded[i:i + n] for i in range(len(padded) - n + 1)}
+
+
+def similarity(a, b):
+    # Dice coefficient of the two titles' trigram sets
+    a, b = ngrams(normalize(a)), ngrams(normalize(b))
+    if not a or not b:
+        return 0.0
+    return 2 * len(a & b) / (len(a) + len(b))
+
+
+class FuzzyIndex:
+    # Trigram inverted index. A query is only scored against the entries sharing at least one trigram with it,
+    # found through the posting lists, instead of being compared with every entry.
+    def __init__(self):
+        self._postings = {}
+        self._entries = []
+
+    def add(self, text, value):
+        grams = ngrams(normalize(text))
+        entry = len(self._entries)
+        self._entries.append((value, len(grams)))
+        for gram in grams:
+            self._postings.setdefault(gram, []).append(entry)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def search(self, text, threshold=DEFAULT_THRESHOLD, limit=10):
+        # [(value, score)] best first, for every entry scoring at least threshold
+        grams = ngrams(normalize(text))
+        shared = Counter()
+        for gram in grams:
+            shared.update(self._postings.get(gram, ()))
+        results = []
+        for entry, count in shared.items():
+            value, size = self._entries[entry]
+            score = 2 * count / (len(grams) + size)
+            if score >= threshold:
+                results.append((score, entry))
+        results.sort(key=lambda result: (-result[0], result[1]))
+        return [(self._entries[entry][0], score) for score, entry in results[:limit]]
+
+
+def best_match(title, candidates, key, threshold=DEFAULT_THRESHOLD, year=None, year_key=None,
+               parent_title=None, parent_key=None):
+    # rescore a short candidate list (index hits or search results) with year and parent title, best first
+    best, best_score = None, threshold
+    for candidate in candidates:
+        score = similarity(title, key(candidate))
+        if parent_title and parent_key:
+            score *= similarity(parent_title, parent_key(candidate))
+        if year and year_key:
+            candidate_year = year_key(candidate)
+            if candidate_year and abs(candidate_year - year) > 1:
+                score *= YEAR_PENALTY
+        if score >= best_score:
+            best, best_score = candidate, score
+    return best, (best_score if best else None)
+
+
+class FuzzyMatcher:
+    # one lazily built FuzzyIndex per item type, so the cost is only paid once something falls through to it.
+    # The indexes don't depend on the threshold, so callers with different thresholds can share them
+    def __init__(self, items, threshold=DEFAULT_THRESHOLD):
+        self.items = items
+        self.threshold = threshold
+        self._indexes = {}
+        self._lock = threading.Lock()
+
+    def _index(self, item_type):
+        with self._lock:
+            index = self._indexes.get(item_type)
+            if index is None:
+                index = FuzzyIndex()
+                for item in self.items():
+                    if item.type == item_type:
+                        index.add(text=item.name, value=item)
+                self._indexes[item_type] = index
+            return index
+
+    def match(self, item_type, title, year=None, parent_title=None, parent_key=None, threshold=None):
+        threshold = self.threshold if threshold is None else threshold
+        hits = self._index(item_type).search(text=title, threshold=threshold)
+        item, _ = best_match(title=title, candidates=[item for item, _ in hits], key=lambda item: item.name,
+                             threshold=threshold, year=year, year_key=lambda item: item.year,
+                             parent_title=parent_title, parent_key=parent_key)
+        return item
+
+
+def add_fuzzy_arguments(parser):
+    parser.add_argument('--fuzzy-threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help=f"How similar (0-1) a title must be to count as a fuzzy match when no ID or exact title "
+                             f"match is found. Set above 1 to turn fuzzy matching off (default: {DEFAULT_THRESHOLD})")
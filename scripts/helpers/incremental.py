@@ -0,0 +1,77 @@
+import threading
+from datetime import datetime, timedelta
+
+import helpers.journal as jnl
+
+# journal mark holding the DateCreated of the newest Jellyfin item when the last incremental run finished
+JELLYFIN_MARK = 'jellyfin:DateCreated'
+
+
+def check_jellyfin(jellyfin, journal, incremental):
+    # (whether Jellyfin gained items since the last incremental run, its newest DateCreated to save afterwards).
+    # Items that went unmatched before are only worth retrying when there is something new to match them with.
+    if not incremental:
+        return False, None
+    _, newest = jellyfin.getLibraryStats()
+    mark = journal.get_mark(JELLYFIN_MARK)
+    return mark is None or (newest or '') > mark, newest
+
+
+def save_jellyfin_mark(journal, newest):
+    if newest:
+        journal.set_mark(JELLYFIN_MARK, newest)
+
+
+class ChangeTracker:
+    # High-water marks for one migration (or one user's part of it) with --incremental. since() is the newest Plex
+    # timestamp a previous run saw for a field (lastRatedAt, lastViewedAt, updatedAt), so only items changed after it
+    # are asked for; seen() tracks the newest value in this run and save() stores it once the run has succeeded.
+    def __init__(self, journal, incremental, jellyfin_changed=False):
+        self.journal = journal
+        self.incremental = incremental
+        self.jellyfin_changed = jellyfin_changed
+        self._lock = threading.Lock()
+        self._seen = {}
+
+    @staticmethod
+    def _source(field):
+        return f'plex:{field}'
+
+    def since(self, field):
+        # None means a full run: not incremental, or no successful incremental run yet
+        mark = self.journal.get_mark(self._source(field)) if self.incremental else None
+        if mark is None:
+            return None
+        # Plex timestamps are whole seconds and the filter is "after", so step back one to keep equal ones
+        return datetime.fromtimestamp(int(mark)) - timedelta(seconds=1)
+
+    def seen(self, field, value):
+        if not self.incremental or value is None:
+            return
+        timestamp = int(value.timestamp())
+        with self._lock:
+            self._seen[field] = max(self._seen.get(field, 0), timestamp)
+
+    def retry_keys(self):
+        # journal keys an incremental run picks up on top of the changed items: the ones that failed before, and
+        # the unmatched ones once Jellyfin has new items
+        if not self.incremental:
+            return []
+        outcomes = [jnl.OUTCOME_FAILED] + ([jnl.OUTCOME_UNMATCHED] if self.jellyfin_changed else [])
+        return self.journal.keys(outcomes=outcomes)
+
+    def save(self):
+        for field, timestamp in self._seen.items():
+            mark = self.journal.get_mark(self._source(field))
+            if mark is None or timestamp > int(mark):
+                self.journal.set_mark(self._source(field), timestamp)
+
+    def scoped(self, journal):
+        # the same settings for a per-user journal, see Journal.scoped
+        return ChangeTracker(journal=journal, incremental=self.incremental, jellyfin_changed=self.jellyfin_changed)
+
+
+def retry_items(plex, changes):
+    # the Plex items behind the retry keys that are plain ratingKeys, fetched in a few requests
+    keys = [key for key in changes.retry_keys() if key.isdigit()]
+    return plex.fetch_items(rating_keys=keys) if keys else []
@@ -1,13 +1,79 @@
 import requests
+import base64
 import socket
 import json
 from urllib.parse import urlencode
-import os
+import re
+import csv
+import random
+import threading
+from collections import Counter
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib3.exceptions import ConnectTimeoutError
+import helpers.fuzzy as fuzzy
+import helpers.match_cache as match_cache
+import helpers.tokens as tokens
+from helpers.metrics import metrics, endpoint as metrics_endpoint
 import signal
 import sys
 import time
 
-token_file = '.jellyfin_token'
+# Plex item type --> Jellyfin BaseItemKind
+PLEX_TO_JELLYFIN_TYPES = {
+    'movie': 'Movie',
+    'show': 'Series',
+    'season': 'Season',
+    'episode': 'Episode',
+    'artist': 'MusicArtist',
+    'album': 'MusicAlbum',
+    'track': 'Audio',
+}
+
+ITEM_FIELDS = 'ProviderIds,DateCreated'
+
+# 100 IDs of 32 characters keeps the request URL around 3.5KB
+PLAYLIST_CHUNK_SIZE = 100
+
+# the methods urllib3 retries by default; anything else (POST) is only resent when the server never got it
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'TRACE'}
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# statuses where the server did not act on the request, so a POST can be safely resent
+RETRY_STATUS_CODES_UNSAFE = {429, 503}
+
+# migrate_posters image type --> Jellyfin ImageType
+JELLYFIN_IMAGE_TYPES = {
+    'poster': 'Primary',
+    'backdrop': 'Backdrop',
+}
+
+# base64 turns every 3 bytes into 4, so chunks that are a multiple of 3 encode independently
+UPLOAD_CHUNK_SIZE = 3 * 64 * 1024
+
+# How a Plex item was matched to its Jellyfin counterpart
+MATCH_PROVIDER_ID = 'provider_id'
+MATCH_TITLE_YEAR = 'title_year'
+MATCH_FUZZY = 'fuzzy'
+MATCH_SEARCH = 'search'
+MATCH_NONE = 'unmatched'
+
+# Plex item type --> (Plex parent title attribute, JellyfinItem parent name attribute) checked by fuzzy matches
+FUZZY_PARENTS = {
+    'episode': ('grandparentTitle', 'series_name'),
+    'album': ('parentTitle', 'album_artist'),
+    'track': ('parentTitle', 'album'),
+}
+
+# Plex guid scheme / Jellyfin ProviderIds key --> common provider name
+PROVIDER_ALIASES = {
+    'imdb': 'imdb',
+    'tmdb': 'tmdb',
+    'themoviedb': 'tmdb',
+    'tvdb': 'tvdb',
+    'thetvdb': 'tvdb',
+    'mbid': 'musicbrainz',
+    'musicbrainz': 'musicbrainz',
+}
 
 
 def signal_handler(signum, frame):
@@ -15,21 +81,342 @@ def signal_handler(signum, frame):
     exit()
 
 
-def _save_token_id(file, creds):
-    with open(file, 'w+') as f:
-        for line in creds:
-            f.write(f"{line}\n")
+def _mount_pool(session, pool_size):
+    # retries are handled in Jellyfin._request so backoff and re-authentication live in one place
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+
+def _make_session(pool_size):
+    session = requests.Session()
+    _mount_pool(session=session, pool_size=pool_size)
+    return session
+
+
+def _parse_retry_after(value):
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def _not_sent(error):
+    # the connection was never made (refused, unresolvable, connect timeout), so the server can't have acted on it.
+    # A reset or read timeout can come after the body went out.
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(error, requests.exceptions.ConnectionError) and isinstance(reason, ConnectTimeoutError)
+
+
+def _json(res):
+    if not res or not res.content:
+        return {}
+    try:
+        return res.json()
+    except ValueError:
+        return {}
+
+
+def sniff_image_type(head):
+    if head.startswith(b'\x89PNG'):
+        return 'image/png'
+    if head.startswith(b'RIFF') and head[8:12] == b'WEBP':
+        return 'image/webp'
+    if head.startswith(b'GIF8'):
+        return 'image/gif'
+    return 'image/jpeg'
+
+
+def _base64_stream(stream, chunk_size=UPLOAD_CHUNK_SIZE):
+    # Jellyfin wants uploaded images base64-encoded: encode as the image is read so it is never held in memory whole
+    try:
+        leftover = b''
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            metrics.inc('jellyfin_upload_bytes_total', len(chunk))
+            chunk = leftover + chunk
+            cut = len(chunk) - len(chunk) % 3
+            leftover = chunk[cut:]
+            if cut:
+                yield base64.b64encode(chunk[:cut])
+        if leftover:
+            yield base64.b64encode(leftover)
+    finally:
+        stream.close()
+
+
+def normalize_title(title):
+    if not title:
+        return ''
+    title = re.sub(r'[^\w\s]', ' ', str(title).casefold())
+    return ' '.join(title.split())
+
+
+def _normalize_provider(provider):
+    provider = provider.casefold()
+    if provider.startswith('musicbrainz'):
+        # MusicBrainzTrack, MusicBrainzAlbum, MusicBrainzArtist, ... all hold MBIDs
+        return 'musicbrainz'
+    return PROVIDER_ALIASES.get(provider)
+
+
+def _parse_plex_guid(guid):
+    # "imdb://tt0084787" or legacy "com.plexapp.agents.imdb://tt0084787?lang=en"
+    if not guid or '://' not in guid:
+        return None
+    scheme, value = guid.split('://', 1)
+    provider = _normalize_provider(scheme.split('.')[-1])
+    value = value.split('?')[0]
+    # legacy TV agent guids look like "thetvdb://<show id>/<season>/<episode>", not item ids
+    if not provider or not value or '/' in value:
+        return None
+    return provider, value
+
+
+def _loaded_attr(plex_item, attr):
+    # the value Plex already sent: plexapi reloads a partial item when an attribute is None or [], which would cost a
+    # request for every item without GUIDs
+    try:
+        return object.__getattribute__(plex_item, attr)
+    except AttributeError:
+        return None
+
+
+def get_plex_provider_ids(plex_item):
+    provider_ids = []
+    guids = _loaded_attr(plex_item, 'guids') or []
+    for guid in [g.id for g in guids] + [_loaded_attr(plex_item, 'guid')]:
+        parsed = _parse_plex_guid(guid)
+        if parsed and parsed not in provider_ids:
+            provider_ids.append(parsed)
+    return provider_ids
+
+
+class IncompleteListError(Exception):
+    # a page of a paged listing could not be fetched, even after retries
+    pass
 
 
 class JellyfinItem:
     def __init__(self, data):
-        self.id = data['ItemId']
-        self.name = data['Name']
+        # /Search/Hints returns "ItemId", /Items returns "Id"
+        self.id = data.get('ItemId') or data.get('Id')
+        self.name = data.get('Name')
+        self.type = data.get('Type')
+        self.year = data.get('ProductionYear')
+        self.series_name = data.get('SeriesName') or data.get('Series')
+        self.album = data.get('Album')
+        self.album_artist = data.get('AlbumArtist')
+        self.index = data.get('IndexNumber')
+        self.parent_index = data.get('ParentIndexNumber')
+        self.provider_ids = data.get('ProviderIds') or {}
+        self.date_created = data.get('DateCreated')
+
+
+class MatchStats:
+    # How one migration's Plex items were matched: a count per method and, with audit=True, one row per item for
+    # --match-report. Kept per migration because migrations running together share the library index.
+    def __init__(self, audit=False):
+        self._lock = threading.Lock()
+        self.counts = Counter()
+        self.audit = [] if audit else None
+
+    def record(self, plex_item, item, method):
+        with self._lock:
+            self.counts[method or MATCH_NONE] += 1
+            if self.audit is not None:
+                self.audit.append([getattr(plex_item, 'ratingKey', ''), getattr(plex_item, 'type', ''),
+                                   getattr(plex_item, 'title', ''), item.id if item else '',
+                                   item.name if item else '', method or MATCH_NONE])
+
+    def print_summary(self):
+        total = sum(self.counts.values())
+        print(f"Matched {total - self.counts[MATCH_NONE]} of {total} Plex items on Jellyfin:")
+        for method in [MATCH_PROVIDER_ID, MATCH_TITLE_YEAR, MATCH_FUZZY, MATCH_SEARCH, MATCH_NONE]:
+            print(f"    {method}: {self.counts[method]}")
+
+    def write_audit(self, file):
+        with self._lock:
+            rows = list(self.audit or [])
+        with open(file, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['plex_rating_key', 'plex_type', 'plex_title', 'jellyfin_id', 'jellyfin_name', 'method'])
+            writer.writerows(rows)
+        print(f"Wrote match report for {len(rows)} items to {file}")
+
+
+class JellyfinLibraryIndex:
+    def __init__(self, jellyfin, item_types=None, page_size=1000):
+        self.jellyfin = jellyfin
+        self.fuzzy = None
+        self.item_types = item_types or list(PLEX_TO_JELLYFIN_TYPES.values())
+        self.page_size = page_size
+        self.items = {}
+        self._by_title = {}
+        self._seasons = {}
+        self._episodes = {}
+        self._by_provider_id = {}
+        self._build_lock = threading.Lock()
+        self.built = False
+        # False when a page failed to load: items missing from the index may still exist on Jellyfin
+        self.complete = True
+
+    def build(self):
+        with metrics.phase('jellyfin_index'):
+            return self._build()
+
+    def _build(self):
+        print("Indexing Jellyfin library...")
+        self.items = {}
+        self._by_title = {}
+        self._seasons = {}
+        self._episodes = {}
+        self._by_provider_id = {}
+        self.fuzzy = fuzzy.FuzzyMatcher(items=lambda: list(self.items.values()))
+        self.complete = True
+        item_types = [t for t in self.item_types if t != 'MusicArtist']
+        try:
+            if item_types:
+                for item in self.jellyfin.iterItems(item_types=item_types, page_size=self.page_size):
+                    self.add(item)
+            if 'MusicArtist' in self.item_types:
+                for item in self.jellyfin.iterArtists(page_size=self.page_size):
+                    self.add(item)
+        except IncompleteListError as e:
+            self.complete = False
+            print(f"Warning: {e}. Items on the missing pages will not be matched, and misses are not cached.")
+        print(f"Indexed {len(self.items)} Jellyfin items.")
+        self.built = True
+        return self
+
+    def covers(self, item_types, page_size):
+        return (set(item_types or PLEX_TO_JELLYFIN_TYPES.values()) <= set(self.item_types)
+                and page_size == self.page_size)
+
+    def ensure_built(self):
+        with self._build_lock:
+            if not self.built:
+                self.build()
+        return self
+
+    def add(self, item):
+        if not item.id:
+            return
+        self.items[item.id] = item
+        self._by_title.setdefault((item.type, normalize_title(item.name)), []).append(item)
+        self._add_provider_ids(item)
+        if item.type == 'Season' and item.index is not None:
+            self._seasons[(normalize_title(item.series_name), item.index)] = item
+        elif item.type == 'Episode' and item.index is not None and item.parent_index is not None:
+            self._episodes[(normalize_title(item.series_name), item.parent_index, item.index)] = item
+
+    def get(self, item_id):
+        return self.items.get(item_id)
+
+    def __len__(self):
+        return len(self.items)
+
+    def _add_provider_ids(self, item):
+        for provider, value in item.provider_ids.items():
+            provider = _normalize_provider(provider)
+            if provider and value:
+                self._by_provider_id[(item.type, provider, str(value).casefold())] = item.id
+
+    def find_by_provider_ids(self, item_type, provider_ids):
+        for provider, value in provider_ids:
+            item_id = self._by_provider_id.get((item_type, provider, value.casefold()))
+            if item_id:
+                return self.items.get(item_id)
+        return None
+
+    def find(self, item_type, title, year=None, parent_title=None, grandparent_title=None):
+        item, _ = self.match_title(item_type=item_type, title=title, year=year, parent_title=parent_title,
+                                   grandparent_title=grandparent_title)
+        return item
+
+    def match_title(self, item_type, title, year=None, parent_title=None, grandparent_title=None):
+        # every given year and parent title has to agree: a remake or a same-named episode of another show is not a
+        # title match, and is left to the fuzzy stage
+        candidates = self._by_title.get((item_type, normalize_title(title)), [])
+        if year:
+            candidates = [c for c in candidates if not c.year or abs(c.year - year) <= 1]
+        if parent_title:
+            parent_title = normalize_title(parent_title)
+            candidates = [c for c in candidates if normalize_title(c.album or c.series_name) == parent_title]
+        if grandparent_title:
+            grandparent_title = normalize_title(grandparent_title)
+            candidates = [c for c in candidates
+                          if normalize_title(c.album_artist or c.series_name) == grandparent_title]
+        if not candidates:
+            return None, None
+        return candidates[0], MATCH_TITLE_YEAR
+
+    def _match_plex_title(self, plex_item, plex_type, item_type):
+        if plex_type == 'season':
+            item = self._seasons.get((normalize_title(plex_item.parentTitle), plex_item.index))
+            return item, (MATCH_TITLE_YEAR if item else None)
+        if plex_type == 'episode':
+            item = self._episodes.get(
+                (normalize_title(plex_item.grandparentTitle), plex_item.parentIndex, plex_item.index))
+            if item:
+                return item, MATCH_TITLE_YEAR
+            return self.match_title(item_type=item_type, title=plex_item.title,
+                                    parent_title=plex_item.grandparentTitle)
+        if plex_type == 'album':
+            return self.match_title(item_type=item_type, title=plex_item.title, year=getattr(plex_item, 'year', None),
+                                    grandparent_title=plex_item.parentTitle)
+        if plex_type == 'track':
+            return self.match_title(item_type=item_type, title=plex_item.title, parent_title=plex_item.parentTitle,
+                                    grandparent_title=plex_item.grandparentTitle)
+        return self.match_title(item_type=item_type, title=plex_item.title, year=getattr(plex_item, 'year', None))
+
+    def _match_plex_fuzzy(self, plex_item, plex_type, item_type, threshold):
+        # last resort before giving up: seasons are only ever matched by series and number
+        if threshold > 1 or plex_type == 'season':
+            return None
+        parent_title, parent_key = None, None
+        if plex_type in FUZZY_PARENTS:
+            plex_attr, jellyfin_attr = FUZZY_PARENTS[plex_type]
+            parent_title = getattr(plex_item, plex_attr, None)
+            parent_key = lambda item: getattr(item, jellyfin_attr) or ''
+        return self.fuzzy.match(item_type=item_type, title=plex_item.title, year=getattr(plex_item, 'year', None),
+                                parent_title=parent_title, parent_key=parent_key, threshold=threshold)
+
+    def match_plex_item(self, plex_item, fuzzy_threshold=fuzzy.DEFAULT_THRESHOLD):
+        plex_type = getattr(plex_item, 'type', None)
+        item_type = PLEX_TO_JELLYFIN_TYPES.get(plex_type)
+        item, method = None, None
+        if item_type:
+            item = self.find_by_provider_ids(item_type=item_type, provider_ids=get_plex_provider_ids(plex_item))
+            if item:
+                method = MATCH_PROVIDER_ID
+            else:
+                item, method = self._match_plex_title(plex_item=plex_item, plex_type=plex_type, item_type=item_type)
+            if not item:
+                item = self._match_plex_fuzzy(plex_item=plex_item, plex_type=plex_type, item_type=item_type,
+                                              threshold=fuzzy_threshold)
+                method = MATCH_FUZZY if item else None
+        return item, method
+
+    def find_plex_item(self, plex_item):
+        item, _ = self.match_plex_item(plex_item)
+        return item
 
 
 class JellyfinPlaylist:
     def __init__(self, data):
         self.id = data['Id']
+        self.name = data.get('Name')
 
 
 class JellyfinUser:
@@ -39,133 +426,162 @@ class JellyfinUser:
 
 
 class Jellyfin:
-    def __init__(self, url, api_key, username, password, default_policy):
+    def __init__(self, url, api_key, username, password, default_policy, pool_size=10, timeout=(10, 60),
+                 max_retries=5, backoff_factor=0.5, backoff_max=30):
         self.url = url
         self.key = api_key
         self.username = username
         self.password = password
-        self.user_id = None
         self.policy = default_policy
-        self.token_header = None
+        self.library_index = None
+        self._index_lock = threading.Lock()
+        # one MatchCache per file, shared by the migrations that use it
+        self.match_caches = {}
+        self._match_caches_lock = threading.Lock()
+        self._legacy_user_data = False
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.pool_size = pool_size
+        self.session = _make_session(pool_size=pool_size)
+        self.tokens = tokens.TokenManager(file=tokens.token_file_for(url=url, username=username), login=self._login,
+                                          check=self._check_token)
         self.authenticate(force_new_auth=False)
-        signal.signal(signal.SIGINT, signal.default_int_handler)
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGINT, signal.default_int_handler)
 
-    def authenticate(self, force_new_auth=False):
-        if force_new_auth or not self._load_token_id(token_file):
-            print("Authenticating with Jellfin...")
-            xEmbyAuth = {
-                'X-Emby-Authorization': 'Emby UserId="{UserId}", Client="{Client}", Device="{Device}", '
-                                        'DeviceId="{DeviceId}", Version="{Version}", Token="""'.format(
-                    UserId="",  # not required, if it was we would have to first request the UserId from the username
-                    Client='account-automation',
-                    Device=socket.gethostname(),
-                    DeviceId=hash(socket.gethostname()),
-                    Version=1,
-                    Token=""  # not required
-                )}
-            data = {'Username': self.username, 'Password': self.password,
-                    'Pw': self.password}
-            try:
-                res = self._post_request_with_token(hdr=xEmbyAuth, cmd='/Users/AuthenticateByName', data=data).json()
-                self.token_header = {'X-Emby-Token': '{}'.format(res['AccessToken'])}
-                self.user_id = res['User']['Id']
-                _save_token_id(file=token_file, creds=[res['AccessToken'], res['User']['Id']])
-            except Exception as e:
-                print('Could not log into Jellyfin.\n{}'.format(e))
-
-    def _load_token_id(self, file):
-        if os.path.exists(file):
-            with open(file, 'r') as f:
-                lines = f.readlines()
-                self.token_header = {'X-Emby-Token': f'{lines[0].rstrip()}'}
-                self.user_id = lines[1].rstrip()
-            return True
-        return False
+    @property
+    def user_id(self):
+        return self.tokens.user_id
 
-    def _get_request(self, cmd, params=None, retried=False):
-        try:
-            res = requests.get(f'{self.url}{cmd}?api_key={self.key}{("&" + params if params else "")}')
-            if res:
-                return res.json()
-            return {}
-        except:
-            if retried:
-                return {}
-            self.authenticate(force_new_auth=True)
-        return self._get_request(cmd=cmd, params=params, retried=True)
-
-    def _get_request_with_token(self, hdr, cmd, data=None, retried=False):
-        try:
-            hdr = {'accept': 'application/json', **hdr}
-            res = requests.get(f'{self.url}{cmd}', headers=hdr, data=(json.dumps(data) if data else None))
-            if res:
-                return res.json()
-            return {}
-        except:
-            if retried:
-                return {}
-            self.authenticate(force_new_auth=True)
-        return self._get_request_with_token(hdr=hdr, cmd=cmd, data=data, retried=True)
-
-    def _post_request(self, cmd, params=None, payload=None, retried=False):
+    def authenticate(self, force_new_auth=False):
+        if force_new_auth:
+            return self.tokens.on_unauthorized(generation=self.tokens.generation)
+        return self.tokens.start()
+
+    def _login(self):
+        print("Authenticating with Jellfin...")
+        xEmbyAuth = {
+            'X-Emby-Authorization': 'Emby UserId="{UserId}", Client="{Client}", Device="{Device}", '
+                                    'DeviceId="{DeviceId}", Version="{Version}", Token="""'.format(
+                UserId="",  # not required, if it was we would have to first request the UserId from the username
+                Client='account-automation',
+                Device=socket.gethostname(),
+                DeviceId=hash(socket.gethostname()),
+                Version=1,
+                Token=""  # not required
+            )}
+        data = {'Username': self.username, 'Password': self.password,
+                'Pw': self.password}
         try:
-            res = requests.post(
-                f'{self.url}{cmd}?api_key={self.key}{("&" + params if params is not None else "")}',
-                json=payload,
-                headers={'accept': 'application/json', 'Content-Type': 'application/json'}
-            )
-
-            if res:
-                return res
+            res = self._post_request_with_token(hdr=xEmbyAuth, cmd='/Users/AuthenticateByName', data=data)
+            res.raise_for_status()
+            res = res.json()
+            return res['AccessToken'], res['User']['Id']
+        except Exception as e:
+            print('Could not log into Jellyfin.\n{}'.format(e))
             return None
-        except:
-            if retried:
-                return None
-            self.authenticate(force_new_auth=True)
-        return self._post_request(cmd=cmd, params=params, payload=payload, retried=True)
 
-    def _post_request_json(self, cmd, payload=None, retried=False):
-        try:
-            res = requests.post(
-                f'{self.url}{cmd}?api_key={self.key}',
-                json=payload,
-                headers={'accept': 'application/json', 'Content-Type': 'application/json'}
-            )
+    def _check_token(self, token):
+        res = self._request('GET', cmd='/Users/Me', hdr={'X-Emby-Token': token})
+        if res is None:
+            return tokens.TOKEN_UNKNOWN
+        if res.status_code in (401, 403):
+            return tokens.TOKEN_INVALID
+        return tokens.TOKEN_VALID if res.ok else tokens.TOKEN_UNKNOWN
+
+    def setPoolSize(self, pool_size):
+        if pool_size != self.pool_size:
+            self.pool_size = pool_size
+            _mount_pool(session=self.session, pool_size=pool_size)
+
+    def _backoff(self, attempt, retry_after=None):
+        # exponential backoff with full jitter, never sooner than the server's Retry-After
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_factor * (2 ** attempt)))
+        wait = _parse_retry_after(retry_after)
+        if wait is not None:
+            delay = max(delay, min(wait, self.backoff_max))
+        return delay
+
+    def _request(self, method, cmd, params=None, hdr=None, payload=None, data=None, api_key=False):
+        # Transport errors and retryable statuses are retried with backoff and never touch the token; a 401 or 403
+        # on a token-authenticated request goes to the token manager, which logs in again at most once per
+        # expired token. Returns None if the server could not be reached.
+        # data may be a callable returning a fresh body for each attempt, for streamed bodies that can't be resent.
+        query = []
+        if api_key:
+            query.append(f'api_key={self.key}')
+        if params:
+            query.append(params)
+        url = f'{self.url}{cmd}'
+        if query:
+            url += ('&' if '?' in cmd else '?') + '&'.join(query)
+        retry_statuses = RETRY_STATUS_CODES if method in IDEMPOTENT_METHODS else RETRY_STATUS_CODES_UNSAFE
+        use_token = hdr is None and not api_key
+        route = metrics_endpoint(cmd)
+        reauthenticated = False
+        attempt = 0
+        while True:
+            headers = {'accept': 'application/json'}
+            if payload is not None:
+                headers['Content-Type'] = 'application/json'
+            if use_token:
+                generation = self.tokens.generation
+                headers.update(self.tokens.header())
+            headers.update(hdr or {})
+            start = time.perf_counter()
+            try:
+                res = self.session.request(method, url, headers=headers, json=payload,
+                                           data=(data() if callable(data) else data), timeout=self.timeout)
+            except requests.exceptions.RequestException as e:
+                metrics.inc('jellyfin_requests_total', method=method, endpoint=route, status='error')
+                retryable = isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout))
+                if method not in IDEMPOTENT_METHODS:
+                    # playlist adds, user creation and user data writes aren't idempotent, so a POST that may have
+                    # reached the server is not sent again
+                    retryable = _not_sent(e)
+                if not retryable or attempt >= self.max_retries:
+                    print(f"Network error: {e}")
+                    return None
+                metrics.inc('jellyfin_retries_total', method=method, endpoint=route, reason=type(e).__name__)
+                time.sleep(self._backoff(attempt))
+                attempt += 1
+                continue
+            metrics.observe('jellyfin_request_seconds', time.perf_counter() - start, method=method, endpoint=route)
+            metrics.inc('jellyfin_requests_total', method=method, endpoint=route, status=res.status_code)
+            if res.status_code in (401, 403) and use_token and not reauthenticated:
+                reauthenticated = True
+                if res.status_code == 401:
+                    renewed = self.tokens.on_unauthorized(generation=generation)
+                else:
+                    renewed = self.tokens.on_forbidden(generation=generation)
+                if renewed:
+                    continue
+            if res.status_code in retry_statuses and attempt < self.max_retries:
+                metrics.inc('jellyfin_retries_total', method=method, endpoint=route, reason=res.status_code)
+                time.sleep(self._backoff(attempt, retry_after=res.headers.get('Retry-After')))
+                attempt += 1
+                continue
+            return res
 
-            if res:
-                return res
-            return None
-        except:
-            if retried:
-                return None
-            self.authenticate(force_new_auth=True)
-        return self._post_request_json(cmd=cmd, payload=payload, retried=True)
+    def _get_request(self, cmd, params=None):
+        return _json(self._request('GET', cmd=cmd, params=params, api_key=True))
 
-    def _post_request_with_token(self, hdr, cmd, data=None, retried=False):
-        try:
-            hdr = {'accept': 'application/json', 'Content-Type': 'application/json', **hdr}
-            res = requests.post(f'{self.url}{cmd}', headers=hdr, json=data)
-            if res.status_code == 401 and not retried:
-                self.authenticate(force_new_auth=True)
-                return self._post_request_with_token(hdr=self.token_header, cmd=cmd, data=data, retried=True)
-            return res
+    def _get_request_with_token(self, cmd, hdr=None, data=None):
+        return _json(self._request('GET', cmd=cmd, hdr=hdr, data=(json.dumps(data) if data else None)))
 
-        except requests.exceptions.RequestException as e:
-            print(f"Network error: {e}")
-            return None
+    def _post_request(self, cmd, params=None, payload=None):
+        return self._request('POST', cmd=cmd, params=params, payload=payload, api_key=True)
 
-    def _delete_request(self, cmd, params=None, retried=False):
-        try:
-            res = requests.delete(
-                f'{self.url}{cmd}?api_key={self.key}{("&" + params if params is not None else "")}')
-            if res:
-                return res.json()
-            return {}
-        except:
-            if retried:
-                return {}
-            self.authenticate(force_new_auth=True)
-        return self._delete_request(cmd=cmd, params=params, retried=True)
+    def _post_request_json(self, cmd, payload=None):
+        return self._request('POST', cmd=cmd, payload=payload, api_key=True)
+
+    def _post_request_with_token(self, cmd, hdr=None, data=None):
+        return self._request('POST', cmd=cmd, hdr=hdr, payload=data)
+
+    def _delete_request(self, cmd, params=None):
+        return _json(self._request('DELETE', cmd=cmd, params=params, api_key=True))
 
     def makeUser(self, username):
         cmd = '/Users/New'
@@ -175,6 +591,8 @@ class Jellyfin:
         res = self._post_request(cmd=cmd, params=None, payload=data)
         if res:
             return JellyfinUser(data=res.json()), None
+        if res is None:
+            return None, "Could not reach Jellyfin"
         return None, res.content.decode("utf-8")
 
     def deleteUser(self, userId):
@@ -187,9 +605,9 @@ class Jellyfin:
             'Id': str(userId),
             'ResetPassword': True
         }
-        res = self._post_request_with_token(hdr=self.token_header, cmd=cmd, data=data)
+        res = self._post_request_with_token(cmd=cmd, data=data)
 
-        if res.status_code == 204:
+        if res is not None and res.status_code == 204:
             return True
         return False
 
@@ -200,8 +618,8 @@ class Jellyfin:
             'CurrentPw': currentPass,
             'NewPw': newPass
         }
-        res = self._post_request_with_token(hdr=self.token_header, cmd=cmd, data=data)
-        if res.status_code == 204:
+        res = self._post_request_with_token(cmd=cmd, data=data)
+        if res is not None and res.status_code == 204:
             return True
         return False
 
@@ -209,15 +627,15 @@ class Jellyfin:
         if not policy:
             policy = self.policy
         cmd = f'/Users/{userId}/Policy'
-        res = self._post_request_with_token(hdr=self.token_header, cmd=cmd, data=policy)
+        res = self._post_request_with_token(cmd=cmd, data=policy)
 
-        if res.status_code == 204:
+        if res is not None and res.status_code == 204:
             return True
         return False
 
     def search(self, keyword):
         cmd = f'/Search/Hints?{urlencode({"SearchTerm": keyword})}'
-        res = self._get_request_with_token(hdr=self.token_header, cmd=cmd)
+        res = self._get_request_with_token(cmd=cmd)
         if not res:
             return []
         res = res['SearchHints']
@@ -226,9 +644,133 @@ class Jellyfin:
             items.append(JellyfinItem(data=item))
         return items
 
+    def getItems(self, item_types=None, start_index=0, limit=None, fields=ITEM_FIELDS):
+        params = {
+            'Recursive': 'true',
+            'StartIndex': start_index,
+            'EnableImages': 'false',
+            'EnableUserData': 'false',
+            'EnableTotalRecordCount': 'true',
+        }
+        if item_types:
+            params['IncludeItemTypes'] = ','.join(item_types)
+        if limit:
+            params['Limit'] = limit
+        if fields:
+            params['Fields'] = fields
+        cmd = f'/Users/{self.user_id}/Items?{urlencode(params)}'
+        return self._get_request_with_token(cmd=cmd)
+
+    def getArtists(self, start_index=0, limit=None, fields=ITEM_FIELDS):
+        params = {
+            'UserId': self.user_id,
+            'StartIndex': start_index,
+            'EnableImages': 'false',
+            'EnableUserData': 'false',
+            'EnableTotalRecordCount': 'true',
+        }
+        if limit:
+            params['Limit'] = limit
+        if fields:
+            params['Fields'] = fields
+        cmd = f'/Artists?{urlencode(params)}'
+        return self._get_request_with_token(cmd=cmd)
+
+    def _iter_pages(self, fetch, page_size, **kwargs):
+        start_index = 0
+        while True:
+            res = fetch(start_index=start_index, limit=page_size, **kwargs)
+            if not res:
+                # _json() returns {} for a request that failed after every retry
+                raise IncompleteListError(f"Could not fetch Jellyfin items from {start_index} on")
+            page = res.get('Items', [])
+            for data in page:
+                yield JellyfinItem(data=data)
+            start_index += len(page)
+            if not page or len(page) < page_size or start_index >= res.get('TotalRecordCount', 0):
+                break
+
+    def iterItems(self, item_types=None, page_size=1000):
+        return self._iter_pages(fetch=self.getItems, page_size=page_size, item_types=item_types)
+
+    def iterArtists(self, page_size=1000):
+        return self._iter_pages(fetch=self.getArtists, page_size=page_size)
+
+    def buildLibraryIndex(self, plex_types=None, page_size=1000, lazy=False):
+        # with lazy=True the library is only pulled on the first match cache miss
+        item_types = None
+        if plex_types:
+            item_types = [PLEX_TO_JELLYFIN_TYPES[t] for t in plex_types if t in PLEX_TO_JELLYFIN_TYPES]
+        with self._index_lock:
+            index = self.library_index
+            if index is None or not index.covers(item_types=item_types, page_size=page_size):
+                if index is not None and item_types:
+                    # keep the item types of the migrations already matching against the index it replaces
+                    item_types = sorted(set(item_types) | set(index.item_types))
+                index = self.library_index = JellyfinLibraryIndex(jellyfin=self, item_types=item_types,
+                                                                  page_size=page_size)
+        # built once, by whichever migration gets here first
+        if not lazy:
+            index.ensure_built()
+        return index
+
+    def getLibraryStats(self):
+        # (number of items, DateCreated of the newest one) in a single one-item request
+        params = {
+            'Recursive': 'true',
+            'SortBy': 'DateCreated',
+            'SortOrder': 'Descending',
+            'Limit': 1,
+            'Fields': 'DateCreated',
+            'EnableImages': 'false',
+            'EnableUserData': 'false',
+            'EnableTotalRecordCount': 'true',
+        }
+        res = self._get_request_with_token(cmd=f'/Users/{self.user_id}/Items?{urlencode(params)}')
+        items = res.get('Items', []) if res else []
+        newest = items[0].get('DateCreated') if items else ''
+        return (res.get('TotalRecordCount', 0) if res else 0), newest
+
+    def getLibraryEtag(self):
+        # changes whenever items are added to or removed from the library
+        total, newest = self.getLibraryStats()
+        return f"{total}:{newest}"
+
+    def openMatchCache(self, file=match_cache.cache_file, lru_size=10000):
+        with self._match_caches_lock:
+            cache = self.match_caches.get(file)
+            if cache is None:
+                cache = self.match_caches[file] = match_cache.MatchCache(file=file, lru_size=lru_size)
+                cache.validate(library_etag=self.getLibraryEtag())
+            return cache
+
+    def _find_cached_item(self, plex_item, cache):
+        # (found in the cache, Jellyfin item or None for a cached miss, match method)
+        cached = cache.get(plex_item)
+        metrics.inc('match_cache_lookups_total', result='miss' if cached is None else 'hit')
+        if cached is None:
+            return False, None, None
+        item_id, name, method = cached
+        if not item_id:
+            return True, None, None
+        item = None
+        library_index = self.library_index
+        if library_index is not None:
+            if cache.verify_hits:
+                library_index.ensure_built()
+            if library_index.built:
+                item = library_index.get(item_id)
+                if not item and library_index.complete:
+                    # removed from Jellyfin since it was cached
+                    cache.discard(plex_item)
+                    return False, None, None
+        if not item:
+            item = JellyfinItem(data={'Id': item_id, 'Name': name})
+        return True, item, method
+
     def getLibraries(self):
         cmd = f'/Users/{self.user_id}/Items'
-        return self._get_request_with_token(hdr=self.token_header, cmd=cmd)
+        return self._get_request_with_token(cmd=cmd)
 
     def getUsers(self):
         cmd = '/Users'
@@ -238,43 +780,136 @@ class Jellyfin:
             users.append(JellyfinUser(data=user))
         return users
 
-    def updateRating(self, itemId, upvote):
-        cmd = f'/Users/{self.user_id}/Items/{itemId}/Rating?Likes={upvote}'
-        res = self._post_request_with_token(hdr=self.token_header, cmd=cmd)
+    def updateRating(self, itemId, upvote, userId=None):
+        cmd = f'/Users/{userId or self.user_id}/Items/{itemId}/Rating?Likes={upvote}'
+        res = self._post_request_with_token(cmd=cmd)
         if res:
             return True
         return False
 
-    def getPlaylist(self, name):
-        cmd = f'/Playlists'
+    def updateUserData(self, itemId, data, userId=None):
+        # data is a (partial) UserItemDataDto, e.g. {"Rating": 8.0, "Likes": True}
+        userId = userId or self.user_id
+        res = None
+        if not self._legacy_user_data:
+            res = self._post_request_with_token(cmd=f'/UserItems/{itemId}/UserData?userId={userId}', data=data)
+            if res is not None and res.status_code == 404:
+                # servers older than 10.9 only have the per-user route
+                self._legacy_user_data = True
+        if self._legacy_user_data:
+            res = self._post_request_with_token(cmd=f'/Users/{userId}/Items/{itemId}/UserData', data=data)
+        if res:
+            return True
+        return False
+
+    def uploadImage(self, itemId, imageType, open_image):
+        # open_image() returns (binary stream, content type); a streamed body can't be resent, so every retry
+        # opens the image again
+        stream, content_type = open_image()
+        unused = [stream]
+
+        def body():
+            return _base64_stream(unused.pop() if unused else open_image()[0])
+
+        cmd = f'/Items/{itemId}/Images/{imageType}'
+        res = self._request('POST', cmd=cmd, hdr={'Content-Type': content_type}, data=body, api_key=True)
+        for stream in unused:
+            stream.close()
+        return bool(res)
+
+    def getPlaylists(self, userId=None):
+        params = {
+            'IncludeItemTypes': 'Playlist',
+            'Recursive': 'true',
+            'EnableImages': 'false',
+            'EnableUserData': 'false',
+        }
+        res = self._get_request_with_token(cmd=f'/Users/{userId or self.user_id}/Items?{urlencode(params)}')
+        return [JellyfinPlaylist(data=data) for data in (res.get('Items', []) if res else [])]
+
+    def getPlaylist(self, name, userId=None):
+        for playlist in self.getPlaylists(userId=userId):
+            if playlist.name == name:
+                return playlist
+        return None
 
-    def makePlaylist(self, name):
-        res = self._post_request_json(
-            cmd=f'/Playlists',
-            payload={"Name": name, "UserId": self.user_id}
-        )
+    def getPlaylistItemsPage(self, playlistId, start_index=0, limit=None, userId=None):
+        params = {
+            'UserId': userId or self.user_id,
+            'StartIndex': start_index,
+            'EnableImages': 'false',
+            'EnableUserData': 'false',
+        }
+        if limit:
+            params['Limit'] = limit
+        return self._get_request_with_token(cmd=f'/Playlists/{playlistId}/Items?{urlencode(params)}')
+
+    def getPlaylistItems(self, playlistId, page_size=1000, userId=None):
+        # raises IncompleteListError if a page can't be fetched: items on a missing page would look absent from the
+        # playlist and be added again
+        return list(self._iter_pages(fetch=self.getPlaylistItemsPage, page_size=page_size, playlistId=playlistId,
+                                     userId=userId))
+
+    def makePlaylist(self, name, userId=None):
+        with metrics.phase('write'):
+            res = self._post_request_json(
+                cmd=f'/Playlists',
+                payload={"Name": name, "UserId": userId or self.user_id}
+            )
 
         if res:
             return JellyfinPlaylist(data=res.json())
         return None
 
-    def addToPlaylist(self, playlistId, itemIds):
-        item_list = ','.join(itemIds)
+    def addToPlaylist(self, playlistId, itemIds, chunk_size=PLAYLIST_CHUNK_SIZE, userId=None):
+        # item IDs go in the query string, so send them in chunks to stay under URL length limits
         cmd = f'/Playlists/{playlistId}/Items'
-        params = f'Ids={item_list}&UserId={self.user_id}'
-        res = self._post_request(cmd=cmd, params=params)
-        if res:
-            return True
-        return False
+        success = True
+        for i in range(0, len(itemIds), chunk_size):
+            item_list = ','.join(itemIds[i:i + chunk_size])
+            params = f'Ids={item_list}&UserId={userId or self.user_id}'
+            with metrics.phase('write'):
+                res = self._post_request(cmd=cmd, params=params)
+            if not res:
+                print(f"Could not add items {i + 1}-{i + len(itemIds[i:i + chunk_size])} to playlist {playlistId}")
+                success = False
+        return success
 
     def statsCustomQuery(self, query):
         cmd = '/user_usage_stats/submit_custom_query'
         return self._post_request(cmd=cmd, params=None, payload=query)
 
-    def findPlexItemOnJellyfin(self, plex_item, title=None):
-        if not title:
-            title = plex_item.title
-        results = self.search(keyword=title)
-        if results:
-            return results[0]
-        return None
+    def findPlexItemOnJellyfin(self, plex_item, title=None, stats=None, match_cache=None,
+                               fuzzy_threshold=fuzzy.DEFAULT_THRESHOLD):
+        # stats, match_cache and fuzzy_threshold belong to the calling migration: migrations running at the same
+        # time share this client, but not their --match-report, --no-match-cache or --fuzzy-threshold
+        with metrics.phase('match'):
+            item, method = self._findPlexItemOnJellyfin(plex_item=plex_item, title=title, cache=match_cache,
+                                                        fuzzy_threshold=fuzzy_threshold)
+        metrics.inc('matches_total', method=method or MATCH_NONE)
+        if stats is not None:
+            stats.record(plex_item=plex_item, item=item, method=method)
+        return item
+
+    def _findPlexItemOnJellyfin(self, plex_item, title=None, cache=None, fuzzy_threshold=fuzzy.DEFAULT_THRESHOLD):
+        if cache is not None:
+            cached, item, method = self._find_cached_item(plex_item=plex_item, cache=cache)
+            if cached:
+                return item, method
+        library_index = self.library_index
+        if library_index is not None:
+            item, method = library_index.ensure_built().match_plex_item(plex_item, fuzzy_threshold=fuzzy_threshold)
+        else:
+            if not title:
+                title = plex_item.title
+            # the first search hint is often a different item, so only accept one whose title is close enough
+            item_type = PLEX_TO_JELLYFIN_TYPES.get(getattr(plex_item, 'type', None))
+            results = [result for result in self.search(keyword=title) if not item_type or result.type == item_type]
+            item, _ = fuzzy.best_match(title=title, candidates=results, key=lambda result: result.name,
+                                       threshold=min(fuzzy_threshold, 1), year=getattr(plex_item, 'year', None),
+                                       year_key=lambda result: result.year)
+            method = MATCH_SEARCH if item else None
+        # a miss against a partial index is not a real miss, so it isn't remembered
+        if cache is not None and (item or library_index is None or library_index.complete):
+            cache.put(plex_item=plex_item, jellyfin_item=item, method=method)
+        return item, method
@@ -0,0 +1,135 @@
+import asyncio
+import functools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from helpers.metrics import metrics
+
+# requests-per-second limiters, shared by every AsyncJellyfin talking to the same host
+_host_limiters = {}
+
+
+def run(coro):
+    if hasattr(asyncio, 'run'):
+        return asyncio.run(coro)
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class RateLimiter:
+    # token bucket: allows bursts of up to `burst` requests, refilled at `rate` requests per second.
+    # Shared by event loops in different threads and runs, so the bucket is guarded by a thread lock and callers
+    # sleep on their own loop.
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = max(1, burst)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        # take a token, ahead of time if the bucket is empty, and return how long to wait before using it
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return 0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    async def acquire(self):
+        delay = self._reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+def get_host_limiter(url, rate, burst=1):
+    host = urlparse(url).netloc
+    limiter = _host_limiters.get(host)
+    if limiter is None or limiter.rate != rate:
+        limiter = RateLimiter(rate=rate, burst=burst)
+        _host_limiters[host] = limiter
+    return limiter
+
+
+class AsyncJellyfin:
+    """
+    asyncio counterpart to helpers.jellyfin.Jellyfin.
+    Calls run on a worker pool sharing the wrapped client's pooled session (and its retry/re-auth handling),
+    with at most `concurrency` requests in flight and at most `rate_limit` requests per second to the host.
+    """
+    def __init__(self, jellyfin, concurrency=16, rate_limit=None):
+        self.jellyfin = jellyfin
+        self.concurrency = concurrency
+        self.jellyfin.setPoolSize(max(self.jellyfin.pool_size, concurrency))
+        self._limiter = None
+        if rate_limit:
+            self._limiter = get_host_limiter(url=jellyfin.url, rate=rate_limit, burst=concurrency)
+        self._semaphore = None
+        self._executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    @property
+    def policy(self):
+        return self.jellyfin.policy
+
+    @property
+    def user_id(self):
+        return self.jellyfin.user_id
+
+    async def _call(self, func, **kwargs):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            if self._limiter:
+                await self._limiter.acquire()
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self._executor, functools.partial(func, **kwargs))
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    async def search(self, keyword):
+        return await self._call(self.jellyfin.search, keyword=keyword)
+
+    async def updateRating(self, itemId, upvote, userId=None):
+        return await self._call(self.jellyfin.updateRating, itemId=itemId, upvote=upvote, userId=userId)
+
+    async def updateUserData(self, itemId, data, userId=None):
+        return await self._call(self.jellyfin.updateUserData, itemId=itemId, data=data, userId=userId)
+
+    async def updateUserDataBatch(self, userId, updates, progress=None):
+        # updates is a list of (itemId, data); all of one user's writes share the worker pool and connection pool
+        async def update(itemId, data):
+            success = await self.updateUserData(itemId=itemId, data=data, userId=userId)
+            if progress:
+                progress()
+            return success
+
+        with metrics.phase('write'):
+            return await asyncio.gather(*[update(itemId, data) for itemId, data in updates])
+
+    async def makeUser(self, username):
+        return await self._call(self.jellyfin.makeUser, username=username)
+
+    async def resetPassword(self, userId):
+        return await self._call(self.jellyfin.resetPassword, userId=userId)
+
+    async def setUserPassword(self, userId, currentPass, newPass):
+        return await self._call(self.jellyfin.setUserPassword, userId=userId, currentPass=currentPass,
+                                newPass=newPass)
+
+    async def updatePolicy(self, userId, policy=None):
+        return await self._call(self.jellyfin.updatePolicy, userId=userId, policy=policy)
+
+    async def makePlaylist(self, name, userId=None):
+        return await self._call(self.jellyfin.makePlaylist, name=name, userId=userId)
+
+    async def addToPlaylist(self, playlistId, itemIds, userId=None):
+        return await self._call(self.jellyfin.addToPlaylist, playlistId=playlistId, itemIds=itemIds, userId=userId)
+
+    async def getUsers(self):
+        return await self._call(self.jellyfin.getUsers)
@@ -0,0 +1,220 @@
+import atexit
+import sqlite3
+import threading
+import time
+
+journal_file = '.migration_journal.db'
+
+OUTCOME_SUCCESS = 'success'
+OUTCOME_FAILED = 'failed'
+OUTCOME_UNMATCHED = 'unmatched'
+
+
+class _Database:
+    # One sqlite connection per journal file, shared by every Journal in the process. Migrations running at the same
+    # time (plex2jellyfin.py --parallel) write through it in turn instead of locking each other out of the file
+    # while one of them holds an uncommitted batch.
+    def __init__(self, file):
+        self.file = file
+        self.lock = threading.RLock()
+        self.pending = 0
+        self.users = 0
+        self.conn = sqlite3.connect(file, check_same_thread=False, timeout=30)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS journal ('
+                          'migration TEXT NOT NULL, '
+                          'key TEXT NOT NULL, '
+                          'jellyfin_id TEXT, '
+                          'outcome TEXT NOT NULL, '
+                          'updated_at REAL NOT NULL, '
+                          'PRIMARY KEY (migration, key))')
+        # high-water marks for incremental runs, see helpers.incremental
+        self.conn.execute('CREATE TABLE IF NOT EXISTS marks ('
+                          'migration TEXT NOT NULL, '
+                          'source TEXT NOT NULL, '
+                          'value TEXT NOT NULL, '
+                          'updated_at REAL NOT NULL, '
+                          'PRIMARY KEY (migration, source))')
+        self.conn.commit()
+
+    def commit(self):
+        self.conn.commit()
+        self.pending = 0
+
+
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def _open_database(file):
+    with _databases_lock:
+        database = _databases.get(file)
+        if database is None:
+            database = _databases[file] = _Database(file=file)
+        database.users += 1
+        return database
+
+
+def _release_database(database):
+    with _databases_lock:
+        with database.lock:
+            database.commit()
+            database.users -= 1
+            if database.users == 0:
+                database.conn.close()
+                del _databases[database.file]
+
+
+class Journal:
+    # On-disk checkpoint of every item a migration has processed, keyed by migration name and Plex ratingKey.
+    # Successful items are skipped on the next run; failed or unmatched items are retried.
+    def __init__(self, migration, file=journal_file, commit_every=100, readonly=False):
+        self.migration = migration
+        # a read-only journal still skips finished items, but records nothing (used when only planning)
+        self.readonly = readonly
+        self.file = file
+        self.commit_every = commit_every
+        self._db = _open_database(file)
+        with self._db.lock:
+            self._entries = {
+                key: (jellyfin_id, outcome)
+                for key, jellyfin_id, outcome in self._db.conn.execute(
+                    'SELECT key, jellyfin_id, outcome FROM journal WHERE migration = ?', (migration,))
+            }
+            self._marks = dict(self._db.conn.execute('SELECT source, value FROM marks WHERE migration = ?',
+                                                     (migration,)))
+        atexit.register(self.close)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        return self._entries.get(str(key), (None, None))
+
+    def is_done(self, key):
+        return self.get(key)[1] == OUTCOME_SUCCESS
+
+    def key(self, key):
+        return str(key)
+
+    def record(self, key, outcome, jellyfin_id=None):
+        key = str(key)
+        if self.readonly:
+            return
+        self._entries[key] = (jellyfin_id, outcome)
+        if self._db is None:
+            return
+        with self._db.lock:
+            self._db.conn.execute('INSERT OR REPLACE INTO journal (migration, key, jellyfin_id, outcome, updated_at) '
+                                  'VALUES (?, ?, ?, ?, ?)', (self.migration, key, jellyfin_id, outcome, time.time()))
+            self._db.pending += 1
+            if self._db.pending >= self.commit_every:
+                self._db.commit()
+
+    def keys(self, outcomes):
+        return [key for key, (_, outcome) in self._entries.items() if outcome in outcomes]
+
+    def get_mark(self, source):
+        return self._marks.get(source)
+
+    def set_mark(self, source, value):
+        if self.readonly:
+            return
+        self._marks[source] = str(value)
+        if self._db is None:
+            return
+        with self._db.lock:
+            self._db.conn.execute('INSERT OR REPLACE INTO marks (migration, source, value, updated_at) '
+                                  'VALUES (?, ?, ?, ?)', (self.migration, source, str(value), time.time()))
+            self._db.commit()
+
+    def record_result(self, key, success, jellyfin_id=None):
+        if success:
+            outcome = OUTCOME_SUCCESS
+        elif jellyfin_id:
+            outcome = OUTCOME_FAILED
+        else:
+            outcome = OUTCOME_UNMATCHED
+        self.record(key=key, outcome=outcome, jellyfin_id=jellyfin_id)
+
+    def reset(self):
+        self._entries = {}
+        self._marks = {}
+        with self._db.lock:
+            self._db.conn.execute('DELETE FROM journal WHERE migration = ?', (self.migration,))
+            self._db.conn.execute('DELETE FROM marks WHERE migration = ?', (self.migration,))
+            self._db.commit()
+
+    def summary(self):
+        counts = {}
+        for _, outcome in self._entries.values():
+            counts[outcome] = counts.get(outcome, 0) + 1
+        return counts
+
+    def scoped(self, prefix):
+        # a view of this journal whose keys are prefixed, e.g. with a user ID for per-user migrations
+        if not prefix:
+            return self
+        return ScopedJournal(journal=self, prefix=prefix)
+
+    def close(self):
+        database, self._db = self._db, None
+        if database is not None:
+            _release_database(database)
+
+
+class ScopedJournal:
+    def __init__(self, journal, prefix):
+        self.journal = journal
+        self.prefix = prefix
+
+    def key(self, key):
+        return f'{self.prefix}/{key}'
+
+    def get(self, key):
+        return self.journal.get(self.key(key))
+
+    def is_done(self, key):
+        return self.journal.is_done(self.key(key))
+
+    def record(self, key, outcome, jellyfin_id=None):
+        self.journal.record(key=self.key(key), outcome=outcome, jellyfin_id=jellyfin_id)
+
+    def record_result(self, key, success, jellyfin_id=None):
+        self.journal.record_result(key=self.key(key), success=success, jellyfin_id=jellyfin_id)
+
+    def keys(self, outcomes):
+        prefix = f'{self.prefix}/'
+        return [key[len(prefix):] for key in self.journal.keys(outcomes=outcomes) if key.startswith(prefix)]
+
+    def get_mark(self, source):
+        return self.journal.get_mark(self.key(source))
+
+    def set_mark(self, source, value):
+        self.journal.set_mark(source=self.key(source), value=value)
+
+
+def add_journal_arguments(parser):
+    parser.add_argument('--journal', type=str, default=journal_file,
+                        help=f"Checkpoint file used to resume interrupted migrations (default: {journal_file})")
+    parser.add_argument('--restart', action='store_true',
+                        help="Ignore the checkpoint file and process every item again")
+
+
+def add_incremental_arguments(parser):
+    # for migrations that can ask Plex for only what changed, see helpers.incremental
+    parser.add_argument('--incremental', action='store_true',
+                        help="Only migrate what changed on Plex since the last incremental run, plus items that "
+                             "failed or (once Jellyfin has new items) went unmatched. The first run is a full one")
+
+
+def open_journal(migration, args):
+    journal = Journal(migration=migration, file=args.journal, readonly=bool(getattr(args, 'plan', None)))
+    if args.restart and not journal.readonly:
+        journal.reset()
+    elif len(journal):
+        counts = journal.summary()
+        print(f"Resuming {migration} migration: {counts.get(OUTCOME_SUCCESS, 0)} items already done, "
+              f"{len(journal) - counts.get(OUTCOME_SUCCESS, 0)} to retry.")
+    return journal
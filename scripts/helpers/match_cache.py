@@ -0,0 +1,140 @@
+import atexit
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+cache_file = '.match_cache.db'
+
+# cached "no match" marker, so unmatched items aren't looked up again until the library changes
+_MISS = (None, None, None)
+
+
+class MatchCache:
+    # Persistent Plex --> Jellyfin match cache, shared by every migration script.
+    # Entries are keyed by Plex ratingKey and guid; an in-memory LRU sits in front of the SQLite file.
+    def __init__(self, file=cache_file, lru_size=10000, commit_every=100):
+        self.file = file
+        self.lru_size = lru_size
+        self.commit_every = commit_every
+        self.hits = 0
+        self.misses = 0
+        # set when the Jellyfin library changed since the cache was written, so hits must be re-checked
+        self.verify_hits = False
+        self._pending = 0
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(file, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS matches ('
+                           'plex_key TEXT PRIMARY KEY, '
+                           'plex_guid TEXT, '
+                           'jellyfin_id TEXT, '
+                           'jellyfin_name TEXT, '
+                           'method TEXT, '
+                           'matched_at REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS matches_guid ON matches (plex_guid)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self._conn.commit()
+        atexit.register(self.close)
+
+    def validate(self, library_etag):
+        # drop cached misses when items were added to or removed from Jellyfin since the last run
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM meta WHERE key = 'library_etag'").fetchone()
+            if row and row[0] == library_etag:
+                return True
+            if row:
+                print("Jellyfin library changed since the last run, re-checking cached matches...")
+                self._conn.execute('DELETE FROM matches WHERE jellyfin_id IS NULL')
+                self._lru.clear()
+                self.verify_hits = True
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('library_etag', ?)",
+                               (library_etag,))
+            self._conn.commit()
+            return False
+
+    def _remember(self, key, entry):
+        self._lru[key] = entry
+        self._lru.move_to_end(key)
+        while len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def get(self, plex_item):
+        # returns (jellyfin_id, jellyfin_name, method), _MISS for a cached non-match, or None if not cached
+        key = str(plex_item.ratingKey)
+        with self._lock:
+            entry = self._lru.get(key)
+            if entry is not None:
+                self._lru.move_to_end(key)
+            elif self._conn is not None:
+                row = self._conn.execute('SELECT jellyfin_id, jellyfin_name, method FROM matches WHERE plex_key = ?',
+                                         (key,)).fetchone()
+                guid = getattr(plex_item, 'guid', None)
+                if row is None and guid:
+                    row = self._conn.execute('SELECT jellyfin_id, jellyfin_name, method FROM matches '
+                                             'WHERE plex_guid = ? AND jellyfin_id IS NOT NULL', (guid,)).fetchone()
+                if row is not None:
+                    entry = tuple(row)
+                    self._remember(key, entry)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def put(self, plex_item, jellyfin_item, method):
+        key = str(plex_item.ratingKey)
+        entry = _MISS
+        if jellyfin_item:
+            entry = (jellyfin_item.id, jellyfin_item.name, method)
+        with self._lock:
+            self._remember(key, entry)
+            if self._conn is None:
+                return
+            self._conn.execute('INSERT OR REPLACE INTO matches '
+                               '(plex_key, plex_guid, jellyfin_id, jellyfin_name, method, matched_at) '
+                               'VALUES (?, ?, ?, ?, ?, ?)',
+                               (key, getattr(plex_item, 'guid', None), *entry, time.time()))
+            self._pending += 1
+            if self._pending >= self.commit_every:
+                self._conn.commit()
+                self._pending = 0
+
+    def discard(self, plex_item):
+        key = str(plex_item.ratingKey)
+        with self._lock:
+            self._lru.pop(key, None)
+            if self._conn is not None:
+                self._conn.execute('DELETE FROM matches WHERE plex_key = ?', (key,))
+
+    def clear(self):
+        with self._lock:
+            self._lru.clear()
+            self._conn.execute('DELETE FROM matches')
+            self._conn.execute('DELETE FROM meta')
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.commit()
+                self._conn.close()
+                self._conn = None
+
+
+def add_match_cache_arguments(parser):
+    parser.add_argument('--match-cache', type=str, default=cache_file,
+                        help=f"File caching Plex to Jellyfin matches between runs and scripts (default: {cache_file})")
+    parser.add_argument('--no-match-cache', action='store_true',
+                        help="Match every item again without reading or writing the match cache")
+
+
+def open_match_cache(jellyfin, args):
+    # the calling migration's cache, or None with --no-match-cache
+    if args.no_match_cache:
+        return None
+    cache = jellyfin.openMatchCache(file=args.match_cache)
+    print(f"Using match cache {args.match_cache}")
+    return cache
@@ -0,0 +1,146 @@
+import json
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+# latency histogram bucket upper bounds, in seconds
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf')]
+
+# IDs in request paths are replaced so requests to the same endpoint share one series
+# an ID segment, or a comma separated list of numeric IDs such as /library/metadata/12,13,14
+_ID_SEGMENT = re.compile(r'/(?:[0-9a-fA-F]{32}|[0-9a-fA-F-]{36}|\d+(?:(?:,|%2C)\d+)*)(?=/|$)', re.IGNORECASE)
+
+
+def endpoint(path):
+    # "/Users/0f3c.../Items?Recursive=true" --> "/Users/{id}/Items"
+    path = path.split('?', 1)[0]
+    if '://' in path:
+        path = '/' + path.split('://', 1)[1].split('/', 1)[-1]
+    return _ID_SEGMENT.sub('/{id}', path) or '/'
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': round(self.sum, 6),
+                'buckets': {('+Inf' if bound == float('inf') else str(bound)): count
+                            for bound, count in zip(BUCKETS, self.counts)}}
+
+
+def _labels(labels):
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+class Metrics:
+    # Process-wide counters and latency histograms, keyed by name and labels. Every helper records into the
+    # shared `metrics` instance below; a script writes it out once at the end of its run.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def phase(self, phase):
+        # time spent enumerating, matching, writing, ...; concurrent work in the same phase adds up
+        return self.timer('phase_seconds', phase=phase)
+
+    def to_json(self):
+        with self._lock:
+            return {
+                'started_at': self.started,
+                'run_seconds': round(time.time() - self.started, 3),
+                'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                             for (name, labels), value in sorted(self.counters.items())],
+                'histograms': [{'name': name, 'labels': dict(labels), **histogram.to_dict()}
+                               for (name, labels), histogram in sorted(self.histograms.items())],
+            }
+
+    def to_prometheus(self, prefix='plex2jellyfin_'):
+        def label_text(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{key}="{value}"' for key, value in pairs) + '}'
+
+        lines = []
+        with self._lock:
+            names = sorted({name for name, _ in self.counters})
+            for name in names:
+                lines.append(f'# TYPE {prefix}{name} counter')
+                for (counter, labels), value in sorted(self.counters.items()):
+                    if counter == name:
+                        lines.append(f'{prefix}{name}{label_text(labels)} {value}')
+            names = sorted({name for name, _ in self.histograms})
+            for name in names:
+                lines.append(f'# TYPE {prefix}{name} histogram')
+                for (histogram_name, labels), histogram in sorted(self.histograms.items()):
+                    if histogram_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(BUCKETS, histogram.counts):
+                        cumulative += count
+                        le = '+Inf' if bound == float('inf') else str(bound)
+                        lines.append(f'{prefix}{name}_bucket{label_text(labels, [("le", le)])} {cumulative}')
+                    lines.append(f'{prefix}{name}_sum{label_text(labels)} {histogram.sum:.6f}')
+                    lines.append(f'{prefix}{name}_count{label_text(labels)} {histogram.count}')
+            lines.append(f'# TYPE {prefix}run_seconds gauge')
+            lines.append(f'{prefix}run_seconds {time.time() - self.started:.3f}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, file):
+        # Prometheus text format for .prom/.txt files, JSON otherwise
+        if file.endswith(('.prom', '.txt')):
+            content = self.to_prometheus()
+        else:
+            content = json.dumps(self.to_json(), indent=2)
+        with open(file, 'w') as f:
+            f.write(content)
+        print(f"Wrote metrics to {file}")
+
+
+metrics = Metrics()
+
+
+def add_metrics_arguments(parser):
+    parser.add_argument('--metrics', type=str, required=False,
+                        help="Write request counts, latencies, retries and per-phase timings to this file when done "
+                             "(Prometheus text format for .prom or .txt files, JSON otherwise)")
+
+
+def write_metrics(args):
+    if getattr(args, 'metrics', None):
+        metrics.write(file=args.metrics)
@@ -0,0 +1,82 @@
+import queue
+import threading
+
+from helpers.metrics import metrics
+
+_DONE = object()
+
+
+class _Stage:
+    def __init__(self, name, func, workers):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.running = self.workers
+        self.lock = threading.Lock()
+
+
+class Pipeline:
+    # Stages run on their own worker threads and are connected by bounded queues, so a slow stage applies
+    # back-pressure to the one feeding it instead of letting work pile up in memory.
+    # Each stage function takes one item and returns an iterable of items for the next stage (or None).
+    def __init__(self, queue_size=100):
+        self.queue_size = queue_size
+        self.stages = []
+
+    def add_stage(self, name, func, workers=1):
+        self.stages.append(_Stage(name=name, func=func, workers=workers))
+        return self
+
+    def run(self, source):
+        # returns False when enumerating the source failed partway, so some items were never processed
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        errors = []
+        threads = [threading.Thread(target=self._produce, args=(source, queues[0], self.stages[0].workers, errors),
+                                    name='source', daemon=True)]
+        for i, stage in enumerate(self.stages):
+            next_queue = queues[i + 1] if i + 1 < len(queues) else None
+            next_workers = self.stages[i + 1].workers if next_queue else 0
+            for n in range(stage.workers):
+                threads.append(threading.Thread(target=self._work,
+                                                args=(stage, queues[i], next_queue, next_workers),
+                                                name=f'{stage.name}-{n}', daemon=True))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            # join with a timeout so Ctrl-C still reaches the main thread
+            while thread.is_alive():
+                thread.join(timeout=0.5)
+        return not errors
+
+    @staticmethod
+    def _produce(source, out_queue, consumers, errors):
+        try:
+            for item in source:
+                out_queue.put(item)
+        except Exception as e:
+            print(f"Error while enumerating items: {e}")
+            errors.append(e)
+        finally:
+            for _ in range(consumers):
+                out_queue.put(_DONE)
+
+    @staticmethod
+    def _work(stage, in_queue, out_queue, consumers):
+        while True:
+            item = in_queue.get()
+            if item is _DONE:
+                break
+            try:
+                with metrics.timer('pipeline_stage_seconds', stage=stage.name):
+                    results = stage.func(item)
+                if out_queue is not None:
+                    for result in results or []:
+                        out_queue.put(result)
+            except Exception as e:
+                print(f"Error in {stage.name} stage: {e}")
+        with stage.lock:
+            stage.running -= 1
+            last = stage.running == 0
+        if last and out_queue is not None:
+            for _ in range(consumers):
+                out_queue.put(_DONE)
@@ -0,0 +1,98 @@
+import asyncio
+import json
+import threading
+import time
+from collections import Counter
+
+ACTION_CREATE_USER = 'create_user'
+ACTION_UPDATE_POLICY = 'update_policy'
+ACTION_SET_USER_DATA = 'set_user_data'
+ACTION_SYNC_PLAYLIST = 'sync_playlist'
+ACTION_COPY_IMAGE = 'copy_image'
+ACTION_UPLOAD_IMAGE = 'upload_image'
+
+
+class PlanWriter:
+    # JSON Lines plan: a header line naming the migration, then one planned write per line.
+    # Nothing is sent to Jellyfin while planning; --apply later runs the actions without matching again.
+    def __init__(self, file, migration):
+        self.file = file
+        self.migration = migration
+        self.counts = Counter()
+        self._lock = threading.Lock()
+        self._f = open(file, 'w')
+        self._write({'migration': migration, 'created_at': time.time()})
+
+    def _write(self, data):
+        self._f.write(json.dumps(data, separators=(',', ':')) + '\n')
+
+    def add(self, action, **fields):
+        with self._lock:
+            self.counts[action] += 1
+            self._write({'action': action, **fields})
+
+    def close(self):
+        with self._lock:
+            if self._f:
+                self._f.close()
+                self._f = None
+
+    def print_summary(self):
+        print(f"Planned {sum(self.counts.values())} actions for the {self.migration} migration:")
+        for action, count in sorted(self.counts.items()):
+            print(f"    {action}: {count}")
+        print(f"Review {self.file}, then run again with --apply {self.file} to make the changes.")
+
+
+def read_plan(file, migration):
+    f = open(file, 'r')
+    header = json.loads(f.readline() or '{}')
+    if header.get('migration') != migration:
+        f.close()
+        print(f"{file} is a plan for the {header.get('migration')} migration, not {migration}.")
+        exit(1)
+
+    def actions():
+        with f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+    return actions()
+
+
+def add_plan_arguments(parser):
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--plan', type=str, required=False,
+                       help="Work out every change without writing anything to Jellyfin, and save the planned "
+                            "actions to this JSON Lines file")
+    group.add_argument('--apply', type=str, required=False,
+                       help="Make the changes listed in a plan file written by --plan, without matching again")
+
+
+def open_plan(migration, args):
+    if getattr(args, 'plan', None):
+        print(f"Planning only, nothing will be written to Jellyfin. Saving plan to {args.plan}")
+        return PlanWriter(file=args.plan, migration=migration)
+    return None
+
+
+async def apply_user_data_actions(async_jellyfin, actions, journal):
+    # one concurrent batch of user-data writes per Jellyfin user
+    by_user = {}
+    for action in actions:
+        if action['action'] == ACTION_SET_USER_DATA:
+            by_user.setdefault(action['user_id'], []).append(action)
+
+    async def apply_user(user_id, user_actions):
+        results = await async_jellyfin.updateUserDataBatch(
+            userId=user_id, updates=[(action['item_id'], action['data']) for action in user_actions])
+        for action, success in zip(user_actions, results):
+            journal.record_result(key=action['journal_key'], success=success, jellyfin_id=action['item_id'])
+        return sum(1 for success in results if success), len(user_actions)
+
+    results = await asyncio.gather(*[apply_user(user_id, user_actions) for user_id, user_actions in by_user.items()])
+    success_count = sum(success for success, _ in results)
+    total = sum(count for _, count in results)
+    print(f"Applied {success_count} of {total} planned user data updates for {len(by_user)} users.")
+    return success_count
@@ -1,15 +1,81 @@
-from plexapi.server import PlexServer
+import threading
+
+from helpers.metrics import metrics, endpoint as metrics_endpoint
+
+# items fetched per request when streaming a library section
+PAGE_SIZE = 500
+
+# library section type --> item types stored in it
+SECTION_LIBTYPES = {
+    'movie': ['movie'],
+    'show': ['show', 'season', 'episode'],
+    'artist': ['artist', 'album', 'track'],
+}
+
+
+# library section type --> item types that have a watched state
+WATCHED_LIBTYPES = {
+    'movie': ['movie'],
+    'show': ['episode'],
+    'artist': ['track'],
+}
+
+# seconds to wait for image bytes when streaming artwork
+IMAGE_TIMEOUT = 60
+
+# ratingKeys per request when fetching items by key
+FETCH_CHUNK_SIZE = 100
+
+
+def changed_since(filters, field, since):
+    # add a server-side "<field> after since" filter, e.g. lastRatedAt or updatedAt, for incremental runs
+    if since is None:
+        return filters
+    return {**filters, f'{field}>>': since}
+
+
+def _record_response(response, *args, **kwargs):
+    route = metrics_endpoint(response.request.path_url)
+    metrics.observe('plex_request_seconds', response.elapsed.total_seconds(), method=response.request.method,
+                    endpoint=route)
+    metrics.inc('plex_requests_total', method=response.request.method, endpoint=route, status=response.status_code)
+
+
+def _instrument(session):
+    # plexapi sends everything through one requests session, shared with switchUser() servers
+    if _record_response not in session.hooks['response']:
+        session.hooks['response'].append(_record_response)
 
 
 class Plex:
-    def __init__(self, url, token, server_name):
+    def __init__(self, url, token, server_name, server=None):
         self.url = url
         self.token = token
         self.server_name = server_name
-        self.server = PlexServer(url, token)
+        if server is None:
+            from plexapi.server import PlexServer  # slow to import, so only when connecting
+            server = PlexServer(url, token)
+        self.server = server
+        _instrument(self.server._session)
+        # plex.tv lookups, kept for every migration that runs in this process
+        self._lock = threading.Lock()
+        self._users = None
+        self._user_servers = {}
+
+    def for_user(self, user):
+        # the same server seen through a shared user's own token, for their watch state, ratings and playlists
+        with self._lock:
+            if user.id not in self._user_servers:
+                server = self.server.switchUser(user)
+                self._user_servers[user.id] = Plex(url=self.url, token=server._token, server_name=self.server_name,
+                                                   server=server)
+            return self._user_servers[user.id]
 
     def get_users(self):
-        return self.server.myPlexAccount().users()
+        with self._lock:
+            if self._users is None:
+                self._users = self.server.myPlexAccount().users()
+            return list(self._users)
 
     def user_has_server_access(self, user):
         for s in user.servers:
@@ -17,6 +83,19 @@ class Plex:
                 return True
         return False
 
+    def open_image(self, path, max_size=None):
+        # Stream an item's thumb or art key from the server. With max_size, Plex downscales the image to fit and
+        # re-encodes it as JPEG before sending it. Returns (binary stream, content type).
+        if max_size:
+            url = self.server.transcodeImage(path, height=max_size, width=max_size, minSize=False, upscale=False,
+                                             imageFormat='jpeg')
+        else:
+            url = self.server.url(path, includeToken=True)
+        res = self.server._session.get(url, stream=True, timeout=IMAGE_TIMEOUT)
+        res.raise_for_status()
+        res.raw.decode_content = True
+        return res.raw, res.headers.get('Content-Type', 'image/jpeg').split(';')[0]
+
     def get_playlists(self):
         return self.server.playlists()
 
@@ -25,3 +104,58 @@ class Plex:
 
     def get_all_section_items(self, section):
         return section.all()
+
+    def iter_section_items(self, section, libtype=None, filters=None, page_size=PAGE_SIZE, since=None, **kwargs):
+        # Stream a section one container page at a time, instead of loading every item into memory at once.
+        # filters/kwargs are applied by the Plex server, e.g. filters={'userRating>>': 0}. With since (a datetime),
+        # only the items added or changed after it.
+        filters = changed_since(filters or {}, field='updatedAt', since=since) or None
+        container_start = 0
+        while True:
+            with metrics.phase('plex_enumerate'):
+                page = section.search(libtype=libtype, filters=filters, container_start=container_start,
+                                      container_size=page_size, maxresults=page_size, **kwargs)
+            for item in page:
+                yield item
+            if len(page) < page_size:
+                break
+            container_start += page_size
+
+    def iter_rated_items(self, libtypes=None, page_size=PAGE_SIZE, since=None):
+        # Only items with a user rating, asked for with one paged userRating>>0 query per section and item type.
+        # With since (a datetime), only the ones rated after it.
+        filters = changed_since({'userRating>>': 0}, field='lastRatedAt', since=since)
+        for section in self.get_library_sections():
+            for libtype in SECTION_LIBTYPES.get(section.type, []):
+                if libtypes and libtype not in libtypes:
+                    continue
+                yield from self.iter_section_items(section=section, libtype=libtype, filters=filters,
+                                                   page_size=page_size)
+
+    def iter_watched_items(self, libtypes=None, page_size=PAGE_SIZE, since=None):
+        # items played at least once, with viewCount and lastViewedAt filled in
+        filters = changed_since({'viewCount>>': 0}, field='lastViewedAt', since=since)
+        for section in self.get_library_sections():
+            for libtype in WATCHED_LIBTYPES.get(section.type, []):
+                if libtypes and libtype not in libtypes:
+                    continue
+                yield from self.iter_section_items(section=section, libtype=libtype, filters=filters,
+                                                   page_size=page_size)
+
+    def iter_in_progress_items(self, libtypes=None, page_size=PAGE_SIZE, since=None):
+        # partially played items, with viewOffset (milliseconds) filled in
+        filters = changed_since({'inProgress': True}, field='lastViewedAt', since=since)
+        for section in self.get_library_sections():
+            for libtype in WATCHED_LIBTYPES.get(section.type, []):
+                if libtypes and libtype not in libtypes:
+                    continue
+                yield from self.iter_section_items(section=section, libtype=libtype, filters=filters,
+                                                   page_size=page_size)
+
+    def fetch_items(self, rating_keys, chunk_size=FETCH_CHUNK_SIZE):
+        # items by ratingKey, many per request (Plex accepts a comma separated list in /library/metadata)
+        rating_keys = [str(key) for key in rating_keys]
+        for i in range(0, len(rating_keys), chunk_size):
+            with metrics.phase('plex_enumerate'):
+                items = self.server.fetchItems(f"/library/metadata/{','.join(rating_keys[i:i + chunk_size])}")
+            yield from items
@@ -0,0 +1,64 @@
+import itertools
+
+import helpers.fuzzy as fz
+import helpers.incremental as inc
+import helpers.journal as jnl
+
+# every Plex item type that can carry a user rating
+RATED_LIBTYPES = ['movie', 'show', 'season', 'episode', 'artist', 'album', 'track']
+
+# Plex ratings at or above this also set Jellyfin's "like" flag
+LIKE_THRESHOLD = 6.0
+
+
+def rating_user_data(rating):
+    # Plex userRating and Jellyfin UserData.Rating are both on a 0-10 scale (5 stars = 10)
+    return {'Rating': float(rating), 'Likes': rating >= LIKE_THRESHOLD}
+
+
+def get_rated_items(plex, journal=None, libtypes=None, changes=None):
+    # {libtype: [plex items]} with a user rating, minus the ones a previous run already migrated. With a
+    # ChangeTracker that has a mark, only the items rated since the last incremental run and the journal's retries.
+    rated_items = {libtype: [] for libtype in (libtypes or RATED_LIBTYPES)}
+    since = changes.since('lastRatedAt') if changes else None
+    plex_items = plex.iter_rated_items(libtypes=list(rated_items.keys()), since=since)
+    if since is not None:
+        plex_items = itertools.chain(plex_items, inc.retry_items(plex=plex, changes=changes))
+    rating_keys = set()
+    for plex_item in plex_items:
+        if plex_item.ratingKey in rating_keys:
+            continue
+        rating_keys.add(plex_item.ratingKey)
+        if changes:
+            changes.seen('lastRatedAt', plex_item.lastRatedAt)
+        if not plex_item.userRating or plex_item.type not in rated_items:  # No rating = None
+            continue
+        # re-rated items are done in the journal, but changed since, so an incremental run redoes them
+        if journal and since is None and journal.is_done(plex_item.ratingKey):
+            continue
+        rated_items[plex_item.type].append(plex_item)
+    return rated_items
+
+
+def match_ratings(jellyfin, plex_items, journal=None, stats=None, match_cache=None,
+                  fuzzy_threshold=fz.DEFAULT_THRESHOLD):
+    # [(plex item, Jellyfin item ID, user data)] for every rated Plex item found on Jellyfin
+    updates = []
+    for plex_item in plex_items:
+        jellyfin_item = jellyfin.findPlexItemOnJellyfin(plex_item=plex_item, stats=stats, match_cache=match_cache,
+                                                        fuzzy_threshold=fuzzy_threshold)
+        if jellyfin_item:
+            updates.append((plex_item, jellyfin_item.id, rating_user_data(plex_item.userRating)))
+        elif journal:
+            journal.record(key=plex_item.ratingKey, outcome=jnl.OUTCOME_UNMATCHED)
+    return updates
+
+
+async def write_ratings(async_jellyfin, user_id, updates, journal=None, progress=None):
+    # write one user's ratings as a single batch through the async client, returns how many succeeded
+    results = await async_jellyfin.updateUserDataBatch(
+        userId=user_id, updates=[(item_id, data) for _, item_id, data in updates], progress=progress)
+    if journal:
+        for (plex_item, item_id, _), success in zip(updates, results):
+            journal.record_result(key=plex_item.ratingKey, success=success, jellyfin_id=item_id)
+    return sum(1 for success in results if success)
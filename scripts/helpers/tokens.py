@@ -0,0 +1,95 @@
+import os
+import re
+import threading
+from urllib.parse import urlparse
+
+from helpers.metrics import metrics
+
+# results of checking a token against the server
+TOKEN_VALID = 'valid'
+TOKEN_INVALID = 'invalid'
+TOKEN_UNKNOWN = 'unknown'  # the server could not be reached or gave an unexpected answer
+
+
+def token_file_for(url, username):
+    # one cache file per server and user, so scripts talking to two Jellyfin servers don't overwrite each other's token
+    server = urlparse(url).netloc or url
+    return '.jellyfin_token.' + re.sub(r'[^\w.-]+', '_', f'{server}.{username}')
+
+
+class TokenManager:
+    # Owns a Jellyfin access token. The cached token is checked once at startup rather than on every request, and
+    # an expired token is replaced at most once: callers pass the generation of the token they were rejected with,
+    # and whoever gets the lock first logs in again while everyone else waits for that login and reuses it.
+    # login() returns (token, user_id) or None; check(token) returns one of the TOKEN_* results.
+    def __init__(self, file, login, check):
+        self.file = file
+        self._login = login
+        self._check = check
+        self._lock = threading.Lock()
+        self.token = None
+        self.user_id = None
+        self.generation = 0
+        self._checked_generation = None
+
+    def header(self):
+        return {'X-Emby-Token': self.token} if self.token else {}
+
+    def start(self):
+        with self._lock:
+            if self._load():
+                result = self._check(self.token)
+                if result != TOKEN_INVALID:
+                    # keep the cached token if the server just couldn't be asked; a 401 later still replaces it
+                    self._checked_generation = self.generation
+                    return True
+                print("Cached Jellyfin token is no longer valid")
+            return self._refresh()
+
+    def on_unauthorized(self, generation):
+        # 401: the token was rejected, replace it unless another caller already has
+        with self._lock:
+            if generation != self.generation:
+                return True
+            return self._refresh()
+
+    def on_forbidden(self, generation):
+        # 403 usually means the user may not do this, which a new token won't fix; only log in again if the
+        # token itself turns out to be invalid, and check each token at most once
+        with self._lock:
+            if generation != self.generation:
+                return True
+            if self._checked_generation == generation:
+                return False
+            self._checked_generation = generation
+            if self._check(self.token) != TOKEN_INVALID:
+                return False
+            return self._refresh()
+
+    def _refresh(self):
+        metrics.inc('jellyfin_reauth_total')
+        creds = self._login()
+        if not creds:
+            return False
+        self.token, self.user_id = creds
+        self.generation += 1
+        self._checked_generation = self.generation
+        self._save()
+        return True
+
+    def _load(self):
+        if not os.path.exists(self.file):
+            return False
+        with open(self.file, 'r') as f:
+            lines = [line.rstrip() for line in f.readlines()]
+        if len(lines) < 2 or not lines[0]:
+            return False
+        self.token, self.user_id = lines[0], lines[1]
+        return True
+
+    def _save(self):
+        # written aside and swapped in, so a second process never reads half a token
+        tmp_file = f'{self.file}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w') as f:
+            f.write(f"{self.token}\n{self.user_id}\n")
+        os.replace(tmp_file, self.file)
@@ -0,0 +1,145 @@
+import errno
+import hashlib
+import os
+import shutil
+import threading
+
+from helpers.metrics import metrics
+
+# FICLONE from <linux/fs.h>: share the source's extents copy-on-write (btrfs, XFS, bcachefs, ...)
+FICLONE = 0x40049409
+
+STRATEGY_AUTO = 'auto'
+STRATEGY_HARDLINK = 'hardlink'
+STRATEGY_REFLINK = 'reflink'
+STRATEGY_KERNEL = 'kernel'
+STRATEGY_COPY = 'copy'
+STRATEGIES = [STRATEGY_AUTO, STRATEGY_HARDLINK, STRATEGY_REFLINK, STRATEGY_KERNEL, STRATEGY_COPY]
+
+# hardlinks share one inode, so a later edit on either side changes both: only used when asked for
+AUTO_STRATEGIES = [STRATEGY_REFLINK, STRATEGY_KERNEL, STRATEGY_COPY]
+
+SKIP_SIZE = 'size'
+SKIP_HASH = 'hash'
+SKIP_NONE = 'none'
+SKIP_MODES = [SKIP_SIZE, SKIP_HASH, SKIP_NONE]
+
+# returned instead of a strategy name when the destination already matched
+UNCHANGED = 'unchanged'
+
+# errors meaning "this filesystem / kernel can't do that", where the next strategy should be tried
+_UNSUPPORTED = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.ENOSYS, errno.EINVAL, errno.EPERM,
+                errno.ENOTTY, errno.EBADF}
+
+
+def _file_hash(file):
+    digest = hashlib.sha1()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_unchanged(src_file, dest_file, mode=SKIP_SIZE):
+    if mode == SKIP_NONE:
+        return False
+    try:
+        src, dest = os.stat(src_file), os.stat(dest_file)
+    except FileNotFoundError:
+        return False
+    if (src.st_dev, src.st_ino) == (dest.st_dev, dest.st_ino):
+        return True
+    if src.st_size != dest.st_size:
+        return False
+    if mode == SKIP_HASH:
+        return _file_hash(src_file) == _file_hash(dest_file)
+    # every strategy but hardlink copies the source mtime over, so equal mtimes mean an earlier transfer
+    return int(src.st_mtime) == int(dest.st_mtime)
+
+
+def _hardlink(src_file, tmp_file):
+    os.link(src_file, tmp_file)
+
+
+def _reflink(src_file, tmp_file):
+    import fcntl  # not available on Windows, where this strategy never works anyway
+    with open(src_file, 'rb') as src, open(tmp_file, 'wb') as dest:
+        fcntl.ioctl(dest.fileno(), FICLONE, src.fileno())
+
+
+def _kernel_copy(src_file, tmp_file):
+    # the data never passes through userspace: copy_file_range can even reflink or copy server-side on NFS/SMB
+    copy = getattr(os, 'copy_file_range', None) or os.sendfile
+    with open(src_file, 'rb') as src, open(tmp_file, 'wb') as dest:
+        remaining = os.fstat(src.fileno()).st_size
+        offset = 0
+        while remaining > 0:
+            if copy is os.sendfile:
+                sent = os.sendfile(dest.fileno(), src.fileno(), offset, remaining)
+            else:
+                sent = copy(src.fileno(), dest.fileno(), remaining, offset)
+            if sent == 0:
+                break
+            offset += sent
+            remaining -= sent
+
+
+def _plain_copy(src_file, tmp_file):
+    shutil.copyfile(src_file, tmp_file)
+
+
+_TRANSFERS = {
+    STRATEGY_HARDLINK: _hardlink,
+    STRATEGY_REFLINK: _reflink,
+    STRATEGY_KERNEL: _kernel_copy,
+    STRATEGY_COPY: _plain_copy,
+}
+
+
+class FileTransfer:
+    # Moves one file per call with the first strategy the filesystem supports. Strategies that fail as unsupported
+    # are remembered and skipped for the rest of the run, so the fallback cost is paid once, not once per file.
+    def __init__(self, strategy=STRATEGY_AUTO, skip_unchanged=SKIP_SIZE):
+        self.strategies = AUTO_STRATEGIES if strategy == STRATEGY_AUTO else [strategy]
+        if strategy in [STRATEGY_HARDLINK, STRATEGY_REFLINK, STRATEGY_KERNEL]:
+            # still get the file across if the requested strategy can't be used here
+            self.strategies = [strategy, STRATEGY_COPY]
+        self.skip_unchanged = skip_unchanged
+        self._unsupported = set()
+
+    def transfer(self, src_file, dest_file):
+        # returns the strategy used, UNCHANGED, or None if the file could not be transferred
+        if is_unchanged(src_file=src_file, dest_file=dest_file, mode=self.skip_unchanged):
+            return UNCHANGED
+        dest_folder = os.path.dirname(dest_file)
+        if dest_folder:
+            os.makedirs(dest_folder, exist_ok=True)
+        # write next to the destination and swap it in, so Jellyfin never reads a half-written image
+        tmp_file = f"{dest_file}.{os.getpid()}-{threading.get_ident()}.tmp"
+        for strategy in self.strategies:
+            if strategy in self._unsupported:
+                continue
+            try:
+                _TRANSFERS[strategy](src_file, tmp_file)
+                if strategy != STRATEGY_HARDLINK:
+                    shutil.copystat(src_file, tmp_file)
+                os.replace(tmp_file, dest_file)
+                metrics.inc('bytes_transferred_total', os.path.getsize(dest_file), strategy=strategy)
+                return strategy
+            except OSError as e:
+                if os.path.lexists(tmp_file):
+                    os.remove(tmp_file)
+                if e.errno not in _UNSUPPORTED or strategy == STRATEGY_COPY:
+                    raise
+                self._unsupported.add(strategy)
+        return None
+
+
+def add_transfer_arguments(parser):
+    parser.add_argument('--transfer', choices=STRATEGIES, default=STRATEGY_AUTO,
+                        help="How to move image files: hardlink, reflink (copy-on-write clone), kernel "
+                             "(copy_file_range/sendfile) or a plain copy. auto tries reflink, then kernel, then copy "
+                             "(default: auto)")
+    parser.add_argument('--skip-unchanged', choices=SKIP_MODES, default=SKIP_SIZE,
+                        help="Skip images whose destination already matches, compared by size and modification time "
+                             "or by content hash (default: size)")
@@ -0,0 +1,140 @@
+import random
+import string
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class UserMapping:
+    # a Plex user and the Jellyfin user created for them by migrate_users.py
+    def __init__(self, username, plex_user, jellyfin_user_id):
+        self.username = username
+        self.plex_user = plex_user  # None for the Plex admin
+        self.jellyfin_user_id = jellyfin_user_id
+        # stable key to scope journal entries per user; the admin keeps unscoped keys
+        self.key = None if plex_user is None else str(plex_user.id)
+
+    @property
+    def is_admin(self):
+        return self.plex_user is None
+
+    def get_plex(self, plex):
+        if self.is_admin:
+            return plex
+        return plex.for_user(self.plex_user)
+
+
+def get_plex_username(plex_user):
+    return plex_user.username or plex_user.title
+
+
+def get_user_mappings(plex, jellyfin, include_admin=True, admin_username=None):
+    jellyfin_users = {user.name.casefold(): user for user in jellyfin.getUsers()}
+    mappings = []
+    if include_admin:
+        mappings.append(UserMapping(username=admin_username or jellyfin.username, plex_user=None,
+                                    jellyfin_user_id=jellyfin.user_id))
+    for plex_user in plex.get_users():
+        if not plex.user_has_server_access(user=plex_user):
+            continue
+        username = get_plex_username(plex_user)
+        jellyfin_user = jellyfin_users.get(username.casefold())
+        if not jellyfin_user:
+            print(f"No Jellyfin user named {username}, skipping (run migrate_users.py first)")
+            continue
+        mappings.append(UserMapping(username=username, plex_user=plex_user, jellyfin_user_id=jellyfin_user.id))
+    return mappings
+
+
+def password(length):
+    return ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(length))
+
+
+class ProvisionResult:
+    def __init__(self, username, success, user_id=None, password=None, reason=None):
+        self.username = username
+        self.success = success
+        self.user_id = user_id
+        self.password = password
+        self.reason = reason
+
+
+class UserProvisioner:
+    # Creates Jellyfin users on a bounded worker pool.
+    # Existing users are fetched once and kept in a dict keyed by case-folded name, so duplicate checks are O(1)
+    # and two workers never create the same user.
+    def __init__(self, jellyfin, workers=8, password_length=10, policy=None):
+        self.jellyfin = jellyfin
+        self.workers = workers
+        self.password_length = password_length
+        self.policy = policy or jellyfin.policy
+        self.existing = {user.name.casefold(): user.id for user in jellyfin.getUsers() if user.name}
+        self.credentials = {}
+        self._lock = threading.Lock()
+
+    def exists(self, username):
+        with self._lock:
+            return username.casefold() in self.existing
+
+    def _claim(self, username):
+        with self._lock:
+            key = username.casefold()
+            if key in self.existing:
+                return False
+            self.existing[key] = None
+            return True
+
+    def _add_password(self, uid):
+        pwd = password(length=self.password_length)
+        if self.jellyfin.resetPassword(userId=uid):
+            if self.jellyfin.setUserPassword(userId=uid, currentPass="", newPass=pwd):
+                return pwd
+        return None
+
+    def provision(self, username):
+        if not self._claim(username):
+            return ProvisionResult(username=username, success=False, reason="already exists")
+        try:
+            print(f"Adding {username} to Jellyfin...")
+            jellyfin_user, failure_msg = self.jellyfin.makeUser(username=username)
+            if not jellyfin_user:
+                with self._lock:
+                    self.existing.pop(username.casefold(), None)
+                return ProvisionResult(username=username, success=False, reason=failure_msg)
+            with self._lock:
+                self.existing[username.casefold()] = jellyfin_user.id
+            pwd = self._add_password(uid=jellyfin_user.id)
+            if not pwd:
+                print(f"Password update failed for {username}. Moving on...")
+            else:
+                with self._lock:
+                    self.credentials[username] = [jellyfin_user.id, pwd]
+            if self.jellyfin.updatePolicy(userId=jellyfin_user.id, policy=self.policy):
+                return ProvisionResult(username=username, success=True, user_id=jellyfin_user.id, password=pwd)
+            if pwd:
+                print(f"INFO: User created and password set, but policy update failed for {username}.")
+            return ProvisionResult(username=username, success=False, user_id=jellyfin_user.id, password=pwd,
+                                   reason="policy update failed")
+        except Exception as e:
+            print(f"Error provisioning {username}: {e}")
+            return ProvisionResult(username=username, success=False, reason=str(e))
+
+    def provision_all(self, usernames, on_result=None):
+        results = []
+
+        def run(username):
+            result = self.provision(username=username)
+            if on_result:
+                on_result(result)
+            return result
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results.extend(executor.map(run, usernames))
+        return results
+
+    def print_credentials(self):
+        with self._lock:
+            credentials = dict(self.credentials)
+        if credentials:
+            print("\nUsername ---- Password")
+            for k, v in credentials.items():
+                print(f"{k}  |  {v[1]}")
@@ -3,24 +3,42 @@
 """
 This script will make a Jellyfin playlist for each playlist on your Plex Media Server.
 Every item on each Plex playlist will be located and added to the new Jellyfin playlist.
+If a Jellyfin playlist with the same name already exists, only the items it is missing are added.
+With --all-users, each Plex user's own playlists are migrated to the Jellyfin user with the same name.
+With --incremental, finished playlists are only synced again once they change on Plex or Jellyfin gets new items.
 """
 
+import helpers.clients as cl
+import helpers.config as cfg
 import helpers.jellyfin as jf
-import helpers.plex as px
-import creds as settings
+import helpers.fuzzy as fz
+import helpers.incremental as inc
+import helpers.journal as jnl
+import helpers.match_cache as mc
+import helpers.metrics as mtr
+import helpers.plan as pln
+import helpers.users as usr
 from progress.bar import Bar
 import sys
 import signal
 import time
+import threading
+import argparse
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
-plex = px.Plex(url=settings.PLEX_URL,
-               token=settings.PLEX_TOKEN,
-               server_name=settings.PLEX_SERVER_NAME)
-jellyfin = jf.Jellyfin(url=settings.JELLYFIN_URL,
-                       api_key=settings.JELLYFIN_API_KEY,
-                       username=settings.JELLYFIN_ADMIN_USERNAME,
-                       password=settings.JELLYFIN_ADMIN_PASSWORD,
-                       default_policy=settings.JELLYFIN_USER_POLICY)
+# set by run()
+plex = None
+jellyfin = None
+journal = None
+plan = None
+changes = None
+match_stats = None
+match_cache = None
+fuzzy_threshold = fz.DEFAULT_THRESHOLD
+
+# Plex item types that can be on a playlist
+PLAYLIST_TYPES = ['movie', 'episode', 'track']
 
 
 def signal_handler(signum, frame):
@@ -28,26 +46,204 @@ def signal_handler(signum, frame):
     exit()
 
 
-if __name__ == '__main__':
-    signal.signal(signal.SIGINT, signal_handler)
-    print("Beginning playlist migration...")
-    for plex_playlist in plex.get_playlists():
+def get_missing_items(item_ids, existing_item_ids):
+    # keep the Plex order, and allow an item to appear on a playlist more than once
+    remaining = Counter(existing_item_ids)
+    missing = []
+    for item_id in item_ids:
+        if remaining[item_id]:
+            remaining[item_id] -= 1
+        else:
+            missing.append(item_id)
+    return missing
+
+
+def match_playlist_items(plex_playlist, show_progress=True):
+    itemList = []
+    plex_items = plex_playlist.items()
+    bar = Bar(f'Matching Plex items on Jellyfin', max=len(plex_items)) if show_progress else None
+    for plex_item in plex_items:
+        jellyfin_item = jellyfin.findPlexItemOnJellyfin(plex_item=plex_item, stats=match_stats,
+                                                        match_cache=match_cache, fuzzy_threshold=fuzzy_threshold)
+        if jellyfin_item:
+            itemList.append(jellyfin_item.id)
+        if bar:
+            bar.next()
+    if bar:
+        bar.finish()
+    return itemList
+
+
+def migrate_playlists(user_plex, user_id=None, user_journal=None, chunk_size=jf.PLAYLIST_CHUNK_SIZE,
+                      show_progress=True, label=''):
+    user_journal = user_journal or journal
+    user_changes = changes.scoped(user_journal)
+    # Plex has no server-side filter for playlists, but they all come back in one request with their updatedAt
+    since = user_changes.since('updatedAt')
+    jellyfin_playlists = {playlist.name: playlist for playlist in jellyfin.getPlaylists(userId=user_id)}
+    for plex_playlist in user_plex.get_playlists():
         # print(playlist.title)
-        jellyfin_playlist = jellyfin.makePlaylist(name=plex_playlist.title)
+        playlist_key = f'playlist/{plex_playlist.ratingKey}'
+        user_changes.seen('updatedAt', plex_playlist.updatedAt)
+        changed = since is not None and (user_changes.jellyfin_changed or
+                                         (plex_playlist.updatedAt is not None and plex_playlist.updatedAt > since))
+        if user_journal.is_done(playlist_key) and not changed:
+            print(f'{label}"{plex_playlist.title}" already migrated, skipping')
+            continue
+        # reuse the Jellyfin playlist from an earlier run instead of creating a duplicate
+        jellyfin_playlist_id, _ = user_journal.get(playlist_key)
+        if jellyfin_playlist_id:
+            jellyfin_playlist = jf.JellyfinPlaylist(data={'Id': jellyfin_playlist_id, 'Name': plex_playlist.title})
+        else:
+            jellyfin_playlist = jellyfin_playlists.get(plex_playlist.title)
+        existing_items = []
+        if jellyfin_playlist:
+            try:
+                existing_items = [item.id for item in jellyfin.getPlaylistItems(playlistId=jellyfin_playlist.id,
+                                                                                userId=user_id)]
+            except jf.IncompleteListError as e:
+                # without the full list every item on a missing page would be added a second time
+                print(f'{label}Skipping "{plex_playlist.title}": {e}')
+                user_journal.record(key=playlist_key, outcome=jnl.OUTCOME_FAILED, jellyfin_id=jellyfin_playlist.id)
+                continue
+        if plan:
+            itemList = match_playlist_items(plex_playlist=plex_playlist, show_progress=show_progress)
+            missing_items = get_missing_items(item_ids=itemList, existing_item_ids=existing_items)
+            plan.add(pln.ACTION_SYNC_PLAYLIST, user_id=user_id, name=plex_playlist.title,
+                     playlist_id=jellyfin_playlist.id if jellyfin_playlist else None, item_ids=missing_items,
+                     journal_key=user_journal.key(playlist_key))
+            print(f'{label}Planned {len(missing_items)} of {len(itemList)} matched items for '
+                  f'"{plex_playlist.title}"{"" if jellyfin_playlist else " (new playlist)"}')
+            continue
+        if not jellyfin_playlist:
+            jellyfin_playlist = jellyfin.makePlaylist(name=plex_playlist.title, userId=user_id)
         if jellyfin_playlist:
-            print(f'Migrating "{plex_playlist.title}"...')
-            itemList = []
-            plex_items = plex_playlist.items()
-            bar = Bar(f'Matching Plex items on Jellyfin', max=len(plex_items))
-            for plex_item in plex_items:
-                jellyfin_item = jellyfin.findPlexItemOnJellyfin(plex_item=plex_item)
-                if jellyfin_item:
-                    itemList.append(jellyfin_item.id)
-                bar.next()
-            bar.finish()
-            print(f"Adding {len(itemList)} matched items to {plex_playlist.title} on Jellyfin...")
-            jellyfin.addToPlaylist(playlistId=jellyfin_playlist.id, itemIds=itemList)
-            print(f'"{plex_playlist.title}" complete.')
+            user_journal.record(key=playlist_key, outcome=jnl.OUTCOME_FAILED, jellyfin_id=jellyfin_playlist.id)
+            print(f'{label}Migrating "{plex_playlist.title}"...')
+            itemList = match_playlist_items(plex_playlist=plex_playlist, show_progress=show_progress)
+            missing_items = get_missing_items(item_ids=itemList, existing_item_ids=existing_items)
+            print(f"{label}Adding {len(missing_items)} of {len(itemList)} matched items to {plex_playlist.title} "
+                  f"on Jellyfin...")
+            if not missing_items or jellyfin.addToPlaylist(playlistId=jellyfin_playlist.id, itemIds=missing_items,
+                                                           chunk_size=chunk_size, userId=user_id):
+                user_journal.record(key=playlist_key, outcome=jnl.OUTCOME_SUCCESS, jellyfin_id=jellyfin_playlist.id)
+                print(f'{label}"{plex_playlist.title}" complete.')
+            else:
+                print(f'{label}Could not add all items to "{plex_playlist.title}"')
         else:
-            print(f'Could not migrate "{plex_playlist.title}"')
-    print("Playlist migration complete.")
+            print(f'{label}Could not migrate "{plex_playlist.title}"')
+    user_changes.save()
+
+
+def apply_playlist_action(action, chunk_size):
+    # no matching here: the plan already holds the Jellyfin IDs of the items each playlist is missing
+    playlist_id = action['playlist_id']
+    if not playlist_id:
+        jellyfin_playlist = jellyfin.makePlaylist(name=action['name'], userId=action['user_id'])
+        if not jellyfin_playlist:
+            print(f'Could not migrate "{action["name"]}"')
+            return
+        playlist_id = jellyfin_playlist.id
+        journal.record(key=action['journal_key'], outcome=jnl.OUTCOME_FAILED, jellyfin_id=playlist_id)
+    if not action['item_ids'] or jellyfin.addToPlaylist(playlistId=playlist_id, itemIds=action['item_ids'],
+                                                        chunk_size=chunk_size, userId=action['user_id']):
+        journal.record(key=action['journal_key'], outcome=jnl.OUTCOME_SUCCESS, jellyfin_id=playlist_id)
+        print(f'"{action["name"]}" complete, added {len(action["item_ids"])} items.')
+    else:
+        print(f'Could not add all items to "{action["name"]}"')
+
+
+def apply_plan(actions, chunk_size, workers):
+    actions = [action for action in actions if action['action'] == pln.ACTION_SYNC_PLAYLIST]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(lambda action: apply_playlist_action(action=action, chunk_size=chunk_size), actions))
+
+
+def migrate_user_playlists(user, chunk_size):
+    # runs on a worker thread: one user's Plex playlists, read with their token and written to their Jellyfin user
+    try:
+        migrate_playlists(user_plex=user.get_plex(plex), user_id=user.jellyfin_user_id,
+                          user_journal=journal.scoped(user.key), chunk_size=chunk_size, show_progress=False,
+                          label=f'[{user.username}] ')
+    except Exception as e:
+        print(f"Could not migrate playlists for {user.username}: {e}")
+        return False
+    return True
+
+
+def add_arguments(parser):
+    parser.add_argument('--match-report', type=str, required=False,
+                        help="Write a CSV of how each Plex item was matched on Jellyfin to this file")
+    parser.add_argument('--chunk-size', type=int, default=jf.PLAYLIST_CHUNK_SIZE,
+                        help=f"How many items to add to a Jellyfin playlist per request "
+                             f"(default: {jf.PLAYLIST_CHUNK_SIZE})")
+    parser.add_argument('--all-users', action='store_true',
+                        help="Migrate the playlists of every Plex user with server access to their Jellyfin user, "
+                             "not just the admin's")
+    parser.add_argument('--user-workers', type=int, default=8,
+                        help="How many users to migrate at once with --all-users (default: 8)")
+    jnl.add_journal_arguments(parser)
+    jnl.add_incremental_arguments(parser)
+    mc.add_match_cache_arguments(parser)
+    fz.add_fuzzy_arguments(parser)
+    pln.add_plan_arguments(parser)
+
+
+def run(args, clients):
+    global plex, jellyfin, journal, plan, changes, match_stats, match_cache, fuzzy_threshold
+    jellyfin = clients.jellyfin
+    journal = jnl.open_journal(migration='playlists', args=args)
+
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGINT, signal_handler)
+    if args.apply:
+        print(f"Applying playlist plan {args.apply}...")
+        apply_plan(actions=pln.read_plan(file=args.apply, migration='playlists'), chunk_size=args.chunk_size,
+                   workers=args.user_workers)
+        journal.close()
+        print("Playlist migration complete.")
+        return
+
+    plex = clients.plex
+    plan = pln.open_plan(migration='playlists', args=args)
+    print("Beginning playlist migration...")
+    match_cache = mc.open_match_cache(jellyfin=jellyfin, args=args)
+    fuzzy_threshold = args.fuzzy_threshold
+    match_stats = jf.MatchStats(audit=bool(args.match_report))
+    jellyfin.buildLibraryIndex(plex_types=PLAYLIST_TYPES, lazy=match_cache is not None)
+    jellyfin_changed, jellyfin_newest = inc.check_jellyfin(jellyfin=jellyfin, journal=journal,
+                                                           incremental=args.incremental)
+    changes = inc.ChangeTracker(journal=journal, incremental=args.incremental, jellyfin_changed=jellyfin_changed)
+    success = True
+    if args.all_users:
+        users = usr.get_user_mappings(plex=plex, jellyfin=jellyfin,
+                                      admin_username=clients.settings.JELLYFIN_ADMIN_USERNAME)
+        with ThreadPoolExecutor(max_workers=args.user_workers) as executor:
+            success = all(list(executor.map(
+                lambda user: migrate_user_playlists(user=user, chunk_size=args.chunk_size), users)))
+    else:
+        migrate_playlists(user_plex=plex, chunk_size=args.chunk_size)
+    if success:
+        inc.save_jellyfin_mark(journal=journal, newest=jellyfin_newest)
+    match_stats.print_summary()
+    if args.match_report:
+        match_stats.write_audit(file=args.match_report)
+    journal.close()
+    if plan:
+        plan.close()
+        plan.print_summary()
+    if not success:
+        print("Could not migrate the playlists of every user, see above.")
+        exit(1)
+    if not plan:
+        print("Playlist migration complete.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    cfg.add_config_arguments(parser)
+    mtr.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    run(args=args, clients=cl.Clients(settings=cfg.load_settings(file=args.config)))
+    mtr.write_metrics(args)
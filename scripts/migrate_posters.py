@@ -11,17 +11,38 @@ NOTES:
     path (helpful if you are running Plex and Jellyfin as Docker containers). If there is no translation needed, simply
     make the app and system paths the same.
     - You can indicate only specific library types (movies, shows, music) to migrate. Use the -h flag to see details.
-    - A Plex item's Jellyfin counterpart is found by searching title and year. Warning, this may produce false results.
+    - Plex's metadata bundles are scanned once at startup (in parallel) to find each item's images.
+    - Plex enumeration, matching and file copying run as a pipeline of worker threads. Use --match-workers and
+    --copy-workers to tune how many threads run each stage.
+    - A Plex item's Jellyfin counterpart is found by its IMDb/TMDb/TVDb/MusicBrainz IDs, falling back to title, year
+    and parent titles, in an index of the Jellyfin library built once at startup. Title matches may produce false
+    results; use --match-report to review how each item was matched.
+    - When Plex and Jellyfin data share a filesystem, --transfer hardlink or reflink avoids copying image bytes at
+    all. Images already at the destination are skipped (--skip-unchanged), so re-runs do very little I/O.
+    - With --upload, images are streamed from Plex (optionally downscaled with --max-size) to Jellyfin's image API
+    instead, so the script can run anywhere and Jellyfin picks the new artwork up straight away.
+    - With --incremental, only the items added or changed on Plex since the last incremental run are enumerated,
+    plus the ones whose images failed before (or went unmatched, once Jellyfin has new items).
 -
 """
-import hashlib
 import os
-import shutil
 import argparse
+import itertools
+import threading
+from collections import Counter, namedtuple
 
+import helpers.clients as cl
+import helpers.config as cfg
 import helpers.jellyfin as jf
-import helpers.plex as px
-import creds as settings
+import helpers.fuzzy as fz
+import helpers.bundles as bnd
+import helpers.incremental as inc
+import helpers.pipeline as pl
+import helpers.journal as jnl
+import helpers.match_cache as mc
+import helpers.metrics as mtr
+import helpers.plan as pln
+import helpers.transfer as xfer
 
 # EDIT THE PATH TRANSLATIONS BELOW
 
@@ -51,14 +72,28 @@ path_translations = {
 
 # DO NOT EDIT BELOW THIS LINE
 
-plex = px.Plex(url=settings.PLEX_URL,
-               token=settings.PLEX_TOKEN,
-               server_name=settings.PLEX_SERVER_NAME)
-jellyfin = jf.Jellyfin(url=settings.JELLYFIN_URL,
-                       api_key=settings.JELLYFIN_API_KEY,
-                       username=settings.JELLYFIN_ADMIN_USERNAME,
-                       password=settings.JELLYFIN_ADMIN_PASSWORD,
-                       default_policy=settings.JELLYFIN_USER_POLICY)
+# set by run()
+plex = None
+jellyfin = None
+options = None
+journal = None
+plan = None
+tally = None
+transfer = None
+bundle_indexes = {}
+changes = None
+match_stats = None
+match_cache = None
+# with --incremental after a first run: every enumerated item changed, so its images are redone
+only_changed = False
+
+# --libraries choice --> Plex item types whose images are migrated
+LIBRARY_TYPES = {
+    'movies': ['movie'],
+    'shows': ['show', 'season', 'episode'],
+    'music': ['artist', 'album'],
+}
+
 # { Media Type: {Plex, Jellyfin}}
 metadata_translations = {
     'movie': {
@@ -66,15 +101,15 @@ metadata_translations = {
         'Jellyfin': '/data/metadata/library'
     },
     'episode': {
-        'Plex': r'/Library/Application Support/Plex Media Server/Metadata/TV\ Shows',
+        'Plex': r'/Library/Application Support/Plex Media Server/Metadata/TV Shows',
         'Jellyfin': '/data/metadata/library'
     },
     'show': {
-        'Plex': r'/Library/Application Support/Plex Media Server/Metadata/TV\ Shows',
+        'Plex': r'/Library/Application Support/Plex Media Server/Metadata/TV Shows',
         'Jellyfin': '/data/metadata/library'
     },
     'season': {
-        'Plex': r'/Library/Application Support/Plex Media Server/Metadata/TV\ Shows',
+        'Plex': r'/Library/Application Support/Plex Media Server/Metadata/TV Shows',
         'Jellyfin': '/data/metadata/library'
     },
     'artist': {
@@ -88,8 +123,9 @@ metadata_translations = {
 }
 
 
-def sha1(text):
-    return hashlib.sha1(text.encode()).hexdigest()
+# one poster or backdrop to move; dest_file is None when the image is uploaded through the Jellyfin API
+ImageJob = namedtuple('ImageJob', ['rating_key', 'jellyfin_id', 'title', 'item_type', 'image_type', 'source', 'src',
+                                   'dest_file'])
 
 
 def local_to_global_path(local_path, server_type, folder_type):
@@ -106,10 +142,8 @@ def global_to_local_path(global_path, server_type, folder_type):
     return global_path
 
 
-def get_plex_metadata_folder(plex_item, item_type):
-    guid = plex_item.guid
-    metadata_id = sha1(guid)
-    return f"{list(path_translations['plex']['App Data'].keys())[0]}{metadata_translations[item_type]['Plex']}/{metadata_id[0]}/{metadata_id[1:]}.bundle"
+def get_plex_metadata_root(folder):
+    return f"{list(path_translations['plex']['App Data'].keys())[0]}{folder}"
 
 
 def get_jellyfin_metadata_folder(jellyfin_item, item_type):
@@ -117,20 +151,12 @@ def get_jellyfin_metadata_folder(jellyfin_item, item_type):
     return f"{list(path_translations['jellyfin']['App Data'].keys())[0]}{metadata_translations[item_type]['Jellyfin']}/{jellyfin_id[:2]}/{jellyfin_id}"
 
 
-def get_plex_image_folder(folder, image_type):
-    if image_type == 'poster':
-        return f"{folder}/posters"
-    elif image_type == 'backdrop':
-        return f"{folder}/art"
-
-
 def get_plex_item_title(plex_item, item_type):
     title = ""
     if item_type == 'movie':
         title = f"{plex_item.title} ({plex_item.year})"
     elif item_type == 'show':
-        season_one = plex_item.seasons()[0]
-        title = f"{season_one.parentTitle}"
+        title = f"{plex_item.title}"
     if item_type == 'season':
         title = f"{plex_item.parentTitle} - Season {plex_item.index}"
     elif item_type == 'episode':
@@ -145,15 +171,21 @@ def get_plex_item_title(plex_item, item_type):
 
 
 def get_plex_file(plex_item, item_type, file_type):
-    try:
-        folder = f"{get_plex_metadata_folder(plex_item=plex_item, item_type=item_type)}/Contents/_stored"
-        folder = get_plex_image_folder(folder=folder, image_type=file_type)
-        folder = local_to_global_path(local_path=folder, server_type='plex', folder_type='App Data')
-        picture_file = os.listdir(folder)[0]
-        return picture_file
-    except Exception as e:
-        print(f"{e}")
-    return None
+    return bundle_indexes[metadata_translations[item_type]['Plex']].get(guid=plex_item.guid, image_type=file_type)
+
+
+def build_bundle_indexes(item_types):
+    # one scan per Plex Metadata folder (shows, seasons and episodes all live under "TV Shows")
+    indexes = {}
+    for item_type in item_types:
+        folder = metadata_translations[item_type]['Plex']
+        if folder not in indexes:
+            root = local_to_global_path(local_path=get_plex_metadata_root(folder=folder), server_type='plex',
+                                        folder_type='App Data')
+            print(f"Indexing Plex metadata bundles in {root}...")
+            indexes[folder] = bnd.BundleIndex(root=root).build()
+            print(f"Found images for {len(indexes[folder])} Plex items.")
+    return indexes
 
 
 def get_jellyfin_image_file(folder, image_type):
@@ -179,92 +211,279 @@ def file_exists(file):
 
 
 def copy_file(src_file, dest_file):
+    # returns how the file was transferred (or that it was already up to date), None on failure
     try:
         if not src_file or not file_exists(src_file):
-            return False
-        shutil.copy(src=src_file, dst=dest_file)
-        return True
+            return None
+        return transfer.transfer(src_file=src_file, dest_file=dest_file)
     except Exception as e:
         print(f"{e}")
-    return False
+    return None
 
 
-def move_images_to_jellyfin(plex_item, plex_item_type):
+def open_bundle_image(file):
+    f = open(file, 'rb')
+    return f, jf.sniff_image_type(f.peek(16)[:16])
+
+
+def get_image_source(plex_item, item_type, image_type):
+    # what the transfer stage reads: a Plex thumb/art key when uploading from the server, otherwise a bundle file
+    if options.upload and options.image_source == 'plex':
+        return plex_item.thumb if image_type == 'poster' else plex_item.art
+    return get_plex_file(plex_item=plex_item, item_type=item_type, file_type=image_type)
+
+
+def match_images(plex_item, plex_item_type):
+    # matching stage: find the Jellyfin item and resolve the source and destination image files
+    tally.add(item_type=plex_item_type, key='items')
+    image_types = []
+    for image_type in ['poster', 'backdrop']:
+        if not only_changed and journal.is_done(f'{plex_item.ratingKey}/{image_type}'):
+            tally.add(item_type=plex_item_type, key=image_type)
+        else:
+            image_types.append(image_type)
+    if not image_types:
+        tally.add(item_type=plex_item_type, key='matched')
+        return []
     title = get_plex_item_title(plex_item=plex_item, item_type=plex_item_type)
-    jellyfin_item = jellyfin.findPlexItemOnJellyfin(plex_item=plex_item, title=title)
-    if jellyfin_item:
-        print(f"Plex: {title} --> Jellyfin: {jellyfin_item.name}")
-        plex_poster = get_plex_file(plex_item=plex_item, item_type=plex_item_type, file_type='poster')
-        plex_backdrop = get_plex_file(plex_item=plex_item, item_type=plex_item_type, file_type='backdrop')
-        jellyfin_poster = get_jellyfin_file(jellyfin_item=jellyfin_item, image_type='poster', item_type=plex_item_type)
-        jellyfin_backdrop = get_jellyfin_file(jellyfin_item=jellyfin_item, image_type='backdrop',
-                                              item_type=plex_item_type)
-        if not plex_poster and not plex_backdrop:
-            print(f"Neither poster and backdrop exists for this item.")
-            return False
-        success = True
-        if not copy_file(plex_poster, jellyfin_poster):
-            success = False
-            print(f"Couldn't migrate poster.")
-        if not copy_file(plex_backdrop, jellyfin_backdrop):
-            success = False
-            print(f"Couldn't migrate backdrop.")
-        return success
-    else:
+    jellyfin_item = jellyfin.findPlexItemOnJellyfin(plex_item=plex_item, title=title, stats=match_stats,
+                                                    match_cache=match_cache, fuzzy_threshold=options.fuzzy_threshold)
+    if not jellyfin_item:
         print(f"Could not locate {title} on Jellyfin to migrate metadata.")
-    return False
-
-
-def migration_success_message(success_count, item_count, section_type):
-    print(f"Successfully migrated metadata for {success_count} of {item_count} {section_type}s")
-
-
-parser = argparse.ArgumentParser()
-parser.add_argument('--libraries', '-l', choices=['movies', 'shows', 'music'], nargs='+', required=False,
-                    help="What types of libraries to include in the migration (movies, shows, music)")
-args = parser.parse_args()
-
-if not args.libraries:
-    args.libraries = ['movies', 'shows', 'music']
-
-for section in plex.get_library_sections():
-    if section.type in ['movie'] and 'movies' in args.libraries:
-        movie_count = 0
-        all_movies = plex.get_all_section_items(section=section)
-        for movie in all_movies:
-            if move_images_to_jellyfin(plex_item=movie, plex_item_type='movie'):
-                movie_count += 1
-        migration_success_message(success_count=movie_count, item_count=len(all_movies), section_type='movie')
-    if section.type in ['show'] and 'shows' in args.libraries:
-        all_shows = plex.get_all_section_items(section=section)
-        show_count = 0
-        for show in all_shows:
-            if move_images_to_jellyfin(plex_item=show, plex_item_type='show'):
-                show_count += 1
-            all_seasons = show.seasons()
-            season_count = 0
-            for season in all_seasons:
-                if move_images_to_jellyfin(plex_item=season, plex_item_type='season'):
-                    season_count += 1
-                all_episodes = season.episodes()
-                episode_count = 0
-                for episode in all_episodes:
-                    if move_images_to_jellyfin(plex_item=episode, plex_item_type='episode'):
-                        episode_count += 1
-                migration_success_message(success_count=episode_count, item_count=len(all_episodes),
-                                          section_type='episode')
-            migration_success_message(success_count=season_count, item_count=len(all_seasons), section_type='season')
-        migration_success_message(success_count=show_count, item_count=len(all_shows), section_type='show')
-    if section.type in ['artist'] and 'music' in args.libraries:
-        all_artists = plex.get_all_section_items(section=section)
-        artist_count = 0
-        for artist in all_artists:
-            if move_images_to_jellyfin(plex_item=artist, plex_item_type='artist'):
-                artist_count += 1
-            all_albums = artist.albums()
-            album_count = 0
-            for album in all_albums:
-                if move_images_to_jellyfin(plex_item=album, plex_item_type='album'):
-                    album_count += 1
-            migration_success_message(success_count=album_count, item_count=len(all_albums), section_type='album')
-        migration_success_message(success_count=artist_count, item_count=len(all_artists), section_type='artist')
+        for image_type in image_types:
+            journal.record(key=f'{plex_item.ratingKey}/{image_type}', outcome=jnl.OUTCOME_UNMATCHED)
+        return []
+    print(f"Plex: {title} --> Jellyfin: {jellyfin_item.name}")
+    tally.add(item_type=plex_item_type, key='matched')
+    jobs = []
+    for image_type in image_types:
+        src = get_image_source(plex_item=plex_item, item_type=plex_item_type, image_type=image_type)
+        if not src:
+            continue
+        dest_file = None
+        if not options.upload:
+            dest_file = get_jellyfin_file(jellyfin_item=jellyfin_item, image_type=image_type,
+                                          item_type=plex_item_type)
+        jobs.append(ImageJob(rating_key=plex_item.ratingKey, jellyfin_id=jellyfin_item.id, title=title,
+                             item_type=plex_item_type, image_type=image_type,
+                             source=options.image_source if options.upload else 'bundle', src=src, dest_file=dest_file))
+    if not jobs:
+        print(f"Neither poster and backdrop exists for {title}.")
+    return jobs
+
+
+def upload_image(job):
+    # returns 'upload' on success, None on failure
+    try:
+        if job.source == 'plex':
+            open_image = lambda: plex.open_image(path=job.src, max_size=options.max_size)
+        else:
+            if not file_exists(job.src):
+                return None
+            open_image = lambda: open_bundle_image(job.src)
+        if jellyfin.uploadImage(itemId=job.jellyfin_id, imageType=jf.JELLYFIN_IMAGE_TYPES[job.image_type],
+                                open_image=open_image):
+            return 'upload'
+    except Exception as e:
+        print(f"{e}")
+    return None
+
+
+def transfer_image(job):
+    # transfer stage: runs on its own worker pool so slow storage or uploads don't hold up matching
+    if job.dest_file is None:
+        method = upload_image(job)
+    else:
+        method = copy_file(job.src, job.dest_file)
+    success = method is not None
+    if success:
+        tally.add_file(method=method)
+    journal.record_result(key=f'{job.rating_key}/{job.image_type}', success=success, jellyfin_id=job.jellyfin_id)
+    if success:
+        tally.add(item_type=job.item_type, key=job.image_type)
+    else:
+        print(f"Couldn't migrate {job.image_type} for {job.title}.")
+
+
+def plan_image(job):
+    # planning stage: takes the place of the transfer stage and records the copy or upload instead of making it
+    action = pln.ACTION_COPY_IMAGE if job.dest_file else pln.ACTION_UPLOAD_IMAGE
+    plan.add(action, **job._asdict())
+
+
+def iter_planned_images(actions):
+    for action in actions:
+        if action['action'] in [pln.ACTION_COPY_IMAGE, pln.ACTION_UPLOAD_IMAGE]:
+            yield ImageJob(**{field: action[field] for field in ImageJob._fields})
+
+
+def enumerate_plex_items(libraries, since=None):
+    # stream each level of the library directly rather than walking show.seasons() / artist.albums() per item
+    for section in plex.get_library_sections():
+        if section.type in ['movie'] and 'movies' in libraries:
+            for movie in plex.iter_section_items(section=section, libtype='movie', since=since):
+                yield movie, 'movie'
+        if section.type in ['show'] and 'shows' in libraries:
+            for libtype in ['show', 'season', 'episode']:
+                for item in plex.iter_section_items(section=section, libtype=libtype, since=since):
+                    yield item, libtype
+        if section.type in ['artist'] and 'music' in libraries:
+            for libtype in ['artist', 'album']:
+                for item in plex.iter_section_items(section=section, libtype=libtype, since=since):
+                    yield item, libtype
+
+
+def iter_retry_items(libraries):
+    # items with a poster or backdrop to retry, from journal keys like "<ratingKey>/poster"
+    item_types = [t for library in libraries for t in LIBRARY_TYPES[library]]
+    rating_keys = sorted({key.split('/')[0] for key in changes.retry_keys() if key.split('/')[0].isdigit()})
+    for plex_item in plex.fetch_items(rating_keys=rating_keys) if rating_keys else []:
+        if plex_item.type in item_types:
+            yield plex_item, plex_item.type
+
+
+def enumerate_changed_items(libraries, since):
+    rating_keys = set()
+    items = enumerate_plex_items(libraries=libraries, since=since)
+    if since is not None:
+        items = itertools.chain(items, iter_retry_items(libraries=libraries))
+    for plex_item, item_type in items:
+        if plex_item.ratingKey in rating_keys:
+            continue
+        rating_keys.add(plex_item.ratingKey)
+        changes.seen('updatedAt', plex_item.updatedAt)
+        yield plex_item, item_type
+
+
+class MigrationTally:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = {}
+        self.files = Counter()
+
+    def add_file(self, method):
+        with self._lock:
+            self.files[method] += 1
+
+    def add(self, item_type, key):
+        with self._lock:
+            self.counts.setdefault(item_type, Counter())[key] += 1
+
+    def print_summary(self):
+        if self.files:
+            print("Image files: " + ", ".join(f"{count} {method}" for method, count in sorted(self.files.items())))
+        for item_type, counts in self.counts.items():
+            print(f"Successfully migrated {counts['poster']} posters and {counts['backdrop']} backdrops "
+                  f"for {counts['matched']} of {counts['items']} {item_type}s")
+
+
+def match_types(args):
+    # Plex item types this migration enumerates and matches on Jellyfin
+    if args.apply:
+        return []
+    return [t for library in (args.libraries or LIBRARY_TYPES.keys()) for t in LIBRARY_TYPES[library]]
+
+
+def add_arguments(parser):
+    parser.add_argument('--libraries', '-l', choices=list(LIBRARY_TYPES.keys()), nargs='+', required=False,
+                        help="What types of libraries to include in the migration (movies, shows, music)")
+    parser.add_argument('--match-report', type=str, required=False,
+                        help="Write a CSV of how each Plex item was matched on Jellyfin to this file")
+    parser.add_argument('--match-workers', type=int, default=4,
+                        help="How many threads match Plex items on Jellyfin and resolve image files (default: 4)")
+    parser.add_argument('--copy-workers', type=int, default=8,
+                        help="How many threads copy or upload image files (default: 8)")
+    parser.add_argument('--upload', action='store_true',
+                        help="Upload images through the Jellyfin API instead of copying files into its metadata folder. "
+                             "Jellyfin path translations are not needed")
+    parser.add_argument('--image-source', choices=['plex', 'bundle'], default='plex',
+                        help="Where --upload reads images from: streamed from the Plex server, or the local Plex "
+                             "metadata bundle (default: plex)")
+    parser.add_argument('--max-size', type=int, default=None,
+                        help="With --upload from the Plex server, have Plex downscale images to fit within this many "
+                             "pixels and re-encode them as JPEG before sending")
+    parser.add_argument('--queue-size', type=int, default=100,
+                        help="Maximum number of items waiting between pipeline stages (default: 100)")
+    xfer.add_transfer_arguments(parser)
+    jnl.add_journal_arguments(parser)
+    jnl.add_incremental_arguments(parser)
+    mc.add_match_cache_arguments(parser)
+    fz.add_fuzzy_arguments(parser)
+    pln.add_plan_arguments(parser)
+
+
+def run(args, clients):
+    global plex, jellyfin, options, journal, plan, tally, transfer, bundle_indexes, changes, \
+        only_changed, match_stats, match_cache
+    options = args
+    plex = clients.plex
+    jellyfin = clients.jellyfin
+    plan = None
+    journal = jnl.open_journal(migration='posters', args=args)
+    tally = MigrationTally()
+    transfer = xfer.FileTransfer(strategy=args.transfer, skip_unchanged=args.skip_unchanged)
+    # one pooled connection to Jellyfin per transfer worker, for uploads
+    jellyfin.setPoolSize(max(jellyfin.pool_size, args.copy_workers))
+
+    if args.apply:
+        # the plan already holds resolved sources and destinations, so only the transfer stage runs
+        pipeline = pl.Pipeline(queue_size=args.queue_size)
+        pipeline.add_stage(name='transfer', func=transfer_image, workers=args.copy_workers)
+        pipeline.run(source=iter_planned_images(actions=pln.read_plan(file=args.apply, migration='posters')))
+        journal.close()
+        tally.print_summary()
+        return
+
+    plan = pln.open_plan(migration='posters', args=args)
+
+    match_cache = mc.open_match_cache(jellyfin=jellyfin, args=args)
+    match_stats = jf.MatchStats(audit=bool(args.match_report))
+    library_index = jellyfin.buildLibraryIndex(plex_types=match_types(args), lazy=match_cache is not None)
+
+    bundle_indexes = {}
+    if not (args.upload and args.image_source == 'plex'):
+        bundle_indexes = build_bundle_indexes(item_types=match_types(args))
+
+    jellyfin_changed, jellyfin_newest = inc.check_jellyfin(jellyfin=jellyfin, journal=journal,
+                                                           incremental=args.incremental)
+    changes = inc.ChangeTracker(journal=journal, incremental=args.incremental, jellyfin_changed=jellyfin_changed)
+    since = changes.since('updatedAt')
+    only_changed = since is not None
+
+    pipeline = pl.Pipeline(queue_size=args.queue_size)
+    pipeline.add_stage(name='match', func=lambda job: match_images(plex_item=job[0], plex_item_type=job[1]),
+                       workers=args.match_workers)
+    if plan:
+        pipeline.add_stage(name='plan', func=plan_image, workers=1)
+    else:
+        pipeline.add_stage(name='transfer', func=transfer_image, workers=args.copy_workers)
+    complete = pipeline.run(source=enumerate_changed_items(libraries=args.libraries or list(LIBRARY_TYPES.keys()),
+                                                           since=since))
+    # items never enumerated on Plex or Jellyfin must come up again on the next incremental run
+    complete = complete and library_index.complete
+    if complete:
+        changes.save()
+        inc.save_jellyfin_mark(journal=journal, newest=jellyfin_newest)
+    journal.close()
+    if not plan:
+        tally.print_summary()
+
+    match_stats.print_summary()
+    if args.match_report:
+        match_stats.write_audit(file=args.match_report)
+    if plan:
+        plan.close()
+        plan.print_summary()
+    if not complete:
+        print("Could not enumerate every item, the next incremental run will pick the rest up.")
+        exit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    cfg.add_config_arguments(parser)
+    mtr.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    run(args=args, clients=cl.Clients(settings=cfg.load_settings(file=args.config)))
+    mtr.write_metrics(args)
@@ -1,63 +1,194 @@
 #!/usr/bin/env python3
 
 """
-This script will grab each movie or music track on your Plex Media Server with a custom user rating, and add the
-rating on the corresponding item on Jellyfin.
+This script will grab each movie, show, season, episode, artist, album or music track on your Plex Media Server with
+a custom user rating, and add the same star rating on the corresponding item on Jellyfin.
+With --all-users, each Plex user's own ratings are migrated to the Jellyfin user with the same name.
+With --incremental, only the ratings given since the last incremental run are read from Plex.
 """
 
+import helpers.clients as cl
+import helpers.config as cfg
+import helpers.fuzzy as fz
+import helpers.incremental as inc
 import helpers.jellyfin as jf
-import helpers.plex as px
-import creds as settings
+import helpers.jellyfin_async as jfa
+import helpers.journal as jnl
+import helpers.match_cache as mc
+import helpers.metrics as mtr
+import helpers.plan as pln
+import helpers.ratings as ratings
+import helpers.users as usr
 from progress.bar import Bar
+import argparse
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
-plex = px.Plex(url=settings.PLEX_URL,
-               token=settings.PLEX_TOKEN,
-               server_name=settings.PLEX_SERVER_NAME)
-jellyfin = jf.Jellyfin(url=settings.JELLYFIN_URL,
-                       api_key=settings.JELLYFIN_API_KEY,
-                       username=settings.JELLYFIN_ADMIN_USERNAME,
-                       password=settings.JELLYFIN_ADMIN_PASSWORD,
-                       default_policy=settings.JELLYFIN_USER_POLICY)
-
-
-def moveRatingToJellyfin(title, rating):
-    upvote = "true"
-    if rating < 6.0:
-        upvote = "false"
-    search_results = jellyfin.search(keyword=title)
-    if search_results:
-        jellyfin_item = search_results[0]
-        res = jellyfin.updateRating(itemId=jellyfin_item.id, upvote=upvote)
-        if res:
-            return True
-    return False
-
-
-print("Beginning rating migration...")
-for section in plex.get_library_sections():
-    # only movies and songs have user ratings
-    if section.type in ['movie']:
-        all_items = plex.get_all_section_items(section=section)
-        bar = Bar(f'Migrating Plex {section.type} ratings to Jellyfin', max=len(all_items))
-        success_count = 0
-        for movie in all_items:
-            if movie.userRating:  # No rating = None
-                if moveRatingToJellyfin(title=movie.title, rating=movie.userRating):
-                    success_count += 1
-            bar.next()
+# set by run()
+settings = None
+plex = None
+jellyfin = None
+journal = None
+plan = None
+changes = None
+match_stats = None
+match_cache = None
+fuzzy_threshold = fz.DEFAULT_THRESHOLD
+
+
+def plan_ratings(user_id, username, updates, user_journal):
+    for plex_item, item_id, data in updates:
+        plan.add(pln.ACTION_SET_USER_DATA, user_id=user_id, username=username, item_id=item_id, data=data,
+                 journal_key=user_journal.key(plex_item.ratingKey))
+
+
+async def migrate(async_jellyfin):
+    # Plex filters out unrated items server-side, so the work scales with the number of rated items
+    rated_items = ratings.get_rated_items(plex=plex, journal=journal, changes=changes)
+    for libtype, plex_items in rated_items.items():
+        if not plex_items:
+            continue
+        updates = ratings.match_ratings(jellyfin=jellyfin, plex_items=plex_items, journal=journal, stats=match_stats,
+                                        match_cache=match_cache, fuzzy_threshold=fuzzy_threshold)
+        if plan:
+            plan_ratings(user_id=jellyfin.user_id, username=settings.JELLYFIN_ADMIN_USERNAME, updates=updates,
+                         user_journal=journal)
+            print(f"Planned ratings for {len(updates)} of {len(plex_items)} {libtype}s.")
+            continue
+        bar = Bar(f'Migrating {len(updates)} {libtype} ratings from Plex to Jellyfin', max=len(updates))
+        success_count = await ratings.write_ratings(async_jellyfin=async_jellyfin, user_id=jellyfin.user_id,
+                                                    updates=updates, journal=journal, progress=bar.next)
         bar.finish()
-        print(f"Updated ratings on Jellyfin for {success_count} {section.type}s.")
-    elif section.type in ['artist']:
-        all_items = plex.get_all_section_items(section=section)
-        success_count = 0
-        for artist in all_items:
-            all_tracks = artist.tracks()
-            bar = Bar(f'Migrating {len(all_tracks)} track ratings from Plex to Jellyfin', max=len(all_tracks))
-            for track in all_tracks:
-                if track.userRating > 0.0:  # No rating = 0.0
-                    if moveRatingToJellyfin(title=track.title, rating=track.userRating):
-                        success_count += 1
-                bar.next()
-            bar.finish()
-        print(f"Updated ratings on Jellyfin for {success_count} tracks.")
-print("Rating migration complete.")
+        print(f"Updated ratings on Jellyfin for {success_count} of {len(plex_items)} {libtype}s.")
+    changes.save()
+
+
+def collect_user_ratings(user):
+    # runs on a worker thread: read one user's ratings with their Plex token and match them on Jellyfin
+    user_plex = user.get_plex(plex)
+    user_journal = journal.scoped(user.key)
+    user_changes = changes.scoped(user_journal)
+    rated_items = ratings.get_rated_items(plex=user_plex, journal=user_journal, changes=user_changes)
+    plex_items = [plex_item for items in rated_items.values() for plex_item in items]
+    updates = ratings.match_ratings(jellyfin=jellyfin, plex_items=plex_items, journal=user_journal, stats=match_stats,
+                                    match_cache=match_cache, fuzzy_threshold=fuzzy_threshold)
+    return len(plex_items), updates, user_changes
+
+
+async def migrate_user(async_jellyfin, plex_executor, user_semaphore, user):
+    async with user_semaphore:
+        loop = asyncio.get_event_loop()
+        try:
+            total, updates, user_changes = await loop.run_in_executor(plex_executor, collect_user_ratings, user)
+        except Exception as e:
+            print(f"Could not read ratings for {user.username} from Plex: {e}")
+            return False
+        if plan:
+            plan_ratings(user_id=user.jellyfin_user_id, username=user.username, updates=updates,
+                         user_journal=journal.scoped(user.key))
+            print(f"{user.username}: planned ratings for {len(updates)} of {total} items.")
+            return True
+        success_count = await ratings.write_ratings(async_jellyfin=async_jellyfin, user_id=user.jellyfin_user_id,
+                                                    updates=updates, journal=journal.scoped(user.key))
+        user_changes.save()
+        print(f"{user.username}: updated ratings on Jellyfin for {success_count} of {total} items.")
+        return True
+
+
+async def migrate_all_users(async_jellyfin, users, user_workers):
+    user_semaphore = asyncio.Semaphore(user_workers)
+    with ThreadPoolExecutor(max_workers=user_workers) as plex_executor:
+        results = await asyncio.gather(*[
+            migrate_user(async_jellyfin=async_jellyfin, plex_executor=plex_executor, user_semaphore=user_semaphore,
+                         user=user)
+            for user in users
+        ])
+    # items that failed are journaled and retried, but a user whose ratings couldn't be read at all fails the run
+    return all(results)
+
+
+def add_arguments(parser):
+    parser.add_argument('--match-report', type=str, required=False,
+                        help="Write a CSV of how each Plex item was matched on Jellyfin to this file")
+    parser.add_argument('--concurrency', '-c', type=int, default=16,
+                        help="How many rating updates to keep in flight at once (default: 16)")
+    parser.add_argument('--rate-limit', type=float, default=None,
+                        help="Maximum rating updates per second sent to Jellyfin (default: unlimited)")
+    parser.add_argument('--all-users', action='store_true',
+                        help="Migrate the ratings of every Plex user with server access to their Jellyfin user, "
+                             "not just the admin's")
+    parser.add_argument('--user-workers', type=int, default=8,
+                        help="How many users to migrate at once with --all-users (default: 8)")
+    jnl.add_journal_arguments(parser)
+    jnl.add_incremental_arguments(parser)
+    mc.add_match_cache_arguments(parser)
+    fz.add_fuzzy_arguments(parser)
+    pln.add_plan_arguments(parser)
+
+
+def run(args, clients):
+    global settings, plex, jellyfin, journal, plan, changes, match_stats, match_cache, fuzzy_threshold
+    settings = clients.settings
+    jellyfin = clients.jellyfin
+    journal = jnl.open_journal(migration='ratings', args=args)
+
+    if args.apply:
+        print(f"Applying rating plan {args.apply}...")
+        async_jellyfin = jfa.AsyncJellyfin(jellyfin=jellyfin, concurrency=args.concurrency,
+                                           rate_limit=args.rate_limit)
+        try:
+            jfa.run(pln.apply_user_data_actions(async_jellyfin=async_jellyfin,
+                                                actions=pln.read_plan(file=args.apply, migration='ratings'),
+                                                journal=journal))
+        finally:
+            async_jellyfin.close()
+            journal.close()
+        print("Rating migration complete.")
+        return
+
+    plex = clients.plex
+    plan = pln.open_plan(migration='ratings', args=args)
+    print("Beginning rating migration...")
+    match_cache = mc.open_match_cache(jellyfin=jellyfin, args=args)
+    fuzzy_threshold = args.fuzzy_threshold
+    match_stats = jf.MatchStats(audit=bool(args.match_report))
+    jellyfin.buildLibraryIndex(plex_types=ratings.RATED_LIBTYPES, lazy=match_cache is not None)
+    jellyfin_changed, jellyfin_newest = inc.check_jellyfin(jellyfin=jellyfin, journal=journal,
+                                                           incremental=args.incremental)
+    changes = inc.ChangeTracker(journal=journal, incremental=args.incremental, jellyfin_changed=jellyfin_changed)
+    async_jellyfin = jfa.AsyncJellyfin(jellyfin=jellyfin, concurrency=args.concurrency, rate_limit=args.rate_limit)
+    success = True
+    try:
+        if args.all_users:
+            users = usr.get_user_mappings(plex=plex, jellyfin=jellyfin,
+                                          admin_username=settings.JELLYFIN_ADMIN_USERNAME)
+            success = jfa.run(migrate_all_users(async_jellyfin=async_jellyfin, users=users,
+                                                user_workers=args.user_workers))
+        else:
+            jfa.run(migrate(async_jellyfin=async_jellyfin))
+        if success:
+            inc.save_jellyfin_mark(journal=journal, newest=jellyfin_newest)
+    finally:
+        async_jellyfin.close()
+        journal.close()
+    match_stats.print_summary()
+    if args.match_report:
+        match_stats.write_audit(file=args.match_report)
+    if plan:
+        plan.close()
+        plan.print_summary()
+    if not success:
+        print("Could not migrate the ratings of every user, see above.")
+        exit(1)
+    if not plan:
+        print("Rating migration complete.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    cfg.add_config_arguments(parser)
+    mtr.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    run(args=args, clients=cl.Clients(settings=cfg.load_settings(file=args.config)))
+    mtr.write_metrics(args)
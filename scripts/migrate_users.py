@@ -6,91 +6,108 @@ Sharing Users) Each new user account will have the same Plex name as their Jelly
 and a randomly-generated alphanumeric password.
 """
 
-import json
-import random
-import string
-import helpers.jellyfin as jf
-import helpers.plex as px
-import creds as settings
-
-plex = px.Plex(url=settings.PLEX_URL,
-               token=settings.PLEX_TOKEN,
-               server_name=settings.PLEX_SERVER_NAME)
-jellyfin = jf.Jellyfin(url=settings.JELLYFIN_URL,
-                       api_key=settings.JELLYFIN_API_KEY,
-                       username=settings.JELLYFIN_ADMIN_USERNAME,
-                       password=settings.JELLYFIN_ADMIN_PASSWORD,
-                       default_policy=settings.JELLYFIN_USER_POLICY)
-
-user_list = {}
-
-
-def password(length):
-    return ''.join(random.choice(string.ascii_letters + string.digits) for _ in range(length))
-
-
-def add_password(uid):
-    pwd = password(length=10)
-    if jellyfin.resetPassword(userId=uid):
-        if jellyfin.setUserPassword(userId=uid, currentPass="", newPass=pwd):
-            return pwd
-    return None
-
-
-def update_policy(uid, policy=None):
-    if jellyfin.updatePolicy(userId=uid, policy=policy):
-        return True
-    return False
-
-def make_jellyfin_user(username):
-    try:
-        pwd = None
-        jellyfin_user, failure_msg = jellyfin.makeUser(username=username)
-        if jellyfin_user:
-            pwd = add_password(uid=jellyfin_user.id)
-            if not pwd:
-                print("Password update failed. Moving on...")
-            if update_policy(uid=jellyfin_user.id, policy=jellyfin.policy):
-                return True, jellyfin_user.id, pwd
-            else:
-                return False, jellyfin_user.id, pwd
-        return False, failure_msg, pwd
-    except Exception as e:
-        print(f"Error in make_jellyfin_user: {e}")
-    return False, None, None
-
-def convert_plex_to_jellyfin(username):
-    print(f"Adding {username} to Jellyfin...")
-    succeeded, uid, pwd = make_jellyfin_user(username=username)
-    if succeeded:
-        user_list[username] = [uid, pwd]
-        return True, None
-    else:
-        if uid and pwd:
-            print(f"INFO: User created and password set, but policy update failed for {username}.")
-            user_list[username] = [uid, pwd]
-            return False, uid
-        if uid:
-            return False, uid
-    return False, None
+import argparse
+import helpers.clients as cl
+import helpers.config as cfg
+import helpers.journal as jnl
+import helpers.metrics as mtr
+import helpers.plan as pln
+import helpers.users as usr
 
-if __name__ == '__main__':
-    print("Beginning user migration...")
-    jf_users = [i.name for i in jellyfin.getUsers()]
+# set by run()
+plex = None
+jellyfin = None
+journal = None
+
+
+def retry_policy(provisioner, plex_user_id, username, jellyfin_id):
+    # created on an earlier run, but the policy update failed
+    print(f"Retrying policy update for {username}...")
+    journal.record_result(key=plex_user_id, jellyfin_id=jellyfin_id,
+                          success=jellyfin.updatePolicy(userId=jellyfin_id, policy=provisioner.policy))
+
+
+def plan_users(provisioner):
+    # ({username: Plex user ID} to create, [(Plex user ID, username, Jellyfin user ID)] to retry the policy for)
+    new_users = {}
+    policy_retries = []
     for plex_user in plex.get_users():
         if plex.user_has_server_access(user=plex_user):
-            username = plex_user.username or plex_user.title
-            if username in jf_users:
+            username = usr.get_plex_username(plex_user)
+            jellyfin_id, outcome = journal.get(plex_user.id)
+            if provisioner.exists(username) and outcome == jnl.OUTCOME_FAILED and jellyfin_id:
+                policy_retries.append((plex_user.id, username, jellyfin_id))
+            elif provisioner.exists(username):
                 print(f"User {username} already exists, skipping")
-                continue
             else:
-                success, failure_reason = convert_plex_to_jellyfin(username=username)
-                if success:
-                    print(f"{plex_user.username} added to Jellyfin.")
-                else:
-                    print(f"{plex_user.username} was not added to Jellyfin. Reason: {failure_reason}")
+                new_users[username] = plex_user.id
+    return new_users, policy_retries
+
+
+def read_user_plan(file):
+    new_users = {}
+    policy_retries = []
+    for action in pln.read_plan(file=file, migration='users'):
+        if action['action'] == pln.ACTION_CREATE_USER:
+            new_users[action['username']] = action['plex_user_id']
+        elif action['action'] == pln.ACTION_UPDATE_POLICY:
+            policy_retries.append((action['plex_user_id'], action['username'], action['user_id']))
+    return new_users, policy_retries
+
+
+def add_arguments(parser):
+    parser.add_argument('--workers', '-w', type=int, default=8,
+                        help="How many users to create on Jellyfin at once (default: 8)")
+    jnl.add_journal_arguments(parser)
+    pln.add_plan_arguments(parser)
+
+
+def run(args, clients):
+    global plex, jellyfin, journal
+    jellyfin = clients.jellyfin
+    journal = jnl.open_journal(migration='users', args=args)
+
+    print("Beginning user migration...")
+    provisioner = usr.UserProvisioner(jellyfin=jellyfin, workers=args.workers)
+    if args.apply:
+        new_users, policy_retries = read_user_plan(file=args.apply)
+    else:
+        plex = clients.plex
+        new_users, policy_retries = plan_users(provisioner=provisioner)
+
+    plan = pln.open_plan(migration='users', args=args)
+    if plan:
+        for plex_user_id, username, jellyfin_id in policy_retries:
+            plan.add(pln.ACTION_UPDATE_POLICY, username=username, plex_user_id=plex_user_id, user_id=jellyfin_id)
+        for username, plex_user_id in new_users.items():
+            plan.add(pln.ACTION_CREATE_USER, username=username, plex_user_id=plex_user_id)
+        plan.close()
+        journal.close()
+        plan.print_summary()
+        return
+
+    for plex_user_id, username, jellyfin_id in policy_retries:
+        retry_policy(provisioner=provisioner, plex_user_id=plex_user_id, username=username, jellyfin_id=jellyfin_id)
+
+    def on_result(result):
+        journal.record_result(key=new_users[result.username], success=result.success,
+                              jellyfin_id=result.user_id)
+        if result.success:
+            print(f"{result.username} added to Jellyfin.")
+        else:
+            print(f"{result.username} was not added to Jellyfin. Reason: {result.reason}")
+
+    provisioner.provision_all(usernames=list(new_users.keys()), on_result=on_result)
+    journal.close()
     print("User migration complete.")
-    if user_list:
-        print("\nUsername ---- Password")
-        for k, v in user_list.items():
-            print(f"{k}  |  {v[1]}")
+    provisioner.print_credentials()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    cfg.add_config_arguments(parser)
+    mtr.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    run(args=args, clients=cl.Clients(settings=cfg.load_settings(file=args.config)))
+    mtr.write_metrics(args)
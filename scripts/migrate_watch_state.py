@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+"""
+This script will copy the watched status, play count, last played date and resume position of every movie, episode
+and music track from each Plex user with access to your Plex Media Server (Sharing Users) to the Jellyfin user with
+the same name (as created by migrate_users.py).
+With --incremental, only the items played since the last incremental run are read from Plex.
+"""
+
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timezone
+import helpers.clients as cl
+import helpers.config as cfg
+import helpers.fuzzy as fz
+import helpers.incremental as inc
+import helpers.jellyfin as jf
+import helpers.jellyfin_async as jfa
+import helpers.journal as jnl
+import helpers.match_cache as mc
+import helpers.metrics as mtr
+import helpers.plan as pln
+import helpers.users as usr
+
+# set by run()
+plex = None
+jellyfin = None
+journal = None
+plan = None
+changes = None
+match_stats = None
+match_cache = None
+fuzzy_threshold = fz.DEFAULT_THRESHOLD
+
+# Jellyfin stores positions in ticks (100ns), Plex in milliseconds
+TICKS_PER_MILLISECOND = 10000
+
+# Plex item types with a watch state
+WATCHED_TYPES = ['movie', 'episode', 'track']
+
+
+def watch_state_user_data(plex_item, in_progress):
+    data = {}
+    if in_progress:
+        data['PlaybackPositionTicks'] = int(plex_item.viewOffset or 0) * TICKS_PER_MILLISECOND
+    if plex_item.viewCount:
+        data['PlayCount'] = int(plex_item.viewCount)
+        if not in_progress:
+            data['Played'] = True
+    if plex_item.lastViewedAt:
+        data['LastPlayedDate'] = plex_item.lastViewedAt.astimezone(timezone.utc).isoformat()
+    return data
+
+
+def collect_watch_state(user):
+    # runs on a worker thread: fetch one user's watched and in-progress items from Plex and match them on Jellyfin
+    user_plex = user.get_plex(plex)
+    user_journal = journal.scoped(user.key)
+    user_changes = changes.scoped(user_journal)
+    since = user_changes.since('lastViewedAt')
+    states = {}
+    for plex_item in user_plex.iter_watched_items(since=since):
+        states[plex_item.ratingKey] = (plex_item, watch_state_user_data(plex_item=plex_item, in_progress=False))
+    for plex_item in user_plex.iter_in_progress_items(since=since):
+        data = states.get(plex_item.ratingKey, (None, {}))[1]
+        data.update(watch_state_user_data(plex_item=plex_item, in_progress=True))
+        states[plex_item.ratingKey] = (plex_item, data)
+    if since is not None:
+        for plex_item in inc.retry_items(plex=user_plex, changes=user_changes):
+            if plex_item.ratingKey not in states and plex_item.type in WATCHED_TYPES:
+                states[plex_item.ratingKey] = (plex_item, watch_state_user_data(
+                    plex_item=plex_item, in_progress=bool(plex_item.viewOffset)))
+    updates = []
+    for rating_key, (plex_item, data) in states.items():
+        user_changes.seen('lastViewedAt', plex_item.lastViewedAt)
+        # played again since the last incremental run, so redone even though the journal has it
+        if since is None and user_journal.is_done(rating_key):
+            continue
+        jellyfin_item = jellyfin.findPlexItemOnJellyfin(plex_item=plex_item, stats=match_stats,
+                                                        match_cache=match_cache, fuzzy_threshold=fuzzy_threshold)
+        if jellyfin_item:
+            updates.append((rating_key, jellyfin_item.id, data))
+        else:
+            user_journal.record(key=rating_key, outcome=jnl.OUTCOME_UNMATCHED)
+    return len(states), updates, user_changes
+
+
+async def migrate_user(async_jellyfin, plex_executor, user_semaphore, user):
+    async with user_semaphore:
+        loop = asyncio.get_event_loop()
+        try:
+            total, updates, user_changes = await loop.run_in_executor(plex_executor, collect_watch_state, user)
+        except Exception as e:
+            print(f"Could not read watch state for {user.username} from Plex: {e}")
+            return False
+        user_journal = journal.scoped(user.key)
+        if plan:
+            for rating_key, item_id, data in updates:
+                plan.add(pln.ACTION_SET_USER_DATA, user_id=user.jellyfin_user_id, username=user.username,
+                         item_id=item_id, data=data, journal_key=user_journal.key(rating_key))
+            print(f"{user.username}: planned watch state for {len(updates)} of {total} items "
+                  f"({total - len(updates)} unmatched or already migrated).")
+            return True
+        results = await async_jellyfin.updateUserDataBatch(
+            userId=user.jellyfin_user_id, updates=[(item_id, data) for _, item_id, data in updates])
+        for (rating_key, item_id, _), success in zip(updates, results):
+            user_journal.record_result(key=rating_key, success=success, jellyfin_id=item_id)
+        user_changes.save()
+        success_count = sum(1 for success in results if success)
+        print(f"{user.username}: updated watch state for {success_count} of {total} items "
+              f"({total - len(updates)} unmatched or already migrated).")
+        return True
+
+
+async def migrate(async_jellyfin, users, user_workers):
+    user_semaphore = asyncio.Semaphore(user_workers)
+    with ThreadPoolExecutor(max_workers=user_workers) as plex_executor:
+        results = await asyncio.gather(*[
+            migrate_user(async_jellyfin=async_jellyfin, plex_executor=plex_executor, user_semaphore=user_semaphore,
+                         user=user)
+            for user in users
+        ])
+    # items that failed are journaled and retried, but a user whose watch state couldn't be read at all fails the run
+    return all(results)
+
+
+def add_arguments(parser):
+    parser.add_argument('--user-workers', type=int, default=8,
+                        help="How many users to migrate at once (default: 8)")
+    parser.add_argument('--concurrency', '-c', type=int, default=16,
+                        help="How many watch state updates to keep in flight at once, across all users (default: 16)")
+    parser.add_argument('--rate-limit', type=float, default=None,
+                        help="Maximum watch state updates per second sent to Jellyfin (default: unlimited)")
+    parser.add_argument('--include-admin', action='store_true',
+                        help="Also copy the Plex admin's watch state to the Jellyfin admin user")
+    parser.add_argument('--match-report', type=str, required=False,
+                        help="Write a CSV of how each Plex item was matched on Jellyfin to this file")
+    jnl.add_journal_arguments(parser)
+    jnl.add_incremental_arguments(parser)
+    mc.add_match_cache_arguments(parser)
+    fz.add_fuzzy_arguments(parser)
+    pln.add_plan_arguments(parser)
+
+
+def run(args, clients):
+    global plex, jellyfin, journal, plan, changes, match_stats, match_cache, fuzzy_threshold
+    jellyfin = clients.jellyfin
+    journal = jnl.open_journal(migration='watch_state', args=args)
+
+    if args.apply:
+        print(f"Applying watch state plan {args.apply}...")
+        async_jellyfin = jfa.AsyncJellyfin(jellyfin=jellyfin, concurrency=args.concurrency,
+                                           rate_limit=args.rate_limit)
+        try:
+            jfa.run(pln.apply_user_data_actions(async_jellyfin=async_jellyfin,
+                                                actions=pln.read_plan(file=args.apply, migration='watch_state'),
+                                                journal=journal))
+        finally:
+            async_jellyfin.close()
+            journal.close()
+        print("Watch state migration complete.")
+        return
+
+    plex = clients.plex
+    plan = pln.open_plan(migration='watch_state', args=args)
+    print("Beginning watch state migration...")
+    match_cache = mc.open_match_cache(jellyfin=jellyfin, args=args)
+    fuzzy_threshold = args.fuzzy_threshold
+    match_stats = jf.MatchStats(audit=bool(args.match_report))
+    jellyfin.buildLibraryIndex(plex_types=WATCHED_TYPES, lazy=match_cache is not None)
+    users = usr.get_user_mappings(plex=plex, jellyfin=jellyfin, include_admin=args.include_admin,
+                                  admin_username=clients.settings.JELLYFIN_ADMIN_USERNAME)
+    jellyfin_changed, jellyfin_newest = inc.check_jellyfin(jellyfin=jellyfin, journal=journal,
+                                                           incremental=args.incremental)
+    changes = inc.ChangeTracker(journal=journal, incremental=args.incremental, jellyfin_changed=jellyfin_changed)
+    async_jellyfin = jfa.AsyncJellyfin(jellyfin=jellyfin, concurrency=args.concurrency, rate_limit=args.rate_limit)
+    try:
+        success = jfa.run(migrate(async_jellyfin=async_jellyfin, users=users, user_workers=args.user_workers))
+        if success:
+            inc.save_jellyfin_mark(journal=journal, newest=jellyfin_newest)
+    finally:
+        async_jellyfin.close()
+        journal.close()
+    match_stats.print_summary()
+    if args.match_report:
+        match_stats.write_audit(file=args.match_report)
+    if plan:
+        plan.close()
+        plan.print_summary()
+    if not success:
+        print("Could not migrate the watch state of every user, see above.")
+        exit(1)
+    if not plan:
+        print("Watch state migration complete.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    cfg.add_config_arguments(parser)
+    mtr.add_metrics_arguments(parser)
+    args = parser.parse_args()
+    run(args=args, clients=cl.Clients(settings=cfg.load_settings(file=args.config)))
+    mtr.write_metrics(args)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+"""
+Runs one or more migrations in a single process. The Plex and Jellyfin connections, the Jellyfin token, the
+Jellyfin library index and the match cache are created once, on first use, and shared by every migration:
+
+    plex2jellyfin.py users + ratings --all-users + playlists --all-users + posters --upload
+
+Separate migrations with "+". Options after a migration's name belong to that migration; run
+"plex2jellyfin.py ratings -h" to see them. Every migration is checked before the first one starts.
+Settings are read from --config, $PLEX2JELLYFIN_CONFIG or creds.py, and environment variables with the same
+names (PLEX_URL, JELLYFIN_API_KEY, ...) override them.
+
+With --parallel the migrations run as a dependency graph instead of one after the other. Every migration starts as
+soon as the ones it depends on are done: users runs before ratings, playlists and watch-state, and posters doesn't
+wait for users.
+"""
+
+import argparse
+import functools
+import importlib
+import sys
+
+import helpers.clients as cl
+import helpers.config as cfg
+import helpers.dag as dag
+import helpers.metrics as mtr
+
+# command --> (script module, description); a script is only imported when its command is used
+COMMANDS = {
+    'users': ('migrate_users', "Create a Jellyfin user for each Plex user with access to the server"),
+    'ratings': ('migrate_ratings', "Copy Plex user ratings to Jellyfin"),
+    'playlists': ('migrate_playlists', "Copy Plex playlists to Jellyfin"),
+    'posters': ('migrate_posters', "Copy posters and backdrops to Jellyfin"),
+    'watch-state': ('migrate_watch_state', "Copy watched status, play counts and resume positions to Jellyfin"),
+    'jf-to-jf': ('jellyfin_users_to_other_jellyfin', "Create the users of one Jellyfin server on another"),
+}
+
+SEPARATOR = '+'
+
+# migrations that write to the Jellyfin users created by the users migration
+USER_DATA_COMMANDS = {'ratings', 'playlists', 'watch-state'}
+
+
+def split_commands(argv):
+    groups = [[]]
+    for arg in argv:
+        if arg == SEPARATOR:
+            groups.append([])
+        else:
+            groups[-1].append(arg)
+    return [group for group in groups if group]
+
+
+def make_parser():
+    epilog = "migrations:\n" + "\n".join(f"  {command:<12} {description}"
+                                          for command, (_, description) in COMMANDS.items())
+    parser = argparse.ArgumentParser(prog='plex2jellyfin.py', description=__doc__, epilog=epilog,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    cfg.add_config_arguments(parser)
+    mtr.add_metrics_arguments(parser)
+    parser.add_argument('--parallel', action='store_true',
+                        help="Run independent migrations at the same time")
+    parser.add_argument('command', choices=list(COMMANDS.keys()), metavar='migration',
+                        help="The first migration to run")
+    parser.add_argument('command_args', nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    return parser
+
+
+def parse_command(parser, command, command_args):
+    if command not in COMMANDS:
+        parser.error(f"unknown migration {command!r} (choose from {', '.join(COMMANDS.keys())})")
+    module_name, description = COMMANDS[command]
+    module = importlib.import_module(module_name)
+    command_parser = argparse.ArgumentParser(prog=f'{parser.prog} {command}', description=description)
+    module.add_arguments(command_parser)
+    return module, command_parser.parse_args(command_args)
+
+
+def run_parallel(migrations, clients):
+    graph = dag.TaskGraph(workers=len(migrations))
+    # users first, so the migrations writing per-user data can depend on it
+    migrations = sorted(migrations, key=lambda migration: migration[0] != 'users')
+    commands = [command for command, _, _ in migrations]
+    names = []
+    for command, module, args in migrations:
+        name = command if command not in names else f'{command}-{names.count(command) + 1}'
+        after = []
+        if command in names:
+            # a script keeps its state in module globals, so the same migration never runs twice at once
+            after.append(command if names.count(command) == 1 else f'{command}-{names.count(command)}')
+        if command in USER_DATA_COMMANDS and 'users' in commands:
+            after.append('users')
+        graph.add(name, functools.partial(module.run, args=args, clients=clients), after=after)
+        names.append(command)
+    status = graph.run()
+    print("Migrations: " + ", ".join(f"{name} {result}" for name, result in status.items()))
+    return all(result == dag.TASK_DONE for result in status.values())
+
+
+def main(argv=None):
+    parser = make_parser()
+    groups = split_commands(sys.argv[1:] if argv is None else argv)
+    if not groups:
+        parser.print_help()
+        exit(1)
+    args = parser.parse_args(groups[0])
+    runs = [(args.command, args.command_args)] + [(group[0], group[1:]) for group in groups[1:]]
+    # check every migration's options before running any of them
+    migrations = [(command, *parse_command(parser=parser, command=command, command_args=command_args))
+                  for command, command_args in runs]
+
+    clients = cl.Clients(settings=cfg.load_settings(file=args.config))
+    if args.parallel:
+        success = run_parallel(migrations=migrations, clients=clients)
+        mtr.write_metrics(args)
+        exit(0 if success else 1)
+    for command, module, command_args in migrations:
+        if len(migrations) > 1:
+            print(f"Running {command}...")
+        module.run(args=command_args, clients=clients)
+    mtr.write_metrics(args)
+
+
+if __name__ == '__main__':
+    main()
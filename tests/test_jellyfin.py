@@ -0,0 +1,99 @@
+import socket
+import threading
+from xml.etree import ElementTree
+
+import pytest
+import requests
+from plexapi.video import Movie
+
+import helpers.jellyfin as jf
+
+
+class OfflineServer:
+    # any request fails the test
+    _baseurl = 'http://plex.invalid'
+
+    def query(self, *args, **kwargs):
+        raise AssertionError(f"unexpected Plex request: {args}")
+
+
+def make_movie(xml):
+    # a partial item, as a library listing returns it
+    return Movie(OfflineServer(), ElementTree.fromstring(xml), initpath='/library/sections/1/all')
+
+
+def test_provider_ids_from_guids():
+    movie = make_movie('<Video ratingKey="1" key="/library/metadata/1" type="movie" title="Tron" '
+                       'guid="plex://movie/5d776825880197001ec90a5c">'
+                       '<Guid id="imdb://tt0084827"/><Guid id="tmdb://97"/></Video>')
+    assert jf.get_plex_provider_ids(movie) == [('imdb', 'tt0084827'), ('tmdb', '97')]
+
+
+def test_provider_ids_without_guids_makes_no_request():
+    movie = make_movie('<Video ratingKey="2" key="/library/metadata/2" type="movie" title="Tron" '
+                       'guid="com.plexapp.agents.imdb://tt0084827?lang=en"/>')
+    assert jf.get_plex_provider_ids(movie) == [('imdb', 'tt0084827')]
+
+    movie = make_movie('<Video ratingKey="3" key="/library/metadata/3" type="movie" title="Tron"/>')
+    assert jf.get_plex_provider_ids(movie) == []
+
+
+def request_error(url):
+    try:
+        requests.post(url, json={'Ids': ['1']}, timeout=5)
+    except requests.exceptions.RequestException as e:
+        return e
+    raise AssertionError("the request should have failed")
+
+
+def test_refused_post_was_not_sent():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+    # nothing listens on the port any more
+    assert jf._not_sent(request_error(f'http://127.0.0.1:{port}/Playlists'))
+
+
+def test_post_reset_after_sending_may_have_been_applied():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+
+    def accept():
+        conn, _ = server.accept()
+        conn.recv(65536)
+        conn.close()
+
+    thread = threading.Thread(target=accept, daemon=True)
+    thread.start()
+    try:
+        error = request_error(f'http://127.0.0.1:{server.getsockname()[1]}/Playlists')
+    finally:
+        thread.join(timeout=5)
+        server.close()
+    assert isinstance(error, requests.exceptions.ConnectionError)
+    assert not jf._not_sent(error)
+
+
+class PagedJellyfin(jf.Jellyfin):
+    # playlist pages served from memory; a page of None stands for a request that failed after every retry
+    def __init__(self, pages):
+        self.pages = pages
+
+    def getPlaylistItemsPage(self, playlistId, start_index=0, limit=None, userId=None):
+        return self.pages[start_index // limit] or {}
+
+
+def playlist_page(ids, total):
+    return {'Items': [{'Id': item_id, 'Name': item_id} for item_id in ids], 'TotalRecordCount': total}
+
+
+def test_playlist_items_across_pages():
+    jellyfin = PagedJellyfin(pages=[playlist_page(['a', 'b'], total=3), playlist_page(['c'], total=3)])
+    assert [item.id for item in jellyfin.getPlaylistItems(playlistId='p', page_size=2)] == ['a', 'b', 'c']
+
+
+def test_playlist_items_with_a_failed_page():
+    jellyfin = PagedJellyfin(pages=[playlist_page(['a', 'b'], total=5), None, playlist_page(['e'], total=5)])
+    with pytest.raises(jf.IncompleteListError):
+        jellyfin.getPlaylistItems(playlistId='p', page_size=2)
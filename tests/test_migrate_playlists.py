@@ -0,0 +1,51 @@
+from datetime import datetime
+
+import helpers.incremental as inc
+import helpers.jellyfin as jf
+import helpers.journal as jnl
+import migrate_playlists
+
+
+class FakePlaylist:
+    ratingKey = '7'
+    title = 'Road Trip'
+    updatedAt = datetime(2024, 1, 1)
+
+    def items(self):
+        return []
+
+
+class FakePlex:
+    def get_playlists(self):
+        return [FakePlaylist()]
+
+
+class FakeJellyfin:
+    def __init__(self):
+        self.added = []
+
+    def getPlaylists(self, userId=None):
+        return [jf.JellyfinPlaylist(data={'Id': 'p1', 'Name': 'Road Trip'})]
+
+    def getPlaylistItems(self, playlistId, userId=None):
+        # the second page of the playlist could not be fetched
+        raise jf.IncompleteListError("Could not fetch Jellyfin items from 1000 on")
+
+    def addToPlaylist(self, playlistId, itemIds, **kwargs):
+        self.added.append((playlistId, itemIds))
+        return True
+
+
+def test_playlist_with_a_failed_page_is_skipped(tmp_path, monkeypatch):
+    journal = jnl.Journal(migration='playlists', file=str(tmp_path / 'journal.db'))
+    jellyfin = FakeJellyfin()
+    monkeypatch.setattr(migrate_playlists, 'jellyfin', jellyfin)
+    monkeypatch.setattr(migrate_playlists, 'journal', journal)
+    monkeypatch.setattr(migrate_playlists, 'plan', None)
+    monkeypatch.setattr(migrate_playlists, 'changes', inc.ChangeTracker(journal=journal, incremental=False))
+
+    migrate_playlists.migrate_playlists(user_plex=FakePlex(), show_progress=False)
+
+    assert jellyfin.added == []
+    assert journal.get('playlist/7') == ('p1', jnl.OUTCOME_FAILED)
+    journal.close()
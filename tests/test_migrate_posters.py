@@ -0,0 +1,80 @@
+import argparse
+from datetime import datetime
+
+import pytest
+
+import helpers.incremental as inc
+import helpers.journal as jnl
+import migrate_posters
+
+PLEX_MARK = 1700000000
+JELLYFIN_MARK = '2024-01-01T00:00:00.0000000Z'
+
+
+class FakeItem:
+    type = 'movie'
+    title = 'Tron'
+    year = 1982
+
+    def __init__(self, rating_key, updated_at):
+        self.ratingKey = rating_key
+        self.updatedAt = datetime.fromtimestamp(updated_at)
+
+
+class FakeSection:
+    type = 'movie'
+
+
+class FakePlex:
+    # the second page of the listing fails
+    def get_library_sections(self):
+        return [FakeSection()]
+
+    def iter_section_items(self, section, libtype, since=None):
+        yield FakeItem(rating_key='1', updated_at=PLEX_MARK + 60)
+        raise RuntimeError("Plex went away")
+
+
+class FakeIndex:
+    complete = True
+
+
+class FakeJellyfin:
+    pool_size = 1
+
+    def setPoolSize(self, size):
+        self.pool_size = size
+
+    def buildLibraryIndex(self, **kwargs):
+        return FakeIndex()
+
+    def getLibraryStats(self):
+        return 10, '2025-01-01T00:00:00.0000000Z'
+
+    def findPlexItemOnJellyfin(self, plex_item, **kwargs):
+        return None
+
+
+class FakeClients:
+    plex = FakePlex()
+    jellyfin = FakeJellyfin()
+
+
+def test_failed_enumeration_keeps_the_marks(tmp_path):
+    journal_file = str(tmp_path / 'journal.db')
+    journal = jnl.Journal(migration='posters', file=journal_file)
+    journal.set_mark('plex:updatedAt', PLEX_MARK)
+    journal.set_mark(inc.JELLYFIN_MARK, JELLYFIN_MARK)
+    journal.close()
+
+    parser = argparse.ArgumentParser()
+    migrate_posters.add_arguments(parser)
+    args = parser.parse_args(['--upload', '--incremental', '--no-match-cache', '--libraries', 'movies',
+                              '--journal', journal_file])
+    with pytest.raises(SystemExit):
+        migrate_posters.run(args=args, clients=FakeClients())
+
+    journal = jnl.Journal(migration='posters', file=journal_file)
+    assert journal.get_mark('plex:updatedAt') == str(PLEX_MARK)
+    assert journal.get_mark(inc.JELLYFIN_MARK) == JELLYFIN_MARK
+    journal.close()
@@ -0,0 +1,20 @@
+import helpers.pipeline as pl
+
+
+def test_run_processes_every_item():
+    seen = []
+    pipeline = pl.Pipeline(queue_size=2).add_stage(name='double', func=lambda n: [n * 2], workers=3)
+    pipeline.add_stage(name='collect', func=seen.append)
+    assert pipeline.run(source=iter(range(10)))
+    assert sorted(seen) == [n * 2 for n in range(10)]
+
+
+def test_run_reports_a_failed_source():
+    def source():
+        yield 1
+        raise RuntimeError("Plex went away")
+
+    seen = []
+    pipeline = pl.Pipeline().add_stage(name='collect', func=seen.append)
+    assert not pipeline.run(source=source())
+    assert seen == [1]